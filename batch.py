@@ -0,0 +1,59 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib import parse
+
+import fetcher
+import resilience
+
+logger = logging.getLogger(__name__)
+
+# Shared worker pool for batch expansions, and the most calls in flight to any one server
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", 16))
+BATCH_PER_ENDPOINT = int(os.getenv("BATCH_PER_ENDPOINT", 8))
+
+_executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix='batch')
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def endpoint_semaphore(vs_endpoint):
+    """Semaphore limiting concurrent batch calls to one terminology server"""
+    key = parse.urlsplit(vs_endpoint).netloc
+    with _semaphores_lock:
+        semaphore = _semaphores.get(key)
+        if semaphore is None:
+            semaphore = _semaphores[key] = threading.BoundedSemaphore(BATCH_PER_ENDPOINT)
+    return semaphore
+
+
+def _expand_item(vs_endpoint, item, count, expand):
+    start = time.perf_counter()
+    try:
+        with endpoint_semaphore(vs_endpoint):
+            result = expand(vs_endpoint, item['expression'], count)
+    except Exception as e:
+        logger.error(f'Batch expansion failed for {item.get("filename")}: {e}')
+        result = {'total': -1, 'concepts': [], 'error': str(e)}
+    return item, result, (time.perf_counter() - start) * 1000
+
+
+def expand_many(vs_endpoint, items, count, expand=None):
+    """
+    Expand many {'expression', 'filename'} items on the shared worker pool and
+    yield (item, result, elapsed_ms) in completion order. Wall time is close to
+    the slowest expansion as long as the batch fits in the per-endpoint limit.
+    Work not yet started is cancelled if the consumer stops early.
+    """
+    expand = expand or fetcher.cached_expand_valueset
+    pending = {resilience.submit(_executor, _expand_item, vs_endpoint, item, count, expand) for item in items}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
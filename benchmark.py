@@ -0,0 +1,623 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the ECL Expression Tester, run against a local stand-in
+terminology server so the numbers are reproducible offline.
+
+Usage:
+    python benchmark.py transport [--requests 200] [--concurrency 4]
+    python benchmark.py search [--entries 100000] [--queries 2000]
+    python benchmark.py decode [--concepts 1000]
+    python benchmark.py parse [--repeat 2000]
+    python benchmark.py snapshot [--concepts 300000]
+    python benchmark.py closure [--concepts 300000]
+    python benchmark.py metrics [--observations 200000] [--threads 4]
+    python benchmark.py load [--scenarios test_ecl,search,index,fetcher] [--concurrency 8] [--output results.json]
+    python benchmark.py compare baseline.json results.json [--threshold 10]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib import parse
+
+# Load results must not depend on earlier runs: no on-disk expansion store and no background warming
+os.environ.setdefault('EXPANSION_STORE', '')
+os.environ.setdefault('CACHE_WARMER', 'false')
+
+import requests
+
+import ecl_parser
+import fetcher
+from ecl_catalog import EclCatalog
+from expansion_decoder import decode_expansion
+from fake_tx_server import FakeTerminologyServer, build_expansion, synthetic_code
+from search_index import SearchIndex
+
+SAMPLE_ECL = '< 404684003 |Clinical finding|'
+
+
+def curl_expand(vs_endpoint, ecl_expr, count):
+    """The previous transport: one curl process (and connection) per call"""
+    vsexp = vs_endpoint + '/ValueSet/$expand?url=http://snomed.info/sct?fhir_vs=ecl/'
+    query = f"{vsexp}{parse.quote(ecl_expr, safe='')}&count={count}"
+    command = ['curl', '-s', '-H', 'Accept: application/fhir+json', '--location', query]
+    result = subprocess.run(command, capture_output=True)
+    return fetcher.parse_expansion(result.stdout)
+
+
+def run_load(func, endpoint, requests, concurrency):
+    """Call func(endpoint, SAMPLE_ECL, 25) `requests` times; return requests/sec"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: func(endpoint, SAMPLE_ECL, 25), range(requests)))
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for r in results if r.get('total', -1) < 0)
+    if failures:
+        print(f'  warning: {failures} failed calls')
+    return requests / elapsed
+
+
+def bench_transport(args):
+    """Compare requests/sec of the curl subprocess path and the pooled client"""
+    fetcher.configure_transport(pool_size=max(args.concurrency, 1))
+    with FakeTerminologyServer(total=args.total) as server:
+        print(f'Transport benchmark: {args.requests} requests, concurrency {args.concurrency}, '
+              f'{args.total} concepts per expansion')
+        # Warm up both paths once so imports and first connections are excluded
+        curl_expand(server.url, SAMPLE_ECL, 25)
+        fetcher.expand_valueset(server.url, SAMPLE_ECL, 25)
+
+        curl_rps = run_load(curl_expand, server.url, args.requests, args.concurrency)
+        print(f'  curl subprocess : {curl_rps:8.1f} req/s')
+        pooled_rps = run_load(fetcher.expand_valueset, server.url, args.requests, args.concurrency)
+        print(f'  pooled client   : {pooled_rps:8.1f} req/s')
+        print(f'  speedup         : {pooled_rps / curl_rps:8.2f}x')
+    fetcher.close_sessions()
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def synthetic_library(entries, seed=42):
+    """Generate catalog entries that look like ecl_library files"""
+    rng = random.Random(seed)
+    syllables = ['ab', 'ce', 'di', 'fo', 'gu', 'la', 'me', 'ni', 'po', 'ra', 'si', 'tu', 'ven', 'xo', 'zy']
+    words = sorted({''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(8000)})
+    words += ['injection', 'tablet', 'finding', 'disorder', 'procedure', 'product', 'reference', 'set']
+    categories = ['AMT', 'ClinicalFindings', 'Procedures', 'Qualifiers', 'RefSets', 'Situations']
+    concepts = [str(rng.randint(10 ** 8, 10 ** 15)) for _ in range(20000)]
+    library = []
+    for i in range(entries):
+        title = [rng.choice(words) for _ in range(rng.randint(2, 5))]
+        clauses = []
+        for _ in range(rng.randint(1, 4)):
+            term = ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+            clauses.append(f'{rng.choice(["<", "<<", "^"])} {rng.choice(concepts)} |{term}|')
+        category = rng.choice(categories)
+        library.append({
+            'filename': f'{i:06d}-{"-".join(title)}.txt',
+            'path': f'ecl_library/{category}/{i:06d}.txt',
+            'description': ' '.join(rng.choice(words) for _ in range(rng.randint(4, 12))),
+            'expression': ' AND '.join(clauses),
+            'category': category
+        })
+    return library, words, concepts
+
+
+def bench_search(args):
+    """Build the search index over a synthetic library and measure query latency"""
+    library, words, concepts = synthetic_library(args.entries)
+    index = SearchIndex()
+    start = time.perf_counter()
+    index.add_many(library)
+    print(f'Search benchmark: indexed {args.entries} entries in {time.perf_counter() - start:.2f}s')
+
+    rng = random.Random(7)
+    queries = []
+    for _ in range(args.queries):
+        kind = rng.random()
+        word = rng.choice(words)
+        if kind < 0.3:
+            queries.append(word)
+        elif kind < 0.6:
+            queries.append(word[:rng.randint(2, len(word))])  # typeahead prefix
+        elif kind < 0.8:
+            queries.append(f'{word} {rng.choice(words)[:3]}')
+        elif kind < 0.9:
+            queries.append(rng.choice(concepts))
+        else:
+            queries.append(rng.choice(['injection', 'reference set', 'disorder', 'product tablet']))
+
+    timings = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query, limit=10)
+        timings.append((time.perf_counter() - start) * 1000)
+    print(f'  {len(queries)} queries: p50 {percentile(timings, 50):.3f} ms, '
+          f'p95 {percentile(timings, 95):.3f} ms, p99 {percentile(timings, 99):.3f} ms, '
+          f'max {max(timings):.3f} ms')
+
+    # Incremental update cost
+    start = time.perf_counter()
+    for entry in library[:100]:
+        index.add(dict(entry, description=entry['description'] + ' edited'))
+    print(f'  re-index 100 changed entries: {(time.perf_counter() - start) * 1000:.1f} ms')
+
+
+def fhirpath_decode(content):
+    """The previous decoder: json.loads plus fhirpathpy evaluate calls per concept"""
+    from fhirpathpy import evaluate
+
+    data = json.loads(content)
+    total = evaluate(data, "expansion.total")
+    concepts = []
+    for concept in evaluate(data, "expansion.contains"):
+        code = evaluate(concept, "code")
+        display = evaluate(concept, "display")
+        concepts.append({'code': str(code[0]), 'display': str(display[0]) if display else str(code[0])})
+    return {'total': total[0], 'concepts': concepts}
+
+
+def bench_decode(args):
+    """Per-concept decode cost of fhirpathpy vs the streaming decoder"""
+    content = json.dumps(build_expansion(SAMPLE_ECL, args.concepts, 0, args.concepts)).encode('utf-8')
+    chunks = [content[i:i + 64 * 1024] for i in range(0, len(content), 64 * 1024)]
+    print(f'Decode benchmark: {args.concepts} concepts, {len(content) / 1024:.0f} KiB response')
+
+    def per_concept_us(func, repeat):
+        func()  # warm up (imports, regex compilation)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = func()
+        elapsed = time.perf_counter() - start
+        assert len(result['concepts']) == args.concepts
+        return elapsed / repeat / args.concepts * 1e6
+
+    before = per_concept_us(lambda: fhirpath_decode(content), 3)
+    after = per_concept_us(lambda: decode_expansion(chunks), 20)
+    print(f'  fhirpathpy evaluate : {before:8.2f} us/concept')
+    print(f'  streaming decoder   : {after:8.2f} us/concept')
+    print(f'  speedup             : {before / after:8.1f}x')
+
+
+def bench_parse(args):
+    """Parse latency for every expression in the ECL library"""
+    expressions = [entry['expression'] for entry in EclCatalog(args.library).files()]
+    timings = []
+    for expression in expressions:
+        ecl_parser.parse(expression)  # warm up
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            ecl_parser.parse(expression)
+        timings.append((time.perf_counter() - start) / args.repeat * 1e6)
+    print(f'Parse benchmark: {len(expressions)} library expressions, {args.repeat} parses each')
+    print(f'  p50 {percentile(timings, 50):.1f} us, max {max(timings):.1f} us, '
+          f'longest expression {max(len(e) for e in expressions)} chars')
+
+
+# Run in a fresh interpreter so load time and memory are measured cold
+SNAPSHOT_PROBE = '''
+import random, sys, time
+start = time.perf_counter()
+from {module} import {cls}
+snapshot = {cls}(sys.argv[1])
+loaded = time.perf_counter() - start
+with open('/proc/self/status') as f:
+    rss = next(int(line.split()[1]) for line in f if line.startswith('VmHWM')) / 1024
+ids = sorted(snapshot.concepts())
+rng = random.Random(3)
+probes = [rng.choice(ids) for _ in range(10000)]
+start = time.perf_counter()
+for sctid in probes:
+    snapshot.parents(sctid); snapshot.children(sctid); snapshot.outgoing(sctid)
+lookup = (time.perf_counter() - start) / len(probes) * 1e6
+print(loaded, lookup, rss)
+'''
+
+
+def probe_snapshot(module, cls, path):
+    code = SNAPSHOT_PROBE.format(module=module, cls=cls)
+    output = subprocess.run([sys.executable, '-c', code, path], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return [float(value) for value in output.split()]
+
+
+def bench_snapshot(args):
+    """RF2 text loading vs opening the compiled, memory-mapped snapshot"""
+    from compiled_snapshot import compile_snapshot
+    from rf2_fixture import write_synthetic_snapshot
+
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot = write_synthetic_snapshot(folder, args.concepts)
+        output = os.path.join(folder, 'snapshot.sctbin')
+        start = time.perf_counter()
+        compile_snapshot(snapshot, output)
+        compiled = time.perf_counter() - start
+        print(f'Snapshot benchmark: {args.concepts} concepts, compiled in {compiled:.1f}s to '
+              f'{os.path.getsize(output) / 1024 / 1024:.1f} MiB')
+        for label, module, cls, path in [('RF2 text files', 'rf2_snapshot', 'Rf2Snapshot', snapshot),
+                                         ('compiled mmap', 'compiled_snapshot', 'CompiledSnapshot', output)]:
+            loaded, lookup, rss = probe_snapshot(module, cls, path)
+            print(f'  {label:15}: start {loaded * 1000:8.1f} ms, RSS after start {rss:7.1f} MiB, '
+                  f'parents+children+attributes {lookup:5.1f} us/concept')
+
+
+def walk(sctid, edges):
+    """The previous hierarchy evaluation: a set-building graph walk"""
+    seen, stack = set(), list(edges(sctid))
+    while stack:
+        node = stack.pop()
+        if node not in seen:
+            seen.add(node)
+            stack.extend(edges(node))
+    return seen
+
+
+def best_ms(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def bench_closure(args):
+    """Graph walks vs the closure index for subsumption and AND/OR/MINUS"""
+    from compiled_snapshot import compile_snapshot, CompiledSnapshot
+    from rf2_fixture import write_synthetic_snapshot
+
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot = CompiledSnapshot(compile_snapshot(write_synthetic_snapshot(folder, args.concepts),
+                                                     os.path.join(folder, 'snapshot.sctbin')))
+        closure = snapshot.closure()
+        ids = sorted(snapshot.concepts())
+        # The two broadest concepts below the root, like < 404684003 |Clinical finding|
+        def size(ordinal):
+            return sum(end - start + 1 for start, end in closure.intervals(ordinal)) - 1
+        a, b = sorted(range(1, min(closure.size, 1000)), key=size, reverse=True)[:2]
+        broad = [closure.order[a], closure.order[b]]
+        sizes = [size(a), size(b)]
+        print(f'Closure benchmark: {closure.size} concepts, {len(closure.starts)} descendant intervals, '
+              f'broad roots with {sizes[0]} and {sizes[1]} descendants')
+
+        def walk_compound():
+            left, right = walk(broad[0], snapshot.children), walk(broad[1], snapshot.children)
+            return left & right, left | right, left - right
+
+        def bits_compound():
+            left, right = closure.descendants(a), closure.descendants(b)
+            return left & right, left | right, left & ~right
+
+        print(f'  < broad root      : graph walk {best_ms(lambda: walk(broad[0], snapshot.children)):8.1f} ms, '
+              f'closure {best_ms(lambda: closure.descendants(a)):8.3f} ms (cached bitmap)')
+        closure._descendant_bits.cache_clear()
+        print(f'  < broad root cold : closure {best_ms(lambda: closure._build_descendant_bits(a)):8.3f} ms '
+              f'(bitmap fill from intervals)')
+        print(f'  AND + OR + MINUS  : graph walk {best_ms(walk_compound):8.1f} ms, '
+              f'closure {best_ms(bits_compound):8.3f} ms')
+
+        rng = random.Random(5)
+        pairs = [(rng.choice(ids), rng.choice(ids[:1000])) for _ in range(10000)]
+        start = time.perf_counter()
+        for sctid, ancestor in pairs:
+            closure.is_subsumed(sctid, ancestor)
+        subsumed = (time.perf_counter() - start) / len(pairs) * 1e6
+        start = time.perf_counter()
+        for sctid, ancestor in pairs[:20]:
+            ancestor in walk(sctid, snapshot.parents)
+        walked = (time.perf_counter() - start) / 20 * 1e6
+        print(f'  is X subsumed by Y: ancestor walk {walked:8.1f} us, closure {subsumed:8.2f} us per check')
+        snapshot.close()
+
+
+def bench_metrics(args):
+    """Cost of recording a metric on the hot path, single-threaded and from several threads"""
+    from metrics import Registry
+
+    registry = Registry()
+    counter = registry.counter('bench_total', 'Benchmark counter', ('endpoint', 'status'))
+    histogram = registry.histogram('bench_seconds', 'Benchmark histogram', ('endpoint',))
+    n = args.observations
+
+    def record(count):
+        for i in range(count):
+            counter.inc('http://tx', '200')
+            histogram.observe((i % 100) / 1000, 'http://tx')
+
+    print(f'Metrics benchmark: {n} counter increments + histogram observations')
+    start = time.perf_counter()
+    record(n)
+    single = (time.perf_counter() - start) / n * 1e9
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        start = time.perf_counter()
+        list(executor.map(record, [n // args.threads] * args.threads))
+        threaded = (time.perf_counter() - start) / (n // args.threads * args.threads) * 1e9
+    start = time.perf_counter()
+    text = registry.render()
+    scrape = (time.perf_counter() - start) * 1000
+    print(f'  1 thread          : {single:8.0f} ns per inc + observe')
+    print(f'  {args.threads} threads         : {threaded:8.0f} ns per inc + observe (wall clock)')
+    print(f'  scrape            : {scrape:8.2f} ms for {len(text.splitlines())} lines')
+
+
+SEARCH_TERMS = ('injection', 'disorder', 'finding', 'product', 'tablet', 'reference set', 'allergy',
+                'procedure', 'diabetes', 'asthma', 'medication', 'body structure')
+
+
+def summarize(latencies, errors, elapsed):
+    """Throughput and latency percentiles (ms) of one load scenario"""
+    requests_done = len(latencies)
+    return {
+        'requests': requests_done,
+        'errors': errors,
+        'error_rate': round(errors / requests_done, 4) if requests_done else 0.0,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(requests_done / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(sum(latencies) / requests_done, 3),
+            'p50': round(percentile(latencies, 50), 3),
+            'p90': round(percentile(latencies, 90), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'max': round(max(latencies), 3)
+        }
+    }
+
+
+def drive(call, requests_total, concurrency, warmup):
+    """
+    Run call(i) for i in range(requests_total) on `concurrency` threads after
+    `warmup` untimed calls; call returns True on success. Returns the summary.
+    """
+    for i in range(warmup):
+        call(-1 - i)
+    latencies = [0.0] * requests_total
+    failed = [False] * requests_total
+
+    def timed(i):
+        start = time.perf_counter()
+        try:
+            ok = call(i)
+        except Exception:
+            ok = False
+        latencies[i] = (time.perf_counter() - start) * 1000
+        failed[i] = not ok
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, range(requests_total)))
+    return summarize(latencies, sum(failed), time.perf_counter() - start)
+
+
+def load_expression(i, distinct):
+    """ECL for the i-th request: a new expression every time, or one of `distinct` in rotation"""
+    if distinct:
+        i %= distinct
+    return f'< {synthetic_code(abs(i))}'
+
+
+def start_app():
+    """Serve the app in-process on a free port; returns (base url, server)"""
+    from werkzeug.serving import make_server
+    from main import app
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}', server
+
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_load(args):
+    """
+    Drive the app routes and the fetcher against the stand-in server at a
+    fixed concurrency and report throughput and latency percentiles per
+    scenario; --output saves them as JSON for `compare`.
+    """
+    canned = None
+    if args.canned:
+        with open(args.canned) as f:
+            canned = json.load(f)
+    # Injected upstream errors are counted below rather than logged to the console one by one
+    logging.getLogger('fetcher').addHandler(logging.NullHandler())
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - {'test_ecl', 'search', 'index', 'fetcher'}
+    if unknown:
+        sys.exit(f'Unknown scenarios: {", ".join(sorted(unknown))}')
+
+    fetcher.configure_transport(pool_size=max(args.concurrency, 1))
+    with FakeTerminologyServer(total=args.total, latency=args.latency, jitter=args.jitter,
+                               error_rate=args.error_rate, canned=canned, seed=args.seed) as tx:
+        app_server = None
+        app_url = args.app_url
+        if app_url is None and set(scenarios) - {'fetcher'}:
+            app_url, app_server = start_app()
+        local = threading.local()
+
+        def session():
+            if not hasattr(local, 'session'):
+                local.session = requests.Session()
+            return local.session
+
+        rng = random.Random(args.seed)
+        queries = [rng.choice(SEARCH_TERMS) for _ in range(args.requests + args.warmup)]
+
+        def test_ecl(i):
+            body = {'expression': load_expression(i, args.distinct), 'endpoint': tx.url, 'count': args.count}
+            response = session().post(f'{app_url}/test_ecl', json=body, timeout=60)
+            return response.status_code == 200 and response.json().get('success', False)
+
+        def search(i):
+            response = session().get(f'{app_url}/search_ecl', params={'q': queries[i]}, timeout=60)
+            return response.status_code == 200
+
+        def index(i):
+            response = session().get(f'{app_url}/', timeout=60)
+            return response.status_code == 200
+
+        def fetch(i):
+            result = fetcher.expand_valueset(tx.url, load_expression(i, args.distinct), args.count)
+            return not result.get('error')
+
+        calls = {'test_ecl': test_ecl, 'search': search, 'index': index, 'fetcher': fetch}
+        print(f'Load benchmark: {args.requests} requests per scenario, concurrency {args.concurrency}, '
+              f'{args.total} concepts, latency {args.latency * 1000:.0f} ms (+{args.jitter * 1000:.0f} ms jitter), '
+              f'error rate {args.error_rate:.1%}')
+        results = {}
+        for name in scenarios:
+            results[name] = summary = drive(calls[name], args.requests, args.concurrency, args.warmup)
+            latency = summary['latency_ms']
+            print(f'  {name:9}: {summary["throughput_rps"]:8.1f} req/s, p50 {latency["p50"]:7.2f} ms, '
+                  f'p95 {latency["p95"]:7.2f} ms, p99 {latency["p99"]:7.2f} ms, errors {summary["errors"]}')
+        if app_server is not None:
+            app_server.shutdown()
+    fetcher.close_sessions()
+
+    report = {
+        'benchmark': 'load',
+        'commit': git_commit(),
+        'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('func', 'output', 'benchmark')},
+        'scenarios': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'  results saved to {args.output}')
+    return report
+
+
+def compare_reports(baseline, current, threshold):
+    """
+    Per-scenario changes between two load reports. A scenario regresses when
+    throughput drops or p95 latency rises by more than `threshold` percent.
+    """
+    rows = []
+    for name, now in current['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            continue
+
+        def change(old, new):
+            return round((new - old) / old * 100, 1) if old else 0.0
+
+        row = {
+            'scenario': name,
+            'throughput_rps': change(before['throughput_rps'], now['throughput_rps']),
+            'p50': change(before['latency_ms']['p50'], now['latency_ms']['p50']),
+            'p95': change(before['latency_ms']['p95'], now['latency_ms']['p95']),
+            'p99': change(before['latency_ms']['p99'], now['latency_ms']['p99'])
+        }
+        row['regression'] = row['throughput_rps'] < -threshold or row['p95'] > threshold
+        rows.append(row)
+    return rows
+
+
+def bench_compare(args):
+    """Compare two saved load reports; exits non-zero on a regression"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    print(f'Comparing {baseline.get("commit")} -> {current.get("commit")} (threshold {args.threshold:.0f}%)')
+    rows = compare_reports(baseline, current, args.threshold)
+    for row in rows:
+        flag = '  REGRESSION' if row['regression'] else ''
+        print(f'  {row["scenario"]:9}: throughput {row["throughput_rps"]:+6.1f}%, p50 {row["p50"]:+6.1f}%, '
+              f'p95 {row["p95"]:+6.1f}%, p99 {row["p99"]:+6.1f}%{flag}')
+    if any(row['regression'] for row in rows):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ECL Expression Tester benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    transport = subparsers.add_parser('transport', help='curl subprocess vs pooled HTTP client')
+    transport.add_argument('--requests', type=int, default=200)
+    transport.add_argument('--concurrency', type=int, default=4)
+    transport.add_argument('--total', type=int, default=1000)
+    transport.set_defaults(func=bench_transport)
+
+    search = subparsers.add_parser('search', help='Inverted-index search latency on a synthetic library')
+    search.add_argument('--entries', type=int, default=100000)
+    search.add_argument('--queries', type=int, default=2000)
+    search.set_defaults(func=bench_search)
+
+    decode = subparsers.add_parser('decode', help='Per-concept decode cost before and after')
+    decode.add_argument('--concepts', type=int, default=1000)
+    decode.set_defaults(func=bench_decode)
+
+    parse_bench = subparsers.add_parser('parse', help='ECL parser latency over the library')
+    parse_bench.add_argument('--library', default='ecl_library')
+    parse_bench.add_argument('--repeat', type=int, default=2000)
+    parse_bench.set_defaults(func=bench_parse)
+
+    snapshot = subparsers.add_parser('snapshot', help='RF2 text load vs compiled mmap snapshot')
+    snapshot.add_argument('--concepts', type=int, default=300000)
+    snapshot.set_defaults(func=bench_snapshot)
+
+    closure = subparsers.add_parser('closure', help='Graph walks vs the transitive-closure index')
+    closure.add_argument('--concepts', type=int, default=300000)
+    closure.set_defaults(func=bench_closure)
+
+    metrics_bench = subparsers.add_parser('metrics', help='Hot-path cost of recording metrics')
+    metrics_bench.add_argument('--observations', type=int, default=200000)
+    metrics_bench.add_argument('--threads', type=int, default=4)
+    metrics_bench.set_defaults(func=bench_metrics)
+
+    load = subparsers.add_parser('load', help='Throughput and latency percentiles of the app routes and fetcher')
+    load.add_argument('--scenarios', default='test_ecl,search,index,fetcher',
+                      help='Comma-separated: test_ecl, search, index, fetcher')
+    load.add_argument('--requests', type=int, default=500, help='Timed requests per scenario')
+    load.add_argument('--concurrency', type=int, default=8)
+    load.add_argument('--warmup', type=int, default=20, help='Untimed requests before each scenario')
+    load.add_argument('--count', type=int, default=25, help='Concepts requested per expansion')
+    load.add_argument('--distinct', type=int, default=0,
+                      help='Distinct expressions to rotate through (0: a new one per request, so nothing is cached)')
+    load.add_argument('--total', type=int, default=1000, help='Concepts in every synthetic expansion')
+    load.add_argument('--latency', type=float, default=0.02, help='Stand-in server latency in seconds')
+    load.add_argument('--jitter', type=float, default=0.0, help='Random extra latency of up to this many seconds')
+    load.add_argument('--error-rate', type=float, default=0.0, help='Fraction of upstream calls answered with a 503')
+    load.add_argument('--canned', help='JSON file mapping ECL expressions to ValueSet resources')
+    load.add_argument('--seed', type=int, default=42)
+    load.add_argument('--app-url', help='Drive an already running app instead of serving it in-process')
+    load.add_argument('--output', help='Save the results as JSON')
+    load.set_defaults(func=bench_load)
+
+    compare = subparsers.add_parser('compare', help='Compare two saved load results')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    compare.add_argument('--threshold', type=float, default=10.0,
+                         help='Percent throughput drop or p95 rise reported as a regression')
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+"""
+Background warming of the expansion cache from the ECL library.
+
+The library is known ahead of time, so after startup a warmer walks the
+catalog and expands every expression into the cache before anyone clicks it.
+Warming is low priority: it runs on a few worker threads and every expansion
+first waits until no interactive request is in flight (InteractiveGate), so
+user traffic never queues behind it. Entries already in the cache (e.g.
+preloaded from the on-disk store) are left alone on the first pass. Later
+passes refresh every entry upstream, either on a schedule or as soon as a
+cheap probe sees the terminology server report a different SNOMED CT version.
+"""
+
+import contextlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import ecl_parser
+
+logger = logging.getLogger(__name__)
+
+
+class InteractiveGate:
+    """Counts interactive requests in flight; background work waits until there are none"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._active = 0
+
+    @contextlib.contextmanager
+    def interactive(self):
+        self.enter()
+        try:
+            yield
+        finally:
+            self.exit()
+
+    def enter(self):
+        with self._condition:
+            self._active += 1
+
+    def exit(self):
+        with self._condition:
+            self._active -= 1
+            if self._active == 0:
+                self._condition.notify_all()
+
+    @property
+    def active(self):
+        return self._active
+
+    def wait_idle(self, timeout=None):
+        """Block until no interactive request is in flight; False if timeout passed first"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._active == 0, timeout)
+
+
+class CacheWarmer:
+    """
+    Expands every library expression into the cache in the background.
+
+    `entries()` returns the library entries ({'expression', 'filename', ...}),
+    `expand(endpoint, ecl, count)` is the cached expansion used for the first
+    pass and `refresh(endpoint, ecl, count)` re-expands upstream and replaces
+    the cached result. `probe(endpoint)` returns the server's current SNOMED
+    CT version (or None); it is called every `check_interval` seconds and a
+    change starts a refresh pass straight away. Otherwise a refresh pass runs
+    every `interval` seconds.
+    """
+
+    def __init__(self, endpoint, entries, expand, refresh, probe=None, gate=None, count=25, concurrency=2,
+                 interval=3000.0, check_interval=300.0, clock=time.time):
+        self.endpoint = endpoint
+        self._entries = entries
+        self._expand = expand
+        self._refresh = refresh
+        self._probe = probe
+        self.gate = gate or InteractiveGate()
+        self.count = count
+        self.concurrency = concurrency
+        self.interval = interval
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._status = {
+            'state': 'idle',
+            'passes': 0,
+            'reason': None,
+            'total': 0,
+            'done': 0,
+            'errors': 0,
+            'started_at': None,
+            'finished_at': None,
+            'version': None,
+            'last_error': None
+        }
+
+    def start(self):
+        """Start the background thread; the first pass begins straight away"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='cache-warmer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def trigger(self):
+        """Ask for a refresh pass now instead of at the next scheduled time"""
+        self._wake.set()
+
+    def _run(self):
+        reason = 'startup'
+        while not self._stop.is_set():
+            try:
+                self.warm(refresh=reason != 'startup', reason=reason)
+            except Exception as e:
+                logger.error(f'Cache warming failed: {e}')
+                self._update(state='idle', last_error=str(e))
+            reason = self._wait_for_next_pass()
+
+    def _wait_for_next_pass(self):
+        """Sleep until the schedule, a version change or trigger() calls for another pass"""
+        due = self._clock() + self.interval
+        while not self._stop.is_set():
+            timeout = min(self.check_interval, max(0.0, due - self._clock()))
+            if self._wake.wait(timeout):
+                self._wake.clear()
+                return 'requested'
+            if self._clock() >= due:
+                return 'schedule'
+            if self._probe is not None:
+                try:
+                    version = self._probe(self.endpoint)
+                except Exception as e:
+                    logger.warning(f'Version probe of {self.endpoint} failed: {e}')
+                    continue
+                known = self.status()['version']
+                if version and known and version != known:
+                    logger.info(f'{self.endpoint} now reports {version} (was {known}); re-warming')
+                    return 'version'
+        return None
+
+    def warm(self, refresh=False, reason='manual'):
+        """
+        One pass over the library: every valid expression is expanded (or
+        refreshed) on `concurrency` threads, each call waiting for interactive
+        requests to finish first. Returns the final status.
+        """
+        items = [entry for entry in self._entries() if ecl_parser.validate(entry['expression']) is None]
+        self._update(state='warming', reason=reason, total=len(items), done=0, errors=0,
+                     started_at=self._clock(), finished_at=None)
+        logger.info(f'Warming {len(items)} library expressions on {self.endpoint} ({reason})')
+        call = self._refresh if refresh else self._expand
+
+        def warm_one(entry):
+            if self._stop.is_set():
+                return
+            self.gate.wait_idle()
+            try:
+                result = call(self.endpoint, entry['expression'], self.count)
+            except Exception as e:
+                result = {'error': str(e)}
+            with self._lock:
+                self._status['done'] += 1
+                if result.get('error'):
+                    self._status['errors'] += 1
+                    self._status['last_error'] = f'{entry.get("filename")}: {result["error"]}'
+                elif result.get('version'):
+                    self._status['version'] = result['version']
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='warm') as executor:
+            list(executor.map(warm_one, items))
+
+        with self._lock:
+            self._status['state'] = 'idle'
+            self._status['passes'] += 1
+            self._status['finished_at'] = self._clock()
+            status = dict(self._status)
+        logger.info(f'Warmed {status["done"]} expressions with {status["errors"]} errors')
+        return status
+
+    def _update(self, **values):
+        with self._lock:
+            self._status.update(values)
+
+    def status(self):
+        """Progress of the current or last pass"""
+        with self._lock:
+            status = dict(self._status)
+        status['endpoint'] = self.endpoint
+        status['running'] = self._thread is not None
+        status['interactive_requests'] = self.gate.active
+        return status
@@ -0,0 +1,273 @@
+"""
+Transitive-closure index over the SNOMED CT is-a hierarchy.
+
+Concepts are numbered densely in depth-first preorder, which makes every
+concept's descendants (including itself) a short list of ordinal intervals:
+the spanning-tree subtree is one interval and each extra parent link merges
+in the child's intervals. Descendant sets are then materialised as bitmaps
+over the ordinals - Python ints, whose &, | and & ~ run word-at-a-time in C -
+so AND/OR/MINUS over large sets cost a few microseconds, and `is X subsumed
+by Y` is a binary search in Y's interval list.
+
+The index is built from any snapshot offering concepts()/parents()/children()
+and can be stored in and reloaded from flat arrays, which is how compiled
+snapshots carry it precomputed.
+"""
+
+import bisect
+import functools
+import re
+import time
+from array import array
+
+_NONZERO = re.compile(rb'[^\x00]+')
+_BYTE_BITS = [tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256)]
+ARRAY_NAMES = ('order', 'rank', 'offsets', 'starts', 'ends', 'parent_offsets', 'parent_index')
+
+
+def bits_from_ordinals(ordinals, size):
+    """Bitmap with the given ordinals set"""
+    buffer = bytearray((size + 7) // 8)
+    for ordinal in ordinals:
+        buffer[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+def iter_ordinals(bits):
+    """Set ordinals of a bitmap in increasing order"""
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, 'little')
+    for run in _NONZERO.finditer(data):
+        base = run.start() * 8
+        for i, byte in enumerate(run.group()):
+            for bit in _BYTE_BITS[byte]:
+                yield base + i * 8 + bit
+
+
+def _merge(intervals):
+    intervals.sort()
+    merged = [intervals[0]]
+    for start, end in intervals[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            if end > last_end:
+                merged[-1] = (last_start, end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ClosureIndex:
+    """
+    Preorder numbering, descendant intervals and parent links of the active
+    hierarchy. `order` maps ordinal -> SCTID, `rank` maps the position of an
+    SCTID in sorted order -> ordinal (with `sorted_ids` the sorted SCTIDs).
+    """
+
+    def __init__(self, sorted_ids, order, rank, offsets, starts, ends, parent_offsets, parent_index):
+        self.sorted_ids = sorted_ids
+        self.order = order
+        self.rank = rank
+        self.offsets = offsets
+        self.starts = starts
+        self.ends = ends
+        self.parent_offsets = parent_offsets
+        self.parent_index = parent_index
+        self.size = len(order)
+        self.all_bits = (1 << self.size) - 1
+        self._descendant_bits = functools.lru_cache(maxsize=512)(self._build_descendant_bits)
+        self._roots = None
+        self._leaves = None
+
+    @classmethod
+    def build(cls, snapshot):
+        """Compute the index from a snapshot's active concepts and is-a links"""
+        start = time.perf_counter()
+        concepts = snapshot.concepts()
+        sorted_ids = array('Q', sorted(concepts))
+        children = {sctid: sorted(c for c in snapshot.children(sctid) if c in concepts) for sctid in sorted_ids}
+        roots = [sctid for sctid in sorted_ids if not any(p in concepts for p in snapshot.parents(sctid))]
+
+        # One depth-first pass gives preorder numbers, spanning-subtree sizes and
+        # a postorder in which every child precedes all of its parents
+        preorder = {}
+        subtree_end = {}
+        postorder = []
+        for root in roots:
+            preorder[root] = len(preorder)
+            stack = [(root, iter(children[root]))]
+            while stack:
+                node, pending = stack[-1]
+                for child in pending:
+                    if child not in preorder:
+                        preorder[child] = len(preorder)
+                        stack.append((child, iter(children[child])))
+                        break
+                else:
+                    stack.pop()
+                    subtree_end[node] = len(preorder) - 1
+                    postorder.append(node)
+
+        intervals = {}
+        for node in postorder:
+            own = [(preorder[node], subtree_end[node])]
+            for child in children[node]:
+                child_intervals = intervals[child]
+                # Spanning-tree children already lie inside the node's own interval
+                if not (own[0][0] <= child_intervals[0][0] and child_intervals[-1][1] <= own[0][1]):
+                    own.extend(child_intervals)
+            intervals[node] = _merge(own) if len(own) > 1 else own
+
+        order = array('Q', bytes(8 * len(preorder)))
+        for sctid, ordinal in preorder.items():
+            order[ordinal] = sctid
+        rank = array('I', (preorder[sctid] for sctid in sorted_ids))
+        offsets, starts, ends = array('I', [0]), array('I'), array('I')
+        parent_offsets, parent_index = array('I', [0]), array('I')
+        for sctid in order:
+            for interval_start, interval_end in intervals[sctid]:
+                starts.append(interval_start)
+                ends.append(interval_end)
+            offsets.append(len(starts))
+            parent_index.extend(sorted(preorder[p] for p in snapshot.parents(sctid) if p in concepts))
+            parent_offsets.append(len(parent_index))
+        index = cls(sorted_ids, order, rank, offsets, starts, ends, parent_offsets, parent_index)
+        index.build_seconds = time.perf_counter() - start
+        return index
+
+    def arrays(self):
+        """The flat arrays that make up the index, for storing it"""
+        return {name: getattr(self, name) for name in ARRAY_NAMES}
+
+    # -- lookups ------------------------------------------------------------
+
+    def ordinal(self, sctid):
+        """Dense ordinal of an active concept, or None"""
+        i = bisect.bisect_left(self.sorted_ids, sctid)
+        if i < self.size and self.sorted_ids[i] == sctid:
+            return self.rank[i]
+        return None
+
+    def intervals(self, ordinal):
+        start, end = self.offsets[ordinal], self.offsets[ordinal + 1]
+        return list(zip(self.starts[start:end], self.ends[start:end]))
+
+    def is_subsumed(self, sctid, ancestor):
+        """True if sctid is ancestor or one of its descendants"""
+        ordinal, ancestor_ordinal = self.ordinal(sctid), self.ordinal(ancestor)
+        if ordinal is None or ancestor_ordinal is None:
+            return False
+        low, high = self.offsets[ancestor_ordinal], self.offsets[ancestor_ordinal + 1]
+        i = bisect.bisect_right(self.starts, ordinal, low, high) - 1
+        return i >= low and ordinal <= self.ends[i]
+
+    # -- bitmaps ------------------------------------------------------------
+
+    def bits(self, sctids):
+        """Bitmap of the active concepts among sctids"""
+        ordinal = self.ordinal
+        return bits_from_ordinals((o for o in map(ordinal, sctids) if o is not None), self.size)
+
+    def sctids(self, bits, offset=0, count=None):
+        """SCTIDs in a bitmap, in hierarchy (preorder) order, optionally paged"""
+        order = self.order
+        result = []
+        for i, ordinal in enumerate(iter_ordinals(bits)):
+            if i < offset:
+                continue
+            if count is not None and len(result) >= count:
+                break
+            result.append(order[ordinal])
+        return result
+
+    def _interval_bits(self, ranges):
+        """Bitmap with every ordinal of the given (first, last) ranges set"""
+        ranges = list(ranges)
+        if len(ranges) <= 16:
+            bits = 0
+            for first, last in ranges:
+                bits |= (1 << (last + 1)) - (1 << first)
+            return bits
+        buffer = bytearray((self.size + 7) // 8)
+        for first, last in ranges:
+            first_byte, last_byte = first >> 3, last >> 3
+            if first_byte == last_byte:
+                buffer[first_byte] |= (0xFF << (first & 7)) & (0xFF >> (7 - (last & 7)))
+            else:
+                buffer[first_byte] |= (0xFF << (first & 7)) & 0xFF
+                buffer[first_byte + 1:last_byte] = b'\xff' * (last_byte - first_byte - 1)
+                buffer[last_byte] |= 0xFF >> (7 - (last & 7))
+        return int.from_bytes(buffer, 'little')
+
+    def _build_descendant_bits(self, ordinal):
+        start, end = self.offsets[ordinal], self.offsets[ordinal + 1]
+        return self._interval_bits(zip(self.starts[start:end], self.ends[start:end]))
+
+    def descendants(self, ordinal, include_self=False):
+        """Bitmap of the descendants of a concept"""
+        bits = self._descendant_bits(ordinal)
+        return bits if include_self else bits & ~(1 << ordinal)
+
+    def descendants_of(self, ordinals, include_self=False):
+        """Bitmap of the descendants of any of the given concepts"""
+        ordinals = list(ordinals)
+        if len(ordinals) <= 64:
+            bits = 0
+            for ordinal in ordinals:
+                bits |= self._descendant_bits(ordinal)
+        else:
+            # One fill over all the intervals beats OR-ing many full-width bitmaps
+            bits = self._interval_bits(_merge([(self.starts[i], self.ends[i]) for ordinal in ordinals
+                                               for i in range(self.offsets[ordinal], self.offsets[ordinal + 1])]))
+        if include_self:
+            return bits
+        # A focus concept stays in when it descends from another focus concept
+        return bits & ~bits_from_ordinals(ordinals, self.size) | self._nested(ordinals)
+
+    def _nested(self, ordinals):
+        focus = set(ordinals)
+        return bits_from_ordinals((o for o in ordinals if not focus.isdisjoint(self.ancestor_ordinals(o))), self.size)
+
+    def parent_ordinals(self, ordinal):
+        return self.parent_index[self.parent_offsets[ordinal]:self.parent_offsets[ordinal + 1]]
+
+    def ancestor_ordinals(self, ordinal):
+        seen = set()
+        stack = list(self.parent_ordinals(ordinal))
+        while stack:
+            parent = stack.pop()
+            if parent not in seen:
+                seen.add(parent)
+                stack.extend(self.parent_ordinals(parent))
+        return seen
+
+    def ancestors(self, ordinal, include_self=False):
+        """Bitmap of the ancestors of a concept"""
+        return self.ancestors_of((ordinal,), include_self)
+
+    def ancestors_of(self, ordinals, include_self=False):
+        """Bitmap of the ancestors of any of the given concepts, found in one walk up the parent links"""
+        ordinals = list(ordinals)
+        seen = set()
+        stack = [parent for ordinal in ordinals for parent in self.parent_ordinals(ordinal)]
+        while stack:
+            parent = stack.pop()
+            if parent not in seen:
+                seen.add(parent)
+                stack.extend(self.parent_ordinals(parent))
+        if include_self:
+            seen.update(ordinals)
+        return bits_from_ordinals(seen, self.size)
+
+    def roots(self):
+        if self._roots is None:
+            self._roots = bits_from_ordinals(
+                (o for o in range(self.size) if self.parent_offsets[o] == self.parent_offsets[o + 1]), self.size)
+        return self._roots
+
+    def leaves(self):
+        if self._leaves is None:
+            # A concept is a leaf when its descendant intervals are just itself
+            self._leaves = bits_from_ordinals(
+                (o for o in range(self.size) if self.offsets[o + 1] - self.offsets[o] == 1
+                 and self.starts[self.offsets[o]] == self.ends[self.offsets[o]]), self.size)
+        return self._leaves
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+Compact binary form of an RF2 snapshot, opened with mmap.
+
+compile_snapshot() turns a release into one columnar file: a sorted array of
+active concept ids, CSR adjacency (offset array + target array) for is-a
+parents/children and for attribute relationships in both directions,
+reference set membership arrays, an interned, UTF-8 description string
+table and the precomputed closure_index arrays. CompiledSnapshot maps the
+file read-only and reads the arrays in place through typed memoryviews, so
+opening it costs a header parse, lookups are a binary search plus a slice,
+and every worker process shares the same page cache instead of holding its
+own copy of the terminology.
+
+Usage:
+    python compiled_snapshot.py <rf2 snapshot dir> <output.sctbin>
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+
+from closure_index import ClosureIndex, ARRAY_NAMES as CLOSURE_ARRAYS
+from rf2_snapshot import Rf2Snapshot, parse_concrete_value, FSN, SYNONYM, DEFINITION
+
+MAGIC = b'SCTBIN\x00\x01'
+FORMAT_VERSION = 2
+NO_STRING = 0xFFFFFFFF
+FULLY_DEFINED = 900000000000073002
+PRIMITIVE = 900000000000074008
+DESCRIPTION_TYPES = [FSN, SYNONYM, DEFINITION]
+
+
+def _align(n):
+    return (n + 7) & ~7
+
+
+class _Strings:
+    """Interned string table"""
+
+    def __init__(self):
+        self.index = {}
+        self.offsets = array('I', [0])
+        self.data = bytearray()
+
+    def add(self, text):
+        i = self.index.get(text)
+        if i is None:
+            i = self.index[text] = len(self.offsets) - 1
+            self.data += text.encode('utf-8')
+            self.offsets.append(len(self.data))
+        return i
+
+
+def _csr(ids, neighbours, *columns):
+    """Offset array plus one array per column for the per-concept neighbour lists"""
+    offsets = array('I', [0])
+    arrays = [array(typecode) for typecode, _ in columns]
+    for sctid in ids:
+        items = neighbours(sctid)
+        for item in items:
+            for target, (_, convert) in zip(arrays, columns):
+                target.append(convert(item))
+        offsets.append(len(arrays[0]))
+    return [offsets] + arrays
+
+
+def compile_snapshot(source, output):
+    """
+    Compile an RF2 snapshot directory (or a loaded Rf2Snapshot) into `output`.
+    The file is written to a temporary name and renamed into place.
+    """
+    snapshot = source if isinstance(source, Rf2Snapshot) else Rf2Snapshot(source)
+    ids = array('Q', sorted(snapshot.concepts()))
+    ordinal = {sctid: i for i, sctid in enumerate(ids)}
+    strings = _Strings()
+
+    modules = sorted({snapshot.module(sctid) for sctid in ids})
+    module_index = {module: i for i, module in enumerate(modules)}
+    languages = sorted({language for sctid in ids for _, language, _ in snapshot.descriptions(sctid)})
+    language_index = {language: i for i, language in enumerate(languages)}
+    types = DESCRIPTION_TYPES + sorted({t for sctid in ids for t, _, _ in snapshot.descriptions(sctid)}
+                                       - set(DESCRIPTION_TYPES))
+    type_index = {t: i for i, t in enumerate(types)}
+
+    sections = {
+        'ids': ids,
+        'module': array('H', (module_index[snapshot.module(sctid)] for sctid in ids)),
+        'defined': array('B', (snapshot.definition_status(sctid) == FULLY_DEFINED for sctid in ids)),
+        'display': array('I', (NO_STRING if snapshot.display(sctid) is None else strings.add(snapshot.display(sctid))
+                               for sctid in ids)),
+    }
+    for name, lookup in (('parent', snapshot.parents), ('child', snapshot.children)):
+        offsets, targets = _csr(ids, lambda sctid: sorted(ordinal[p] for p in lookup(sctid) if p in ordinal),
+                                ('I', int))
+        sections[f'{name}_offsets'], sections[f'{name}_index'] = offsets, targets
+    for name, lookup in (('out', snapshot.outgoing), ('in', snapshot.incoming)):
+        offsets, groups, type_ids, others = _csr(ids, lambda sctid: sorted(lookup(sctid)),
+                                                 ('H', lambda r: r[0]), ('Q', lambda r: r[1]), ('Q', lambda r: r[2]))
+        sections.update({f'{name}_offsets': offsets, f'{name}_group': groups, f'{name}_type': type_ids,
+                         f'{name}_other': others})
+
+    def concrete_text(value):
+        if isinstance(value, bool):
+            return 'true' if value else 'false'
+        return f'#{value}' if isinstance(value, (int, float)) else f'"{value}"'
+
+    offsets, groups, type_ids, values = _csr(
+        ids, lambda sctid: sorted(snapshot.concrete(sctid), key=lambda c: (c[0], c[1])),
+        ('H', lambda c: c[0]), ('Q', lambda c: c[1]), ('I', lambda c: strings.add(concrete_text(c[2]))))
+    sections.update({'concrete_offsets': offsets, 'concrete_group': groups, 'concrete_type': type_ids,
+                     'concrete_value': values})
+
+    refset_ids = array('Q', sorted(snapshot.refsets()))
+    refset_offsets = array('I', [0])
+    refset_members = array('Q')
+    for refset in refset_ids:
+        refset_members.extend(sorted(snapshot.members(refset)))
+        refset_offsets.append(len(refset_members))
+    sections.update({'refset_ids': refset_ids, 'refset_offsets': refset_offsets, 'refset_members': refset_members})
+
+    offsets, type_codes, language_codes, terms = _csr(
+        ids, lambda sctid: snapshot.descriptions(sctid),
+        ('B', lambda d: type_index[d[0]]), ('B', lambda d: language_index[d[1]]), ('I', lambda d: strings.add(d[2])))
+    sections.update({'desc_offsets': offsets, 'desc_type': type_codes, 'desc_language': language_codes,
+                     'desc_term': terms})
+    closure = snapshot.closure()
+    sections.update({f'closure_{name}': values for name, values in closure.arrays().items()})
+    sections['string_offsets'] = strings.offsets
+    sections['strings'] = array('B', bytes(strings.data))
+
+    layout = {}
+    position = 0
+    for name, values in sections.items():
+        layout[name] = [position, values.typecode, len(values)]
+        position = _align(position + len(values) * values.itemsize)
+    header = json.dumps({
+        'format': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'itemsizes': {code: array(code).itemsize for code in 'BHIQ'},
+        'version': snapshot.version,
+        'modules': modules,
+        'languages': languages,
+        'description_types': types,
+        'sections': layout,
+    }).encode('utf-8')
+
+    temporary = f'{output}.tmp{os.getpid()}'
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header)) + header)
+        data_start = _align(f.tell())
+        f.write(b'\0' * (data_start - f.tell()))
+        for name, values in sections.items():
+            f.seek(data_start + layout[name][0])
+            values.tofile(f)
+        f.write(b'\0' * (_align(f.tell()) - f.tell()))
+    os.replace(temporary, output)
+    return output
+
+
+class CompiledSnapshot:
+    """
+    Read-only view of a compiled snapshot with the same lookup methods as
+    Rf2Snapshot. Arrays are read straight from the mapped file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        if bytes(buffer[:len(MAGIC)]) != MAGIC:
+            buffer.release()
+            self._mmap.close()
+            raise ValueError(f'{path} is not a compiled SNOMED CT snapshot')
+        (header_length,) = struct.unpack_from('<I', buffer, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(bytes(buffer[header_start:header_start + header_length]))
+        native_sizes = {code: array(code).itemsize for code in 'BHIQ'}
+        if (header['format'] != FORMAT_VERSION or header['byteorder'] != sys.byteorder
+                or header['itemsizes'] != native_sizes):
+            buffer.release()
+            self._mmap.close()
+            raise ValueError(f'{path} was compiled for a different format or platform; recompile it')
+
+        self.version = header['version']
+        self._modules = header['modules']
+        self._languages = header['languages']
+        self._types = header['description_types']
+        self._buffer = buffer
+        self._views = []
+        data_start = _align(header_start + header_length)
+        for name, (offset, typecode, count) in header['sections'].items():
+            start = data_start + offset
+            view = buffer[start:start + count * native_sizes[typecode]].cast(typecode)
+            self._views.append(view)
+            setattr(self, '_' + name, view)
+        self._count = len(self._ids)
+        self._concept_set = None
+        self._closure = ClosureIndex(self._ids, *(getattr(self, f'_closure_{name}') for name in CLOSURE_ARRAYS))
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._buffer.release()
+        self._mmap.close()
+
+    def __len__(self):
+        return self._count
+
+    def _ordinal(self, sctid):
+        i = bisect.bisect_left(self._ids, sctid)
+        if i < self._count and self._ids[i] == sctid:
+            return i
+        return None
+
+    def _string(self, index):
+        return bytes(self._strings[self._string_offsets[index]:self._string_offsets[index + 1]]).decode('utf-8')
+
+    def concepts(self):
+        """Set of active concept ids, built on first use"""
+        if self._concept_set is None:
+            self._concept_set = set(self._ids)
+        return self._concept_set
+
+    def is_active(self, sctid):
+        return self._ordinal(sctid) is not None
+
+    def closure(self):
+        """Transitive-closure index, read from the file"""
+        return self._closure
+
+    def _hierarchy(self, sctid, offsets, index):
+        i = self._ordinal(sctid)
+        if i is None:
+            return ()
+        ids = self._ids
+        return [ids[o] for o in index[offsets[i]:offsets[i + 1]]]
+
+    def parents(self, sctid):
+        return self._hierarchy(sctid, self._parent_offsets, self._parent_index)
+
+    def children(self, sctid):
+        return self._hierarchy(sctid, self._child_offsets, self._child_index)
+
+    def _relationships(self, sctid, prefix):
+        i = self._ordinal(sctid)
+        if i is None:
+            return ()
+        offsets = getattr(self, f'_{prefix}_offsets')
+        start, end = offsets[i], offsets[i + 1]
+        return list(zip(getattr(self, f'_{prefix}_group')[start:end], getattr(self, f'_{prefix}_type')[start:end],
+                        getattr(self, f'_{prefix}_other')[start:end]))
+
+    def outgoing(self, sctid):
+        return self._relationships(sctid, 'out')
+
+    def incoming(self, sctid):
+        return self._relationships(sctid, 'in')
+
+    def concrete(self, sctid):
+        i = self._ordinal(sctid)
+        if i is None:
+            return ()
+        start, end = self._concrete_offsets[i], self._concrete_offsets[i + 1]
+        return [(self._concrete_group[j], self._concrete_type[j], parse_concrete_value(self._string(self._concrete_value[j])))
+                for j in range(start, end)]
+
+    def refsets(self):
+        return list(self._refset_ids)
+
+    def members(self, refset):
+        i = bisect.bisect_left(self._refset_ids, refset)
+        if i == len(self._refset_ids) or self._refset_ids[i] != refset:
+            return ()
+        return self._refset_members[self._refset_offsets[i]:self._refset_offsets[i + 1]].tolist()
+
+    def descriptions(self, sctid):
+        i = self._ordinal(sctid)
+        if i is None:
+            return ()
+        start, end = self._desc_offsets[i], self._desc_offsets[i + 1]
+        return [(self._types[self._desc_type[j]], self._languages[self._desc_language[j]],
+                 self._string(self._desc_term[j])) for j in range(start, end)]
+
+    def display(self, sctid):
+        i = self._ordinal(sctid)
+        if i is None or self._display[i] == NO_STRING:
+            return None
+        return self._string(self._display[i])
+
+    def module(self, sctid):
+        i = self._ordinal(sctid)
+        return None if i is None else self._modules[self._module[i]]
+
+    def definition_status(self, sctid):
+        i = self._ordinal(sctid)
+        if i is None:
+            return None
+        return FULLY_DEFINED if self._defined[i] else PRIMITIVE
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    start = time.perf_counter()
+    compile_snapshot(sys.argv[1], sys.argv[2])
+    compiled = time.perf_counter() - start
+    start = time.perf_counter()
+    snapshot = CompiledSnapshot(sys.argv[2])
+    print(f'Compiled {len(snapshot)} concepts into {sys.argv[2]} '
+          f'({os.path.getsize(sys.argv[2]) / 1024 / 1024:.1f} MiB) in {compiled:.1f}s; '
+          f'opens in {(time.perf_counter() - start) * 1000:.1f} ms')
@@ -0,0 +1,234 @@
+"""
+Canonical form of ECL expressions.
+
+Expressions that differ only cosmetically - term labels, whitespace and line
+breaks, long vs symbolic operators, AND/and/',' spellings, redundant
+parentheses, operand order of AND/OR - produce the same canonical text and
+therefore the same cache key, so they share one cached expansion and one
+upstream query.
+
+Usage:
+    python ecl_canonical.py [ecl_library]    # report library expressions that collapse
+"""
+
+import functools
+import hashlib
+import re
+import sys
+
+import ecl_parser
+from ecl_parser import (AlternateIdentifier, AttributeGroup, Compound, ConceptReference, ConcreteValue, Dotted,
+                        EclSyntaxError, HistorySupplement, Refined, RefinementCompound, SubExpression, Wildcard)
+
+SYMBOLS = {name: symbol for symbol, name in ecl_parser.OPERATORS.items()}
+_WHITESPACE = re.compile(r'\s+')
+_SIMPLE_ALTID = re.compile(r'[^\s()\[\]{},|:="]+')
+
+
+def _unwrap(node):
+    """Strip redundant parentheses: (expr) with no operator, member-of or filters"""
+    while (isinstance(node, SubExpression) and node.operator is None and not node.member_of
+           and not node.filters and not isinstance(node.focus, (ConceptReference, Wildcard, AlternateIdentifier))):
+        node = node.focus
+    return node
+
+
+def _flatten(node, operator, node_type):
+    """Operands of nested same-operator AND/OR compounds, which are associative"""
+    node = _unwrap(node)
+    if isinstance(node, node_type) and node.operator == operator:
+        for operand in node.operands:
+            yield from _flatten(operand, operator, node_type)
+    else:
+        yield node
+
+
+def _commutative(operator, rendered):
+    # AND and OR are commutative and idempotent: sort and drop duplicates
+    operands = sorted(set(rendered))
+    return f' {operator.upper()} '.join(operands)
+
+
+def _expression(node):
+    node = _unwrap(node)
+    if isinstance(node, Compound):
+        if node.operator == 'minus':
+            left, right = node.operands
+            return f'{_operand(left)} MINUS {_operand(right)}'
+        return _commutative(node.operator, (_operand(o) for o in _flatten(node, node.operator, Compound)))
+    if isinstance(node, Refined):
+        return f'{_operand(node.expression)} : {_refinement(node.refinement)}'
+    if isinstance(node, Dotted):
+        return ' . '.join(_operand(o) for o in [node.expression] + node.attributes)
+    return _sub_expression(node)
+
+
+def _operand(node):
+    """An expression used inside a larger one, parenthesised unless it is a simple sub-expression"""
+    node = _unwrap(node)
+    if isinstance(node, (Compound, Refined, Dotted)):
+        return f'({_expression(node)})'
+    return _sub_expression(node)
+
+
+def _focus(focus):
+    if isinstance(focus, ConceptReference):
+        return focus.sctid
+    if isinstance(focus, Wildcard):
+        return '*'
+    if isinstance(focus, AlternateIdentifier):
+        code = focus.code if _SIMPLE_ALTID.fullmatch(focus.code) else _quote(focus.code)
+        return f'{focus.scheme}#{code}'
+    inner = _unwrap(focus)
+    if isinstance(inner, SubExpression) and inner.operator is None and not inner.member_of and not inner.filters:
+        return _focus(inner.focus)
+    return f'({_expression(inner)})'
+
+
+def _sub_expression(node):
+    parts = []
+    if node.operator:
+        parts.append(SYMBOLS[node.operator])
+    if node.member_of:
+        parts.append('^')
+        if node.refset_fields:
+            parts.append('[' + ', '.join(node.refset_fields) + ']')
+    parts.append(_focus(node.focus))
+    parts.extend(_filter(f) for f in node.filters)
+    return ' '.join(parts)
+
+
+def _quote(text):
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _concrete(value):
+    if value.kind == 'numeric':
+        return f'#{value.value}'
+    if value.kind == 'boolean':
+        return 'true' if value.value else 'false'
+    prefix = f'{value.match}:' if value.match else ''
+    return prefix + _quote(value.value)
+
+
+def _refinement(node):
+    if isinstance(node, RefinementCompound):
+        rendered = []
+        for operand in _flatten(node, node.operator, RefinementCompound):
+            text = _refinement(operand)
+            rendered.append(f'({text})' if isinstance(operand, RefinementCompound) else text)
+        return _commutative(node.operator, rendered)
+    if isinstance(node, AttributeGroup):
+        return f'{_cardinality(node.cardinality)}{{ {_refinement(node.refinement)} }}'
+    return _attribute(node)
+
+
+def _cardinality(cardinality):
+    if cardinality is None:
+        return ''
+    high = '*' if cardinality.max is None else cardinality.max
+    return f'[{cardinality.min}..{high}] '
+
+
+def _attribute(node):
+    value = _concrete(node.value) if isinstance(node.value, ConcreteValue) else _operand(node.value)
+    reverse = 'R ' if node.reverse else ''
+    return f'{_cardinality(node.cardinality)}{reverse}{_operand(node.name)} {node.operator} {value}'
+
+
+def _filter_value(value):
+    if isinstance(value, ConcreteValue):
+        return _concrete(value)
+    if isinstance(value, tuple):
+        word, acceptability = value
+        return f'{word} ({acceptability.lower()})'
+    if isinstance(value, list):
+        return '(' + ' '.join(_filter_value(v) for v in value) + ')'
+    if isinstance(value, str):
+        return value
+    return _operand(value)
+
+
+def _filter(node):
+    if isinstance(node, HistorySupplement):
+        profile = f'-{node.profile}' if node.profile else ''
+        expression = f' ({_expression(node.expression)})' if node.expression is not None else ''
+        return f'{{{{ +HISTORY{profile}{expression} }}}}'
+    conditions = [f'{c.name} {c.operator} {_filter_value(c.value)}' for c in node.conditions]
+    domain = f'{node.domain} ' if node.domain else ''
+    separator = ', ' if node.conjunction == 'and' else ' OR '
+    return f'{{{{ {domain}{separator.join(sorted(conditions))} }}}}'
+
+
+def render(node):
+    """Canonical ECL text for an already parsed expression"""
+    return _expression(node)
+
+
+def split(node):
+    """
+    Operator and operands of an AND/OR/MINUS compound, looking through
+    redundant parentheses and flattening nested AND/OR, or None if the
+    expression is not a compound
+    """
+    node = _unwrap(node)
+    if not isinstance(node, Compound):
+        return None
+    if node.operator == 'minus':
+        return node.operator, [_unwrap(operand) for operand in node.operands]
+    return node.operator, list(_flatten(node, node.operator, Compound))
+
+
+def canonicalize(text):
+    """Canonical ECL text for an expression; raises EclSyntaxError if it does not parse"""
+    return _expression(ecl_parser.parse(text))
+
+
+def canonical_form(text):
+    """canonicalize(), falling back to whitespace-collapsed text for expressions that do not parse"""
+    try:
+        return canonicalize(text)
+    except EclSyntaxError:
+        return _WHITESPACE.sub(' ', text).strip()
+
+
+@functools.lru_cache(maxsize=4096)
+def canonical_key(text):
+    """Stable hash of the canonical form, used as the expansion cache key"""
+    return hashlib.blake2b(canonical_form(text).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def collapse_report(entries):
+    """
+    Group library entries by canonical form. Returns the number of expressions,
+    distinct canonical forms, how many expressions collapse onto another one,
+    the groups of filenames sharing a form and the files that do not parse.
+    """
+    groups = {}
+    invalid = []
+    for entry in entries:
+        try:
+            form = canonicalize(entry['expression'])
+        except EclSyntaxError:
+            invalid.append(entry['filename'])
+            form = canonical_form(entry['expression'])
+        groups.setdefault(form, []).append(entry['filename'])
+    return {
+        'expressions': len(entries),
+        'canonical_forms': len(groups),
+        'collapsed': len(entries) - len(groups),
+        'groups': [{'canonical': form, 'files': files} for form, files in groups.items() if len(files) > 1],
+        'invalid': invalid,
+    }
+
+
+if __name__ == '__main__':
+    from ecl_catalog import EclCatalog
+
+    report = collapse_report(EclCatalog(sys.argv[1] if len(sys.argv) > 1 else 'ecl_library').files())
+    print(f"{report['expressions']} expressions, {report['canonical_forms']} canonical forms, "
+          f"{report['collapsed']} collapse onto another expression")
+    for group in report['groups']:
+        print(f"  {', '.join(group['files'])}\n    {group['canonical']}")
+    for filename in report['invalid']:
+        print(f'  invalid: {filename}')
@@ -0,0 +1,130 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def parse_ecl_file(file_path):
+    """
+    Parse one library file into its catalog entry, or None if it has no ECL.
+    The first '#' line is the description; the remaining non-comment lines are
+    the expression.
+    """
+    with open(file_path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+
+    description = ""
+    ecl_expression = []
+    for line in content.split('\n'):
+        line = line.strip()
+        if line.startswith('#'):
+            # Only take the first comment line as description
+            if not description:
+                description = line.lstrip('#').strip()
+        elif line:
+            ecl_expression.append(line)
+
+    if not ecl_expression:
+        return None
+    return {
+        'filename': os.path.basename(file_path),
+        'path': file_path,
+        'description': description or "No description available",
+        'expression': '\n'.join(ecl_expression),
+        'category': os.path.basename(os.path.dirname(file_path))
+    }
+
+
+class EclCatalog:
+    """
+    In-memory catalog of the ECL library.
+
+    The library is scanned once and then polled at most every `poll_interval`
+    seconds. Only files whose inode, size or mtime changed are re-parsed.
+    `generation` increases whenever the set of entries changes so dependent
+    caches can tell when to rebuild; listeners registered with `subscribe`
+    receive the (added, changed, removed) entries of each refresh.
+    """
+
+    def __init__(self, root='ecl_library', poll_interval=2.0, clock=time.monotonic):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.generation = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stats = {}    # path -> (inode, size, mtime_ns)
+        self._entries = {}  # path -> entry
+        self._sorted = []
+        self._last_poll = None
+        self._listeners = []
+
+    def subscribe(self, listener):
+        """Call listener(added, changed, removed) after every refresh that changes the catalog"""
+        self._listeners.append(listener)
+
+    def files(self):
+        """All entries sorted by category then filename, refreshing if the poll interval elapsed"""
+        now = self._clock()
+        if self._last_poll is None or now - self._last_poll >= self.poll_interval:
+            self.refresh()
+        return self._sorted
+
+    def get(self, path):
+        return self._entries.get(path)
+
+    def refresh(self):
+        """Rescan the library and re-parse changed files; returns True if anything changed"""
+        with self._lock:
+            self._last_poll = self._clock()
+            seen = {}
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                for name in filenames:
+                    if not name.endswith('.txt'):
+                        continue
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    seen[path] = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+            added, changed, removed = [], [], []
+            for path in set(self._stats) - set(seen):
+                del self._stats[path]
+                entry = self._entries.pop(path, None)
+                if entry is not None:
+                    removed.append(entry)
+
+            for path, stat in seen.items():
+                if self._stats.get(path) == stat:
+                    continue
+                is_new = path not in self._stats
+                self._stats[path] = stat
+                old = self._entries.pop(path, None)
+                try:
+                    entry = parse_ecl_file(path)
+                except Exception as e:
+                    logger.error(f'Error reading file {path}: {e}')
+                    entry = None
+                if entry is None:
+                    if old is not None:
+                        removed.append(old)
+                    continue
+                self._entries[path] = entry
+                if is_new or old is None:
+                    added.append(entry)
+                else:
+                    changed.append(entry)
+
+            if not (added or changed or removed):
+                return False
+            self._sorted = sorted(self._entries.values(), key=lambda x: (x['category'], x['filename']))
+            self.generation += 1
+            logger.info(f'ECL catalog generation {self.generation}: '
+                        f'{len(added)} added, {len(changed)} changed, {len(removed)} removed')
+
+        for listener in self._listeners:
+            listener(added, changed, removed)
+        return True
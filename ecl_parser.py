@@ -0,0 +1,609 @@
+"""
+Parser for SNOMED CT Expression Constraint Language (ECL 2.x).
+
+parse() turns an expression into a typed AST, or raises EclSyntaxError with
+the exact offset, line and column of the problem, so invalid expressions can
+be rejected before they are sent to the terminology server. The parser is a
+hand-written recursive descent over a single-regex tokenizer and takes tens
+of microseconds for typical library expressions.
+
+Supported: constraint operators (symbolic and long forms, including
+child/parent, top and bottom), member-of with optional refset fields,
+wildcards, alternate identifiers, AND/OR/MINUS (with ',' as AND),
+refinements with attribute groups, cardinality, reverse flags, expression,
+numeric, string and boolean comparisons, dotted attributes, description,
+concept and member filters, and history supplements.
+"""
+
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Union
+
+
+class EclSyntaxError(ValueError):
+    """Invalid ECL; `position` is the 0-based offset, `line`/`column` are 1-based"""
+
+    def __init__(self, message, text, position):
+        self.message = message
+        self.position = position
+        self.line = text.count('\n', 0, position) + 1
+        self.column = position - (text.rfind('\n', 0, position) + 1) + 1
+        super().__init__(f'{message} at line {self.line}, column {self.column}')
+
+    def to_dict(self):
+        return {'message': self.message, 'position': self.position,
+                'line': self.line, 'column': self.column}
+
+
+# ---------------------------------------------------------------------------
+# AST
+
+@dataclass
+class ConceptReference:
+    sctid: str
+    term: Optional[str] = None
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Wildcard:
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class AlternateIdentifier:
+    scheme: str
+    code: str
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class FilterCondition:
+    name: str
+    operator: str
+    value: object
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class HistorySupplement:
+    profile: Optional[str] = None
+    expression: Optional['Expression'] = None
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Filter:
+    """A {{ ... }} block; domain is 'D', 'C', 'M' or None (description filter)"""
+    domain: Optional[str]
+    conditions: List[FilterCondition]
+    conjunction: str = 'and'
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class SubExpression:
+    """[operator] [^] focus [filters]; focus may be a parenthesised expression"""
+    focus: Union[ConceptReference, Wildcard, AlternateIdentifier, 'Expression']
+    operator: Optional[str] = None
+    member_of: bool = False
+    refset_fields: Optional[List[str]] = None
+    filters: List[Union[Filter, HistorySupplement]] = field(default_factory=list)
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Compound:
+    """AND / OR / MINUS of two or more operands (MINUS always has exactly two)"""
+    operator: str
+    operands: list
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Dotted:
+    expression: SubExpression
+    attributes: List[SubExpression]
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Cardinality:
+    min: int
+    max: Optional[int]  # None means '*'
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class ConcreteValue:
+    """#number, "string" / match:"..." / wild:"...", or boolean attribute value"""
+    kind: str  # 'numeric', 'string' or 'boolean'
+    value: object
+    match: Optional[str] = None
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Attribute:
+    name: SubExpression
+    operator: str
+    value: Union[SubExpression, ConcreteValue]
+    cardinality: Optional[Cardinality] = None
+    reverse: bool = False
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class AttributeGroup:
+    refinement: object
+    cardinality: Optional[Cardinality] = None
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class RefinementCompound:
+    """AND / OR of attributes, attribute groups or nested refinements"""
+    operator: str
+    operands: list
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+@dataclass
+class Refined:
+    expression: SubExpression
+    refinement: Union[Attribute, AttributeGroup, RefinementCompound]
+    pos: int = field(default=0, compare=False, repr=False)
+
+
+Expression = Union[SubExpression, Compound, Dotted, Refined]
+
+
+# ---------------------------------------------------------------------------
+# Tokenizer
+
+OPERATORS = {
+    '<': 'descendantOf', '<<': 'descendantOrSelfOf', '<!': 'childOf', '<<!': 'childOrSelfOf',
+    '>': 'ancestorOf', '>>': 'ancestorOrSelfOf', '>!': 'parentOf', '>>!': 'parentOrSelfOf',
+    '!!>': 'top', '!!<': 'bottom',
+}
+LONG_OPERATORS = {name.lower(): name for name in OPERATORS.values()}
+NUMERIC_OPERATORS = ('=', '!=', '<', '<=', '>', '>=')
+FILTER_DOMAINS = ('d', 'c', 'm')
+ACCEPTABILITY = ('prefer', 'accept', 'preferred', 'acceptable')
+
+_TOKEN_RE = re.compile(r'''
+    (?P<ws>(?:\s+|/\*.*?\*/)+)
+  | (?P<term>\|[^|]*\|)
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<altid>[A-Za-z][A-Za-z0-9._-]*\#(?:"(?:[^"\\]|\\.)*"|[^\s()\[\]{},|:=]+))
+  | (?P<number>\d+)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_-]*)
+  | (?P<op><<!|<<|<!|<=|<|>>!|>>|>!|>=|>|!!>|!!<|!=|=|\{\{|}}|\.\.|[\^:,(){}\[\].*\#+-])
+''', re.VERBOSE | re.DOTALL)
+
+# A fraction belongs to the number only in a concrete value (#2.5, #-0.5); elsewhere
+# a dot between two identifiers is the dotted attribute operator (404684003.363698007)
+_FRACTION_RE = re.compile(r'\.\d+')
+
+def _in_concrete_value(tokens):
+    if tokens and tokens[-1][0] == 'op' and tokens[-1][1] in ('+', '-'):
+        tokens = tokens[:-1]
+    return bool(tokens) and tokens[-1][:2] == ('op', '#')
+
+def tokenize(text):
+    """Split ECL text into (kind, value, offset) tokens, dropping whitespace and comments"""
+    tokens = []
+    pos = 0
+    length = len(text)
+    match = _TOKEN_RE.match
+    while pos < length:
+        m = match(text, pos)
+        if m is None:
+            if text.startswith('/*', pos):
+                raise EclSyntaxError('Unterminated comment', text, pos)
+            if text[pos] == '|':
+                raise EclSyntaxError('Unterminated term (missing closing "|")', text, pos)
+            if text[pos] == '"':
+                raise EclSyntaxError('Unterminated string', text, pos)
+            raise EclSyntaxError(f'Unexpected character {text[pos]!r}', text, pos)
+        kind = m.lastgroup
+        end = m.end()
+        if kind == 'number' and _in_concrete_value(tokens):
+            fraction = _FRACTION_RE.match(text, end)
+            if fraction is not None:
+                end = fraction.end()
+        if kind != 'ws':
+            tokens.append((kind, text[pos:end], pos))
+        pos = end
+    tokens.append(('eof', '', length))
+    return tokens
+
+
+# ---------------------------------------------------------------------------
+# Parser
+
+class _Parser:
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.index = 0
+
+    # -- token helpers ------------------------------------------------------
+
+    def peek(self, ahead=0):
+        index = self.index + ahead
+        return self.tokens[index] if index < len(self.tokens) else self.tokens[-1]
+
+    def at(self, *values):
+        kind, value, pos = self.tokens[self.index]
+        return kind == 'op' and value in values
+
+    def at_word(self, *words):
+        kind, value, pos = self.tokens[self.index]
+        return kind == 'word' and value.lower() in words
+
+    def advance(self):
+        token = self.tokens[self.index]
+        if token[0] != 'eof':
+            self.index += 1
+        return token
+
+    def error(self, expected, token=None):
+        kind, value, pos = token or self.tokens[self.index]
+        found = 'end of expression' if kind == 'eof' else repr(value)
+        return EclSyntaxError(f'Expected {expected} but found {found}', self.text, pos)
+
+    def expect(self, value, expected=None):
+        if not self.at(value):
+            raise self.error(expected or repr(value))
+        return self.advance()
+
+    def conjunction_operator(self):
+        """'and' / 'or' / 'minus' if the next token is one, else None"""
+        kind, value, pos = self.tokens[self.index]
+        if kind == 'op' and value == ',':
+            return 'and'
+        if kind == 'word':
+            lowered = value.lower()
+            if lowered in ('and', 'or', 'minus'):
+                return lowered
+        return None
+
+    # -- expressions --------------------------------------------------------
+
+    def expression_constraint(self):
+        pos = self.peek()[2]
+        first = self.sub_expression()
+        if self.at(':'):
+            self.advance()
+            return Refined(first, self.refinement(), pos=pos)
+        if self.at('.'):
+            attributes = []
+            while self.at('.'):
+                self.advance()
+                attributes.append(self.sub_expression())
+            return Dotted(first, attributes, pos=pos)
+        operator = self.conjunction_operator()
+        if operator is None:
+            return first
+        operands = [first]
+        while True:
+            current = self.conjunction_operator()
+            if current is None:
+                break
+            if current != operator:
+                raise EclSyntaxError(
+                    f'Cannot mix {operator.upper()} and {current.upper()} without parentheses',
+                    self.text, self.peek()[2])
+            if operator == 'minus' and len(operands) == 2:
+                raise EclSyntaxError('MINUS takes exactly two operands; add parentheses',
+                                     self.text, self.peek()[2])
+            self.advance()
+            operands.append(self.sub_expression())
+        return Compound(operator, operands, pos=pos)
+
+    def sub_expression(self):
+        kind, value, pos = self.peek()
+        operator = None
+        if kind == 'op' and value in OPERATORS:
+            operator = OPERATORS[value]
+            self.advance()
+        elif kind == 'word' and value.lower() in LONG_OPERATORS:
+            operator = LONG_OPERATORS[value.lower()]
+            self.advance()
+
+        member_of = False
+        refset_fields = None
+        if self.at('^') or self.at_word('memberof'):
+            self.advance()
+            member_of = True
+            if self.at('['):
+                refset_fields = self.refset_fields()
+
+        focus = self.focus_concept()
+        filters = []
+        while self.at('{{'):
+            filters.append(self.filter_constraint())
+        return SubExpression(focus, operator, member_of, refset_fields, filters, pos=pos)
+
+    def refset_fields(self):
+        self.expect('[')
+        fields = []
+        while True:
+            kind, value, pos = self.peek()
+            if kind == 'word' or (kind == 'op' and value == '*'):
+                fields.append(value)
+                self.advance()
+            else:
+                raise self.error('refset field name')
+            if self.at(','):
+                self.advance()
+                continue
+            self.expect(']', '"," or "]"')
+            return fields
+
+    def focus_concept(self):
+        kind, value, pos = self.peek()
+        if kind == 'number':
+            self.advance()
+            if not value.isdigit() or not 6 <= len(value) <= 18 or value[0] == '0':
+                raise EclSyntaxError(f'Invalid SNOMED CT identifier {value!r}', self.text, pos)
+            term = None
+            if self.peek()[0] == 'term':
+                term = self.advance()[1][1:-1].strip()
+            return ConceptReference(value, term, pos=pos)
+        if kind == 'op' and value == '*':
+            self.advance()
+            return Wildcard(pos=pos)
+        if kind == 'altid':
+            self.advance()
+            scheme, code = value.split('#', 1)
+            return AlternateIdentifier(scheme, code.strip('"'), pos=pos)
+        if kind == 'op' and value == '(':
+            self.advance()
+            expression = self.expression_constraint()
+            self.expect(')', '")"')
+            return expression
+        raise self.error('a concept id, "*" or "("')
+
+    # -- refinements --------------------------------------------------------
+
+    def refinement(self, in_group=False):
+        pos = self.peek()[2]
+        first = self.sub_refinement(in_group)
+        operator = self.conjunction_operator()
+        if operator is None or operator == 'minus':
+            return first
+        operands = [first]
+        while True:
+            current = self.conjunction_operator()
+            if current is None or current == 'minus':
+                break
+            if current != operator:
+                raise EclSyntaxError(
+                    f'Cannot mix {operator.upper()} and {current.upper()} without parentheses',
+                    self.text, self.peek()[2])
+            self.advance()
+            operands.append(self.sub_refinement(in_group))
+        return RefinementCompound(operator, operands, pos=pos)
+
+    def sub_refinement(self, in_group):
+        if self.at('('):
+            # Either a parenthesised refinement or an attribute whose name is a
+            # parenthesised expression; try the refinement first
+            start = self.index
+            self.advance()
+            try:
+                refinement = self.refinement(in_group)
+                self.expect(')', '")"')
+                if self.at('=', '!=', '<', '<=', '>', '>=', '.', '{{'):
+                    raise self.error('attribute')
+                return refinement
+            except EclSyntaxError as refinement_error:
+                self.index = start
+                try:
+                    return self.attribute()
+                except EclSyntaxError as attribute_error:
+                    # Report whichever reading got further into the text
+                    if refinement_error.position > attribute_error.position:
+                        raise refinement_error from None
+                    raise
+
+        cardinality = None
+        if self.at('['):
+            start = self.index
+            cardinality = self.cardinality()
+            if not self.at('{'):
+                self.index = start
+                return self.attribute()
+        if self.at('{'):
+            if in_group:
+                raise self.error('attribute (attribute groups cannot be nested)')
+            pos = self.advance()[2]
+            refinement = self.refinement(in_group=True)
+            self.expect('}', '"}"')
+            return AttributeGroup(refinement, cardinality, pos=pos)
+        return self.attribute()
+
+    def cardinality(self):
+        pos = self.expect('[')[2]
+        minimum = self.advance()
+        if minimum[0] != 'number' or not minimum[1].isdigit():
+            raise self.error('minimum cardinality', minimum)
+        self.expect('..', '".."')
+        maximum = self.advance()
+        if maximum[0] == 'op' and maximum[1] == '*':
+            high = None
+        elif maximum[0] == 'number' and maximum[1].isdigit():
+            high = int(maximum[1])
+            if high < int(minimum[1]):
+                raise EclSyntaxError('Maximum cardinality is less than the minimum', self.text, maximum[2])
+        else:
+            raise self.error('maximum cardinality or "*"', maximum)
+        self.expect(']', '"]"')
+        return Cardinality(int(minimum[1]), high, pos=pos)
+
+    def attribute(self):
+        pos = self.peek()[2]
+        cardinality = self.cardinality() if self.at('[') else None
+        reverse = False
+        if self.peek()[0] == 'word' and self.peek()[1] == 'R' or self.at_word('reverseof'):
+            self.advance()
+            reverse = True
+        name = self.sub_expression()
+
+        kind, operator, op_pos = self.peek()
+        if kind != 'op' or operator not in NUMERIC_OPERATORS:
+            raise self.error('comparison operator')
+        self.advance()
+
+        if self.at('#'):
+            value_pos = self.advance()[2]
+            sign = ''
+            if self.at('-', '+'):
+                sign = self.advance()[1]
+            number = self.advance()
+            if number[0] != 'number':
+                raise self.error('number after "#"', number)
+            text = sign + number[1]
+            value = ConcreteValue('numeric', float(text) if '.' in text else int(text), pos=value_pos)
+        elif operator not in ('=', '!='):
+            raise self.error('"#" and a number after a numeric comparison')
+        elif self.peek()[0] == 'string' or self.is_typed_search_term():
+            value = self.string_value()
+        elif self.at_word('true', 'false'):
+            kind, word, value_pos = self.advance()
+            value = ConcreteValue('boolean', word.lower() == 'true', pos=value_pos)
+        else:
+            value = self.sub_expression()
+        return Attribute(name, operator, value, cardinality, reverse, pos=pos)
+
+    def is_typed_search_term(self):
+        return (self.at_word('match', 'wild') and self.peek(1)[0] == 'op'
+                and self.peek(1)[1] == ':')
+
+    def string_value(self):
+        pos = self.peek()[2]
+        match = None
+        if self.is_typed_search_term():
+            match = self.advance()[1].lower()
+            self.advance()
+        kind, value, string_pos = self.advance()
+        if kind != 'string':
+            raise self.error('quoted string', (kind, value, string_pos))
+        return ConcreteValue('string', value[1:-1].replace('\\"', '"').replace('\\\\', '\\'), match, pos=pos)
+
+    # -- filters ------------------------------------------------------------
+
+    def filter_constraint(self):
+        pos = self.expect('{{')[2]
+        if self.at('+'):
+            supplement = self.history_supplement(pos)
+            self.expect('}}', '"}}"')
+            return supplement
+
+        domain = None
+        if self.at_word(*FILTER_DOMAINS) and self.peek(1)[0] == 'word':
+            domain = self.advance()[1].upper()
+        conditions = [self.filter_condition()]
+        conjunction = None
+        while not self.at('}}'):
+            operator = self.conjunction_operator()
+            if operator is None or operator == 'minus':
+                raise self.error('",", AND, OR or "}}"')
+            if conjunction is not None and operator != conjunction:
+                raise EclSyntaxError('Cannot mix AND and OR in a filter', self.text, self.peek()[2])
+            conjunction = operator
+            self.advance()
+            conditions.append(self.filter_condition())
+        self.advance()
+        return Filter(domain, conditions, conjunction or 'and', pos=pos)
+
+    def history_supplement(self, pos):
+        self.expect('+')
+        kind, value, word_pos = self.advance()
+        if kind != 'word' or not value.upper().startswith('HISTORY'):
+            raise self.error('HISTORY', (kind, value, word_pos))
+        profile = value[len('HISTORY'):].lstrip('-').upper() or None
+        if profile not in (None, 'MIN', 'MOD', 'MAX'):
+            raise EclSyntaxError(f'Unknown history profile {value!r}', self.text, word_pos)
+        expression = None
+        if self.at('('):
+            self.advance()
+            expression = self.expression_constraint()
+            self.expect(')', '")"')
+        return HistorySupplement(profile, expression, pos=pos)
+
+    def filter_condition(self):
+        kind, name, pos = self.peek()
+        if kind != 'word':
+            raise self.error('filter name')
+        self.advance()
+        kind, operator, op_pos = self.peek()
+        if kind != 'op' or operator not in NUMERIC_OPERATORS:
+            raise self.error('comparison operator')
+        self.advance()
+        return FilterCondition(name, operator, self.filter_value(), pos=pos)
+
+    def filter_value(self):
+        kind, value, pos = self.peek()
+        if self.at('('):
+            self.advance()
+            values = []
+            while not self.at(')'):
+                if self.peek()[0] == 'eof':
+                    raise self.error('")"')
+                values.append(self.filter_value())
+            self.advance()
+            return values
+        if kind == 'string' or self.is_typed_search_term():
+            return self.string_value()
+        if self.at('#'):
+            self.advance()
+            number = self.advance()
+            if number[0] != 'number':
+                raise self.error('number after "#"', number)
+            return ConcreteValue('numeric', float(number[1]) if '.' in number[1] else int(number[1]), pos=pos)
+        if kind == 'word' and value.lower() not in LONG_OPERATORS and value.lower() != 'memberof':
+            self.advance()
+            if value.lower() in ('true', 'false'):
+                return ConcreteValue('boolean', value.lower() == 'true', pos=pos)
+            # e.g. dialect = en-au (prefer)
+            if (self.at('(') and self.peek(1)[0] == 'word' and self.peek(1)[1].lower() in ACCEPTABILITY
+                    and self.peek(2)[1] == ')'):
+                self.advance()
+                acceptability = self.advance()[1]
+                self.advance()
+                return (value, acceptability)
+            return value
+        if kind == 'number' and len(value) == 8 and self.peek(1)[0] != 'term':
+            # effectiveTime dates such as 20190731
+            self.advance()
+            return value
+        return self.sub_expression()
+
+
+def parse(text):
+    """Parse an ECL expression into its AST; raises EclSyntaxError if it is invalid"""
+    parser = _Parser(text)
+    if parser.peek()[0] == 'eof':
+        raise EclSyntaxError('Empty expression', text, 0)
+    expression = parser.expression_constraint()
+    if parser.peek()[0] != 'eof':
+        operator = parser.conjunction_operator()
+        if operator is not None and isinstance(expression, (Refined, Dotted)):
+            raise EclSyntaxError(
+                f'{operator.upper()} after a refinement or dotted expression needs parentheses',
+                text, parser.peek()[2])
+        raise parser.error('end of expression')
+    return expression
+
+
+def validate(text):
+    """None if the expression is valid, otherwise the EclSyntaxError describing the problem"""
+    try:
+        parse(text)
+    except EclSyntaxError as e:
+        return e
+    return None
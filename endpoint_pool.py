@@ -0,0 +1,225 @@
+"""
+Pool of interchangeable terminology servers.
+
+Every endpoint keeps a rolling window of response times and a run of
+consecutive failures. A request goes to the fastest healthy endpoint; if it
+has not answered within that endpoint's p95 latency, the same request is sent
+to the next endpoint as a hedge, the first good answer wins and the other
+call is cancelled. Transport failures fail over to the next endpoint straight
+away, and an endpoint that keeps failing is skipped until a cooldown has
+passed, after which one request probes it again. Only the endpoint's own
+failures (transport errors and 5xx responses) count towards that; a call
+cut short by the client's deadline or cancelled as a losing hedge does not.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import resilience
+
+logger = logging.getLogger(__name__)
+
+
+def is_failure(result):
+    """Transport errors count against an endpoint; an OperationOutcome is a valid answer"""
+    return bool(result.get('error')) and not result.get('operation_outcome')
+
+
+def is_endpoint_failure(result, cancelled=None):
+    """
+    A failure that says the endpoint is unwell: not the request's own deadline
+    running out, a call we cancelled, or a circuit breaker refusing to call
+    """
+    return is_failure(result) and not result.get('deadline_exceeded') and not result.get('circuit_open') \
+        and not (cancelled is not None and cancelled.is_set())
+
+
+class EndpointHealth:
+    """Rolling latency window and failure tracking for one endpoint"""
+
+    def __init__(self, url, window=200, failure_threshold=3, cooldown=30.0, clock=time.monotonic):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._consecutive_failures = 0
+        self._down_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.cancelled = 0
+
+    def record_success(self, latency):
+        self.requests += 1
+        self._latencies.append(latency)
+        self._outcomes.append(True)
+        self._consecutive_failures = 0
+        self._down_until = 0.0
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self._outcomes.append(False)
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.failure_threshold:
+            self._down_until = self._clock() + self.cooldown
+
+    def record_cancelled(self, elapsed):
+        # The time a losing call had run is a lower bound on its latency; keep
+        # it so a slow endpoint drops down the ranking even though it never answers
+        self.cancelled += 1
+        self._latencies.append(elapsed)
+
+    @property
+    def healthy(self):
+        return self._consecutive_failures < self.failure_threshold
+
+    def available(self):
+        """Healthy, or unhealthy but due for a probe"""
+        return self.healthy or self._clock() >= self._down_until
+
+    def samples(self):
+        return len(self._latencies)
+
+    def percentile(self, pct):
+        if not self._latencies:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def stats(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        return {
+            'endpoint': self.url,
+            'healthy': self.healthy,
+            'requests': self.requests,
+            'failures': self.failures,
+            'error_rate': round(self._outcomes.count(False) / len(self._outcomes), 4) if self._outcomes else 0.0,
+            'p50_ms': round(p50 * 1000, 1) if p50 is not None else None,
+            'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'cancelled': self.cancelled
+        }
+
+
+class EndpointPool:
+    """
+    Routes expansions across `endpoints` with hedging and failover.
+    `call(endpoint, ecl, count, offset, cancelled)` performs one upstream
+    expansion and should stop early once the `cancelled` event is set.
+
+    The hedge fires after the primary's p95 latency (never less than
+    `min_hedge_delay`), or after `hedge_delay` until `min_samples` responses
+    have been seen.
+    """
+
+    def __init__(self, endpoints, call, hedge_delay=1.0, min_hedge_delay=0.05, min_samples=20, window=200,
+                 failure_threshold=3, cooldown=30.0, max_workers=16, clock=time.monotonic):
+        self.endpoints = [endpoint.rstrip('/') for endpoint in endpoints]
+        self._call = call
+        self.hedge_delay = hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self._health = {endpoint: EndpointHealth(endpoint, window, failure_threshold, cooldown, clock)
+                        for endpoint in self.endpoints}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='endpoint')
+
+    def __contains__(self, vs_endpoint):
+        return vs_endpoint.rstrip('/') in self._health
+
+    def ranked(self):
+        """Available endpoints, fastest median first; endpoints without samples are tried early"""
+        with self._lock:
+            available = [h for h in self._health.values() if h.available()]
+            if not available:
+                # Everything is down: try them all rather than fail without asking
+                available = list(self._health.values())
+            available.sort(key=lambda h: (not h.healthy, h.percentile(50) or 0.0))
+            return [h.url for h in available]
+
+    def _hedge_after(self, endpoint):
+        health = self._health[endpoint]
+        with self._lock:
+            if health.samples() < self.min_samples:
+                return self.hedge_delay
+            return max(health.percentile(95), self.min_hedge_delay)
+
+    def _attempt(self, endpoint, ecl_expr, count, offset, cancelled):
+        start = time.perf_counter()
+        try:
+            result = self._call(endpoint, ecl_expr, count, offset, cancelled)
+        except Exception as e:
+            logger.error(f'Expansion on {endpoint} failed: {e}')
+            result = {'total': -1, 'concepts': [], 'error': str(e)}
+        return result, time.perf_counter() - start
+
+    def expand(self, ecl_expr, count, offset=0):
+        """Expand on the best endpoint, hedging on the next one when it is slow"""
+        candidates = self.ranked()
+        pending = {}
+        result = None
+
+        def launch(hedge):
+            endpoint = candidates.pop(0)
+            cancelled = threading.Event()
+            future = resilience.submit(self._executor, self._attempt, endpoint, ecl_expr, count, offset, cancelled)
+            pending[future] = (endpoint, cancelled, hedge, time.perf_counter())
+            if hedge:
+                with self._lock:
+                    self._health[endpoint].hedges += 1
+
+        launch(False)
+        hedged = False
+        while pending:
+            timeout = None
+            if candidates and not hedged:
+                primary = next(endpoint for endpoint, _, hedge, _ in pending.values() if not hedge)
+                timeout = self._hedge_after(primary)
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                launch(True)
+                continue
+            for future in done:
+                endpoint, cancelled, hedge, started = pending.pop(future)
+                result, latency = future.result()
+                health = self._health[endpoint]
+                with self._lock:
+                    if not is_failure(result):
+                        health.record_success(latency)
+                        if hedge:
+                            health.hedge_wins += 1
+                    elif is_endpoint_failure(result, cancelled):
+                        health.record_failure()
+                if not is_failure(result) or result.get('deadline_exceeded'):
+                    # Another endpoint would run out of time just the same
+                    self._cancel(pending)
+                    return result
+                logger.warning(f'Endpoint {endpoint} failed ({result.get("error")}); failing over')
+                if candidates and not pending:
+                    launch(hedged)
+        return result
+
+    def _cancel(self, pending):
+        """Stop the calls that lost the race"""
+        now = time.perf_counter()
+        for future, (endpoint, cancelled, hedge, started) in pending.items():
+            cancelled.set()
+            future.cancel()
+            with self._lock:
+                self._health[endpoint].record_cancelled(now - started)
+
+    def stats(self):
+        with self._lock:
+            return [health.stats() for health in self._health.values()]
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
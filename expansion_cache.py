@@ -0,0 +1,164 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from ecl_canonical import canonical_key
+
+
+class ExpansionCache:
+    """
+    Bounded in-process cache for expand_valueset results.
+
+    Successful expansions live in an LRU bounded by entry count and by an
+    estimate of their serialized size, and expire after `ttl` seconds.
+    OperationOutcome errors (invalid ECL) are kept in a separate, smaller LRU
+    with the shorter `negative_ttl` so a fixed expression is re-checked soon.
+    Transport failures are never cached. Keys use the canonical form of the
+    expression, so cosmetically different spellings share one entry, and the
+    SNOMED CT version the endpoint served, so releases never mix.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=64 * 1024 * 1024, ttl=3600,
+                 negative_ttl=60, max_negative_entries=200, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_negative_entries = max_negative_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires_at, size, result)
+        self._negative = OrderedDict()  # key -> (expires_at, result)
+        self._bytes = 0
+        self._hits = 0
+        self._negative_hits = 0
+        self._misses = 0
+        self._evictions = {'lru': 0, 'bytes': 0, 'expired': 0}
+
+    @staticmethod
+    def make_key(vs_endpoint, ecl_expr, count, version=None):
+        return (vs_endpoint.rstrip('/'), canonical_key(ecl_expr), int(count), version)
+
+    @staticmethod
+    def is_negative(result):
+        """True for results describing an OperationOutcome from the server"""
+        return bool(result.get('operation_outcome'))
+
+    @staticmethod
+    def is_cacheable(result):
+        """Only complete expansions and OperationOutcome errors are worth caching"""
+        return not result.get('error') or ExpansionCache.is_negative(result)
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss"""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return entry[2]
+                self._remove(key)
+                self._evictions['expired'] += 1
+
+            negative = self._negative.get(key)
+            if negative is not None:
+                if negative[0] > now:
+                    self._negative.move_to_end(key)
+                    self._negative_hits += 1
+                    return negative[1]
+                del self._negative[key]
+                self._evictions['expired'] += 1
+
+            self._misses += 1
+            return None
+
+    def __contains__(self, key):
+        """True if key holds a live entry; unlike get() this counts no hit or miss and keeps the LRU order"""
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return True
+            negative = self._negative.get(key)
+            return negative is not None and negative[0] > now
+
+    def put(self, key, result):
+        """Store a result; uncacheable results (transport errors) are ignored"""
+        if not self.is_cacheable(result):
+            return
+        now = self._clock()
+        with self._lock:
+            if self.is_negative(result):
+                self._negative[key] = (now + self.negative_ttl, result)
+                self._negative.move_to_end(key)
+                while len(self._negative) > self.max_negative_entries:
+                    self._negative.popitem(last=False)
+                    self._evictions['lru'] += 1
+                return
+
+            size = len(json.dumps(result, separators=(',', ':')))
+            if size > self.max_bytes:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._negative.pop(key, None)
+            self._entries[key] = (now + self.ttl, size, result)
+            self._bytes += size
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions['lru'] += 1
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self._evictions['bytes'] += 1
+
+    def get_or_expand(self, expand, vs_endpoint, ecl_expr, count, version=None):
+        """Return the cached result or call expand(vs_endpoint, ecl_expr, count) and cache it"""
+        key = self.make_key(vs_endpoint, ecl_expr, count, version)
+        result = self.get(key)
+        if result is None:
+            result = expand(vs_endpoint, ecl_expr, count)
+            self.put(key, result)
+        return result
+
+    def discard(self, vs_endpoint, version):
+        """Drop every entry of one endpoint and SNOMED CT version; returns how many were dropped"""
+        endpoint = vs_endpoint.rstrip('/')
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == endpoint and key[3] == version]
+            for key in keys:
+                self._remove(key)
+            negative = [key for key in self._negative if key[0] == endpoint and key[3] == version]
+            for key in negative:
+                del self._negative[key]
+            return len(keys) + len(negative)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._negative.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Counters for sizing the cache against real traffic"""
+        with self._lock:
+            hits = self._hits + self._negative_hits
+            lookups = hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'negative_entries': len(self._negative),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'negative_hits': self._negative_hits,
+                'misses': self._misses,
+                'hit_ratio': round(hits / lookups, 4) if lookups else 0.0,
+                'evictions': dict(self._evictions)
+            }
+
+    def _remove(self, key):
+        expires_at, size, result = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,251 @@
+"""
+Streaming decoder for FHIR $expand responses.
+
+Walks the response JSON incrementally from an iterable of byte chunks and
+pulls out only what the app needs: the resource type, expansion.total, the
+code system version parameter and code/display/system/version of each entry
+in expansion.contains. Each concept is decoded on its own as it arrives, so
+the full document is never held in memory or turned into a Python tree.
+Values the app does not use (and all of contains for a total-only count)
+are skipped by scanning brackets and strings, without decoding them.
+"""
+
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Everything up to the next bracket that is not inside a string, or the start of an unfinished string
+_SKIP_RUN = re.compile(r'(?:[^"\[\]{}]++|"[^"\\]*+(?:\\.[^"\\]*+)*+")*+')
+_STRING_END = re.compile(r'["\\]')
+_SCALAR_END = re.compile(r'[ \t\n\r,\]}]')
+_decoder = json.JSONDecoder()
+
+
+class EmptyResponseError(ValueError):
+    pass
+
+
+class _Reader:
+    """Text buffer over a chunk iterator that refills on demand"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self._start = None  # start of a value being scanned, kept when the buffer is trimmed
+
+    def fill(self):
+        """Append the next chunk; returns False once the input is exhausted"""
+        if self.eof:
+            return False
+        for chunk in self._chunks:
+            if not chunk:
+                continue
+            text = self._utf8.decode(chunk)
+            keep = self.pos if self._start is None else self._start
+            if keep > 65536:
+                # Drop what has already been consumed
+                self.buf = self.buf[keep:]
+                self.pos -= keep
+                if self._start is not None:
+                    self._start = 0
+            self.buf += text
+            return True
+        self.buf += self._utf8.decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def peek(self):
+        """Skip whitespace and return the next character ('' at end of input)"""
+        while True:
+            self.pos = _WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f'Expected {char!r} at offset {self.pos}')
+        self.pos += 1
+
+    def value(self):
+        """
+        Decode one complete JSON value at the current position. A value that
+        runs past the end of the buffer is scanned to its end first, reading
+        more input as needed, and then decoded once.
+        """
+        self.peek()
+        try:
+            value, end = _decoder.raw_decode(self.buf, self.pos)
+        except json.JSONDecodeError:
+            if self.eof:
+                raise
+            value, end = self._scan_and_decode()
+        else:
+            if end == len(self.buf) and not self.eof and isinstance(value, (int, float)):
+                # A number at the end of the buffer may continue in the next chunk
+                value, end = self._scan_and_decode()
+        self.pos = end
+        return value
+
+    def _scan_and_decode(self):
+        self._start = self.pos
+        try:
+            self.skip()
+        finally:
+            start, self._start = self._start, None
+        return _decoder.raw_decode(self.buf, start)
+
+    def skip(self):
+        """
+        Move past the JSON value at the current position without building it.
+        Only brackets and strings are tracked, so a malformed value is not
+        always noticed.
+        """
+        char = self.peek()
+        if char == '"':
+            self.pos += 1
+            self._skip_string()
+            return
+        if char not in ('[', '{'):
+            # A number or literal runs up to the next delimiter
+            while True:
+                match = _SCALAR_END.search(self.buf, self.pos)
+                if match is not None:
+                    self.pos = match.start()
+                    return
+                self.pos = len(self.buf)
+                if not self.fill():
+                    return
+        depth = 0
+        while True:
+            self.pos = _SKIP_RUN.match(self.buf, self.pos).end()
+            if self.pos == len(self.buf):
+                if not self.fill():
+                    raise ValueError(f'Unterminated JSON value at offset {self.pos}')
+                continue
+            char = self.buf[self.pos]
+            self.pos += 1
+            if char == '"':
+                # The string continues in the next chunk
+                self._skip_string()
+            elif char in '[{':
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return
+
+    def _skip_string(self):
+        """Move past the rest of a string whose opening quote has been read"""
+        while True:
+            match = _STRING_END.search(self.buf, self.pos)
+            if match is None:
+                self.pos = len(self.buf)
+                if not self.fill():
+                    raise ValueError(f'Unterminated string at offset {self.pos}')
+                continue
+            if match.group() == '"':
+                self.pos = match.end()
+                return
+            # A backslash escapes the next character, which may still be in the next chunk
+            self.pos = match.start()
+            while self.pos + 1 >= len(self.buf):
+                if not self.fill():
+                    raise ValueError(f'Unterminated string at offset {self.pos}')
+            self.pos += 2
+
+    def members(self):
+        """Iterate the keys of the object at the current position, leaving each value unread"""
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            char = self.peek()
+            self.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f'Expected "," or "}}" at offset {self.pos - 1}')
+
+    def items(self):
+        """Iterate the elements of the array at the current position, leaving each unread"""
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f'Expected "," or "]" at offset {self.pos - 1}')
+
+
+def _add_concepts(entry, concepts, full):
+    code = entry.get('code')
+    if code:
+        # Use code as fallback if no display
+        concept = {'code': str(code), 'display': str(entry.get('display') or code)}
+        if full:
+            concept['system'] = entry.get('system')
+            concept['version'] = entry.get('version')
+        concepts.append(concept)
+    # Hierarchical expansions nest entries under 'contains'
+    for child in entry.get('contains', ()):
+        _add_concepts(child, concepts, full)
+
+
+def _read_expansion(reader, decoded, full, total_only):
+    for key in reader.members():
+        if key == 'total':
+            decoded['total'] = reader.value()
+        elif key == 'parameter':
+            for parameter in reader.value():
+                if parameter.get('name') == 'version':
+                    decoded['version'] = parameter.get('valueUri') or parameter.get('valueString')
+        elif key == 'contains' and not total_only:
+            concepts = decoded['concepts']
+            for _ in reader.items():
+                _add_concepts(reader.value(), concepts, full)
+        else:
+            reader.skip()
+
+
+def decode_expansion(chunks, full=False, total_only=False):
+    """
+    Decode a $expand response from an iterable of byte chunks.
+
+    Returns a dict with 'resourceType', 'total' (-1 if absent), 'concepts'
+    (list of {code, display}, plus system and version when full=True),
+    'version' when the server reported one, and 'issue' for OperationOutcome
+    responses. With total_only=True any concepts in the response are skipped
+    and 'concepts' stays empty. Raises EmptyResponseError for an empty body
+    and ValueError for malformed JSON.
+    """
+    reader = _Reader(chunks)
+    if reader.peek() == '':
+        raise EmptyResponseError('Empty response')
+    decoded = {'resourceType': None, 'total': -1, 'concepts': []}
+    for key in reader.members():
+        if key == 'resourceType':
+            decoded['resourceType'] = reader.value()
+        elif key == 'expansion':
+            _read_expansion(reader, decoded, full, total_only)
+        elif key == 'issue':
+            decoded['issue'] = reader.value()
+        else:
+            reader.skip()
+    if reader.peek() != '':
+        raise ValueError(f'Unexpected data after JSON document at offset {reader.pos}')
+    return decoded
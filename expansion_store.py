@@ -0,0 +1,245 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import resilience
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS expansions (
+    endpoint    TEXT NOT NULL,
+    version     TEXT NOT NULL,
+    ecl         TEXT NOT NULL,
+    count       INTEGER NOT NULL,
+    result      TEXT NOT NULL,
+    created_at  REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (endpoint, version, ecl, count)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS expansions_accessed ON expansions (accessed_at);
+CREATE TABLE IF NOT EXISTS endpoint_versions (
+    endpoint    TEXT PRIMARY KEY,
+    version     TEXT NOT NULL,
+    seen_at     REAL NOT NULL
+);
+"""
+
+
+class ExpansionStore:
+    """
+    SQLite-backed store of expansion results that survives restarts.
+
+    Rows are keyed on terminology server, SNOMED edition/version URI and ECL
+    (plus page size). The store remembers the latest version seen for each
+    endpoint so lookups, which happen before the server is asked, only return
+    expansions from the release the server is currently serving.
+
+    Every `compact_every` puts the store is compacted back to `max_rows` rows
+    on a background thread. Worker processes sharing the file take turns
+    through a lock file next to it: whoever finds it held skips the round.
+    """
+
+    def __init__(self, path, ttl=7 * 24 * 3600, clock=time.time, max_rows=10000, compact_every=500):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.compact_every = compact_every
+        self._clock = clock
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._compacting = threading.Lock()
+        self._puts = 0
+        self.compactions = 0
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(vs_endpoint, ecl_expr, count):
+        return vs_endpoint.rstrip('/'), ecl_expr.strip(), int(count)
+
+    @resilience.offloaded
+    def current_version(self, vs_endpoint):
+        """The SNOMED version URI last reported by an endpoint, or None"""
+        return self._current_version(vs_endpoint)
+
+    def _current_version(self, vs_endpoint):
+        row = self._connect().execute(
+            'SELECT version FROM endpoint_versions WHERE endpoint = ?',
+            (vs_endpoint.rstrip('/'),)).fetchone()
+        return row[0] if row else None
+
+    @resilience.offloaded
+    def current_versions(self):
+        """{endpoint: version} for every endpoint the store has seen"""
+        return dict(self._connect().execute('SELECT endpoint, version FROM endpoint_versions'))
+
+    @resilience.offloaded
+    def get(self, vs_endpoint, ecl_expr, count, version=None):
+        """Return the stored result for `version`, by default the endpoint's current one, or None"""
+        endpoint, ecl, count = self._key(vs_endpoint, ecl_expr, count)
+        version = version or self._current_version(endpoint)
+        if version is None:
+            return None
+        now = self._clock()
+        conn = self._connect()
+        row = conn.execute(
+            'SELECT result, created_at FROM expansions '
+            'WHERE endpoint = ? AND version = ? AND ecl = ? AND count = ?',
+            (endpoint, version, ecl, count)).fetchone()
+        if row is None or row[1] + self.ttl < now:
+            return None
+        with conn:
+            conn.execute(
+                'UPDATE expansions SET accessed_at = ? '
+                'WHERE endpoint = ? AND version = ? AND ecl = ? AND count = ?',
+                (now, endpoint, version, ecl, count))
+        return json.loads(row[0])
+
+    def put(self, vs_endpoint, ecl_expr, count, result):
+        """Store a successful expansion under the version the server reported"""
+        if not self._put(vs_endpoint, ecl_expr, count, result) or not self.compact_every:
+            return
+        with self._lock:
+            self._puts += 1
+            due = self._puts >= self.compact_every
+            if due:
+                self._puts = 0
+        if due:
+            threading.Thread(target=self._compact_in_background, name='expansion-store-compact',
+                             daemon=True).start()
+
+    @resilience.offloaded
+    def _put(self, vs_endpoint, ecl_expr, count, result):
+        if result.get('error') or not result.get('version'):
+            return False
+        endpoint, ecl, count = self._key(vs_endpoint, ecl_expr, count)
+        now = self._clock()
+        payload = json.dumps(result, separators=(',', ':'))
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO expansions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (endpoint, result['version'], ecl, count, payload, now, now))
+            conn.execute(
+                'INSERT OR REPLACE INTO endpoint_versions VALUES (?, ?, ?)',
+                (endpoint, result['version'], now))
+        return True
+
+    def _compact_in_background(self):
+        try:
+            self.try_compact()
+        except sqlite3.Error as e:
+            logger.error(f'Failed to compact expansion store {self.path}: {e}')
+
+    def iter_current(self, limit=None):
+        """
+        Yield (endpoint, ecl, count, result) for the current version of every
+        endpoint, most recently used first. Rows are read lazily.
+        """
+        now = self._clock()
+        query = ('SELECT e.endpoint, e.ecl, e.count, e.result FROM expansions e '
+                 'JOIN endpoint_versions v ON v.endpoint = e.endpoint AND v.version = e.version '
+                 'WHERE e.created_at >= ? ORDER BY e.accessed_at DESC')
+        params = [now - self.ttl]
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(int(limit))
+        for endpoint, ecl, count, payload in self._connect().execute(query, params):
+            yield endpoint, ecl, count, json.loads(payload)
+
+    def preload(self, cache, limit=None):
+        """Fill an ExpansionCache from the store; returns the number of entries loaded"""
+        loaded = 0
+        for endpoint, ecl, count, result in self.iter_current(limit):
+            cache.put(cache.make_key(endpoint, ecl, count, result.get('version')), result)
+            loaded += 1
+        logger.info(f'Preloaded {loaded} expansions from {self.path}')
+        return loaded
+
+    def try_compact(self, max_rows=None):
+        """
+        compact() unless another thread or worker process is already compacting
+        the file, in which case nothing is done and None is returned
+        """
+        if not self._compacting.acquire(blocking=False):
+            return None
+        try:
+            return self._compact_if_unlocked(max_rows)
+        finally:
+            self._compacting.release()
+
+    @resilience.offloaded
+    def _compact_if_unlocked(self, max_rows):
+        if fcntl is None:
+            return self.compact(max_rows)
+        fd = os.open(self.path + '.compact.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            return self.compact(max_rows)
+        finally:
+            os.close(fd)
+
+    def compact(self, max_rows=None):
+        """
+        Drop expired rows and rows from superseded versions, keep at most
+        max_rows (default: the store's max_rows) most recently used rows and,
+        if anything went, reclaim the file space. Returns the number of rows removed.
+        """
+        max_rows = self.max_rows if max_rows is None else max_rows
+        conn = self._connect()
+        with conn:
+            removed = conn.execute(
+                'DELETE FROM expansions WHERE created_at < ?',
+                (self._clock() - self.ttl,)).rowcount
+            removed += conn.execute(
+                'DELETE FROM expansions WHERE NOT EXISTS ('
+                'SELECT 1 FROM endpoint_versions v '
+                'WHERE v.endpoint = expansions.endpoint AND v.version = expansions.version)').rowcount
+            removed += conn.execute(
+                'DELETE FROM expansions WHERE accessed_at < ('
+                'SELECT accessed_at FROM expansions ORDER BY accessed_at DESC LIMIT 1 OFFSET ?)',
+                (max_rows - 1,)).rowcount
+        self.compactions += 1
+        if removed:
+            conn.execute('VACUUM')
+            logger.info(f'Compacted expansion store {self.path}: removed {removed} rows')
+        return removed
+
+    @resilience.offloaded
+    def stats(self):
+        conn = self._connect()
+        rows = conn.execute('SELECT COUNT(*) FROM expansions').fetchone()[0]
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        return {'path': self.path, 'rows': rows, 'file_bytes': page_count * page_size,
+                'compactions': self.compactions}
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for a FHIR terminology server's ValueSet/$expand operation.
+
+Used by the benchmarks and offline tests so the fetcher can be exercised
+without reaching tx.ontoserver.csiro.au. Expansions are synthetic concepts
+of a configurable size, or canned responses (e.g. recorded from a real
+server) for the expressions they cover; latency, jitter and a random error
+rate can be injected, seeded so runs are reproducible.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+SNOMED_VERSION = 'http://snomed.info/sct/32506021000036107/version/20250131'
+
+
+def synthetic_code(index):
+    """Deterministic fake SCTID for the n-th concept of an expansion"""
+    return str(100000000 + index * 7919)
+
+
+def build_expansion(ecl_expr, total, offset, count, version=SNOMED_VERSION):
+    """Build a ValueSet expansion resource holding one page of synthetic concepts"""
+    contains = []
+    for index in range(offset, min(offset + count, total)):
+        contains.append({
+            'system': 'http://snomed.info/sct',
+            'version': version,
+            'code': synthetic_code(index),
+            'display': f'Synthetic concept {index}'
+        })
+    return {
+        'resourceType': 'ValueSet',
+        'url': 'http://snomed.info/sct?fhir_vs=ecl/' + parse.quote(ecl_expr, safe=''),
+        'status': 'active',
+        'expansion': {
+            'identifier': f'urn:uuid:fake-{offset}-{count}',
+            'timestamp': '2025-01-31T00:00:00+00:00',
+            'total': total,
+            'offset': offset,
+            'parameter': [
+                {'name': 'version', 'valueUri': version},
+                {'name': 'count', 'valueInteger': count},
+                {'name': 'offset', 'valueInteger': offset}
+            ],
+            'contains': contains
+        }
+    }
+
+
+def page_of(resource, offset, count):
+    """One page of a canned expansion, as the server would return it for offset/count"""
+    expansion = dict(resource.get('expansion', {}))
+    contains = expansion.get('contains', [])
+    expansion['offset'] = offset
+    expansion['contains'] = contains[offset:offset + count]
+    expansion.setdefault('total', len(contains))
+    return dict(resource, expansion=expansion)
+
+
+def operation_outcome(message):
+    """Build an OperationOutcome like the ones Ontoserver returns for bad ECL"""
+    return {
+        'resourceType': 'OperationOutcome',
+        'issue': [{
+            'severity': 'error',
+            'code': 'invalid',
+            'diagnostics': f'error: [00000000-0000-0000-0000-000000000000]: {message}'
+        }]
+    }
+
+
+class _ExpandHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/fhir+json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        server = self.server.fake
+        url = parse.urlsplit(self.path)
+        server.record_request()
+        delay, fail_status = server.next_response()
+        if delay:
+            time.sleep(delay)
+        if fail_status:
+            payload = b'Service Unavailable'
+            self.send_response(fail_status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+
+        if url.path.endswith('/ValueSet/$expand'):
+            params = parse.parse_qs(url.query)
+            vs_url = params.get('url', [''])[0]
+            ecl_expr = vs_url.split('fhir_vs=ecl/', 1)[-1]
+            if not ecl_expr.strip() or 'invalid' in ecl_expr.lower():
+                self._send_json(400, operation_outcome(f'Unable to parse ECL: {ecl_expr}'))
+                return
+            count = int(params.get('count', ['25'])[0])
+            offset = int(params.get('offset', ['0'])[0])
+            canned = server.canned.get(parse.unquote(ecl_expr).strip())
+            if canned is not None:
+                resource = page_of(canned, offset, count)
+            else:
+                resource = build_expansion(ecl_expr, server.total, offset, count, server.version)
+            if not server.report_total:
+                resource['expansion'].pop('total', None)
+            self._send_json(200, resource)
+        elif url.path.endswith('/metadata'):
+            self._send_json(200, {'resourceType': 'CapabilityStatement', 'status': 'active'})
+        else:
+            self._send_json(404, operation_outcome(f'Unknown path {url.path}'))
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    # The socketserver default of 5 drops connection bursts from concurrent load tests
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients that drop a connection after an error status are expected under load
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeTerminologyServer:
+    """
+    Threaded HTTP/1.1 server answering $expand with synthetic concepts.
+
+    Use as a context manager; the base FHIR URL is available as `url`.
+    `latency` and `fail_status` (an HTTP status to answer every request with)
+    can be changed while the server runs to inject slowness and outages, and
+    `version` to simulate loading a new SNOMED CT release. `jitter` adds a
+    random extra delay of up to that many seconds and `error_rate` answers
+    that fraction of requests with a 503, both drawn from a generator seeded
+    with `seed`. `canned` maps ECL expressions to ValueSet resources served
+    (paged) instead of synthetic concepts. With report_total=False responses
+    leave out expansion.total, which is optional in FHIR.
+    """
+
+    def __init__(self, total=1000, latency=0.0, host='127.0.0.1', port=0, fail_status=None, version=SNOMED_VERSION,
+                 jitter=0.0, error_rate=0.0, canned=None, seed=0, report_total=True):
+        self.total = total
+        self.report_total = report_total
+        self.version = version
+        self.latency = latency
+        self.fail_status = fail_status
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.canned = {ecl.strip(): resource for ecl, resource in (canned or {}).items()}
+        self.request_count = 0
+        self.injected_errors = 0
+        self._count_lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._httpd = _QuietHTTPServer((host, port), _ExpandHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f'http://{host}:{port}/fhir'
+
+    def record_request(self):
+        with self._count_lock:
+            self.request_count += 1
+
+    def next_response(self):
+        """(delay in seconds, failure status or None) for the next request"""
+        with self._count_lock:
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+            if self.fail_status:
+                return delay, self.fail_status
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.injected_errors += 1
+                return delay, 503
+            return delay, None
+
+    def serve_forever(self):
+        self._httpd.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a local stand-in FHIR terminology server')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--total', type=int, default=1000, help='Concepts in every expansion')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds to wait before answering')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra delay of up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--canned', help='JSON file mapping ECL expressions to ValueSet resources')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    canned = None
+    if args.canned:
+        with open(args.canned) as f:
+            canned = json.load(f)
+    server = FakeTerminologyServer(total=args.total, latency=args.latency, port=args.port, jitter=args.jitter,
+                                   error_rate=args.error_rate, canned=canned, seed=args.seed)
+    print(f'Fake terminology server listening on {server.url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,13 +1,207 @@
 import os
-import subprocess
-import json
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib import parse
 import requests
-from fhirpathpy import evaluate
+import urllib3
+from requests.adapters import HTTPAdapter
 import logging
+from expansion_decoder import decode_expansion, EmptyResponseError
+from expansion_cache import ExpansionCache
+from ecl_canonical import canonical_form
+import local_engine
+from expansion_store import ExpansionStore
+from single_flight import SingleFlight
+from endpoint_pool import EndpointPool, is_failure
+import resilience
+from resilience import BreakerRegistry
+from release_tracker import ReleaseTracker
+import metrics
+import profiling
 
 logger = logging.getLogger(__name__)
 
+# Transport configuration (seconds / connections per endpoint)
+TX_CONNECT_TIMEOUT = float(os.getenv("TX_CONNECT_TIMEOUT", 5))
+TX_READ_TIMEOUT = float(os.getenv("TX_READ_TIMEOUT", 30))
+TX_POOL_SIZE = int(os.getenv("TX_POOL_SIZE", 10))
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+# Retries of failed $expand calls (idempotent GETs) and the per-server circuit breaker
+TX_RETRIES = int(os.getenv("TX_RETRIES", 2))
+TX_RETRY_BACKOFF = float(os.getenv("TX_RETRY_BACKOFF", 0.1))
+TX_BREAKER_THRESHOLD = int(os.getenv("TX_BREAKER_THRESHOLD", 5))
+TX_BREAKER_RESET = float(os.getenv("TX_BREAKER_RESET", 30))
+breakers = BreakerRegistry(TX_BREAKER_THRESHOLD, TX_BREAKER_RESET)
+
+# Request GUIDs Ontoserver prefixes to diagnostics, e.g. "[xxxxxxxx-...-xxxxxxxxxxxx]: "
+GUID_PATTERN = re.compile(r'\[[\da-f]{8}-[\da-f]{4}-[\da-f]{4}-[\da-f]{4}-[\da-f]{12}\]:\s*', re.IGNORECASE)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+# Background page fetches for streaming expansions
+_prefetch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("STREAM_PREFETCH_WORKERS", 8)),
+                                        thread_name_prefix='prefetch')
+
+# Expansion result cache in front of expand_valueset
+expansion_cache = ExpansionCache(
+    max_entries=int(os.getenv("CACHE_MAX_ENTRIES", 1000)),
+    max_bytes=int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("CACHE_TTL", 3600)),
+    negative_ttl=float(os.getenv("CACHE_NEGATIVE_TTL", 60))
+)
+
+# Persistent expansion store; set EXPANSION_STORE to an empty string to disable
+EXPANSION_STORE = os.getenv("EXPANSION_STORE", "./cache/expansions.sqlite3")
+STORE_MAX_ROWS = int(os.getenv("STORE_MAX_ROWS", 10000))
+STORE_COMPACT_EVERY = int(os.getenv("STORE_COMPACT_EVERY", 500))
+expansion_store = ExpansionStore(EXPANSION_STORE, ttl=float(os.getenv("STORE_TTL", 7 * 24 * 3600)),
+                                 max_rows=STORE_MAX_ROWS, compact_every=STORE_COMPACT_EVERY) if EXPANSION_STORE else None
+
+# Identical concurrent expansions share one upstream call. Worker processes also
+# coalesce through lock files next to the store, whose rows carry the result across.
+SINGLE_FLIGHT_LOCKS = os.getenv("SINGLE_FLIGHT_LOCKS",
+                                os.path.join(os.path.dirname(EXPANSION_STORE) or '.', 'locks') if EXPANSION_STORE else '')
+single_flight = SingleFlight(SINGLE_FLIGHT_LOCKS if expansion_store is not None and SINGLE_FLIGHT_LOCKS else None)
+
+
+# SNOMED CT release each endpoint serves; expansion cache keys include it. After a release
+# change the old entries stay usable for RELEASE_OVERLAP seconds while the new release warms up.
+releases = ReleaseTracker(overlap=float(os.getenv("RELEASE_OVERLAP", 600)),
+                          check_interval=float(os.getenv("RELEASE_CHECK_INTERVAL", 300)))
+
+
+# Interchangeable terminology servers (comma separated). A request for any of them is
+# routed through the pool, which hedges slow calls and fails over between them.
+TX_ENDPOINTS = [e.strip() for e in os.getenv("TX_ENDPOINTS", "").split(',') if e.strip()]
+TX_HEDGE_DELAY = float(os.getenv("TX_HEDGE_DELAY", 1.0))
+TX_ENDPOINT_COOLDOWN = float(os.getenv("TX_ENDPOINT_COOLDOWN", 30))
+endpoint_pool = None
+
+
+def configure_endpoint_pool(endpoints, **options):
+    """
+    Replace the endpoint pool. `options` are passed to EndpointPool; fewer than
+    two endpoints disables pooling.
+    """
+    global endpoint_pool
+    options.setdefault('hedge_delay', TX_HEDGE_DELAY)
+    options.setdefault('cooldown', TX_ENDPOINT_COOLDOWN)
+    # One thread per pooled connection, so the executor never queues calls the sessions could carry
+    options.setdefault('max_workers', TX_POOL_SIZE * max(1, len(endpoints)))
+    previous = endpoint_pool
+    # Pool members are not retried in place: failing over to the next endpoint is the retry
+    endpoint_pool = EndpointPool(endpoints, lambda *args: _expand_remote(*args, retries=0), **options) \
+        if len(endpoints) > 1 else None
+    if previous is not None:
+        previous.close()
+    return endpoint_pool
+
+
+configure_endpoint_pool(TX_ENDPOINTS)
+
+
+def configure_transport(connect_timeout=None, read_timeout=None, pool_size=None):
+    """
+    Override the transport timeouts and pool size. Existing pooled sessions are
+    closed so the new settings apply to the next request.
+    """
+    global TX_CONNECT_TIMEOUT, TX_READ_TIMEOUT, TX_POOL_SIZE
+    if connect_timeout is not None:
+        TX_CONNECT_TIMEOUT = float(connect_timeout)
+    if read_timeout is not None:
+        TX_READ_TIMEOUT = float(read_timeout)
+    if pool_size is not None:
+        TX_POOL_SIZE = int(pool_size)
+    close_sessions()
+
+
+def close_sessions():
+    """Close every pooled session and drop its keep-alive connections"""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+def shutdown():
+    """
+    Let queued background page fetches and refreshes finish, then release
+    the endpoint pool, pooled connections and the store (worker exit).
+    """
+    _prefetch_executor.shutdown(wait=True)
+    if endpoint_pool is not None:
+        endpoint_pool.close()
+    close_sessions()
+    if expansion_store is not None:
+        expansion_store.close()
+
+
+def get_session(vs_endpoint):
+    """
+    Return the keep-alive session for an endpoint. Sessions are pooled per
+    scheme://host:port so every path on the same server shares connections.
+    """
+    url = parse.urlsplit(vs_endpoint)
+    key = f"{url.scheme}://{url.netloc}"
+    session = _sessions.get(key)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = _TimedAdapter(pool_connections=1, pool_maxsize=TX_POOL_SIZE, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept'] = 'application/fhir+json'
+            _sessions[key] = session
+    return session
+
+# Seconds the current thread spent opening connections, read around each request
+_connect_time = threading.local()
+
+
+def _timed_connect(connect):
+    def timed(self):
+        start = time.perf_counter()
+        try:
+            return connect(self)
+        finally:
+            _connect_time.seconds = getattr(_connect_time, 'seconds', 0.0) + time.perf_counter() - start
+    return timed
+
+
+class _TimedHTTPConnection(urllib3.connection.HTTPConnection):
+    connect = _timed_connect(urllib3.connection.HTTPConnection.connect)
+
+
+class _TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+    connect = _timed_connect(urllib3.connection.HTTPSConnection.connect)
+
+
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections record how long connecting (TCP and TLS) took"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': _TimedHTTPConnectionPool,
+                                                   'https': _TimedHTTPSConnectionPool}
+
+
 def write_bundle_data(endpoint, token, outfile):
     """
     Write the syndicated bundles to outfile
@@ -21,40 +215,393 @@ def write_bundle_data(endpoint, token, outfile):
         f.write(response.content)
 
 
-def expand_valueset(vs_endpoint, ecl_expr, count):
+def cached_expand_valueset(vs_endpoint, ecl_expr, count):
+    """
+    expand_valueset behind the in-process expansion cache and the on-disk store.
+    The canonical form of the expression is what gets stored and sent upstream,
+    so equivalent spellings make a single query.
+
+    Entries are keyed on the SNOMED CT version the endpoint currently serves.
+    For RELEASE_OVERLAP seconds after a release change, a miss falls back to
+    the previous release's entry, which is refreshed in the background.
+    """
+    ecl_expr = canonical_form(ecl_expr)
+    current, previous = releases.versions(vs_endpoint)
+    _maintain_releases(vs_endpoint)
+    result = expansion_cache.get(ExpansionCache.make_key(vs_endpoint, ecl_expr, count, current))
+    if result is not None:
+        return result
+    if previous is not None:
+        result = expansion_cache.get(ExpansionCache.make_key(vs_endpoint, ecl_expr, count, previous))
+        if result is not None:
+            _prefetch_executor.submit(refresh_expansion, vs_endpoint, ecl_expr, count)
+            return result
+    result = _expand_through_store(vs_endpoint, ecl_expr, count, current)
+    return _remember(vs_endpoint, ecl_expr, count, result)
+
+
+def count_valueset(vs_endpoint, ecl_expr):
+    """
+    Number of concepts an expression matches, without fetching any of them:
+    a cached count=0 expansion, so the server only has to report the total.
+    Returns {total, concepts: [], version?} or {total: -1, error}.
+    """
+    return cached_expand_valueset(vs_endpoint, ecl_expr, 0)
+
+
+def refresh_expansion(vs_endpoint, ecl_expr, count):
+    """
+    Re-expand upstream, bypassing the cache and store, and replace the cached
+    result. A failed call leaves the previous entry in place.
+    """
+    ecl_expr = canonical_form(ecl_expr)
+    key = ExpansionCache.make_key(vs_endpoint, ecl_expr, count)
+    if expansion_store is None:
+        result = single_flight.do(key, lambda: expand_valueset(vs_endpoint, ecl_expr, count),
+                                  expired=deadline_exceeded)
+    else:
+        result = single_flight.do(key, lambda: _expand_and_store(vs_endpoint, ecl_expr, count),
+                                  expired=deadline_exceeded)
+    return _remember(vs_endpoint, ecl_expr, count, result)
+
+
+def _remember(vs_endpoint, ecl_expr, count, result):
+    """Cache a result under the version it came from, noting a release change on the way"""
+    version = result.get('version') if not result.get('error') else None
+    if version:
+        observe_release(vs_endpoint, version)
+    else:
+        # OperationOutcomes carry no version; they belong to the release being served
+        version = releases.current(vs_endpoint)
+    expansion_cache.put(ExpansionCache.make_key(vs_endpoint, ecl_expr, count, version), result)
+    return result
+
+
+# Cheapest possible expansion: the SNOMED CT root concept alone, total only
+VERSION_PROBE_ECL = '138875005'
+
+
+def server_version(vs_endpoint):
+    """SNOMED CT version the server currently expands against, or None if it did not say"""
+    result = expand_valueset(vs_endpoint, VERSION_PROBE_ECL, 0)
+    return result.get('version') if not result.get('error') else None
+
+
+def check_release(vs_endpoint):
+    """Probe the version an endpoint serves and record it; returns the version or None"""
+    version = server_version(vs_endpoint)
+    if version:
+        observe_release(vs_endpoint, version)
+    return version
+
+
+def observe_release(vs_endpoint, version):
+    previous = releases.observe(vs_endpoint, version)
+    if previous is not None:
+        logger.info(f'{vs_endpoint} now serves {version} (was {previous}); '
+                    f'keeping the old release cached for {releases.overlap:.0f}s')
+
+
+def _maintain_releases(vs_endpoint):
+    """Drop entries whose overlap has ended and start a background probe when one is due"""
+    for endpoint, version in releases.take_expired():
+        dropped = expansion_cache.discard(endpoint, version)
+        logger.info(f'Dropped {dropped} cached expansions of {endpoint} for superseded release {version}')
+    if not local_engine.is_local(vs_endpoint) and releases.due_for_check(vs_endpoint):
+        _prefetch_executor.submit(check_release, vs_endpoint)
+
+
+def _expand_through_store(vs_endpoint, ecl_expr, count, version=None):
+    key = ExpansionCache.make_key(vs_endpoint, ecl_expr, count)
+    if expansion_store is None:
+        return single_flight.do(key, lambda: expand_valueset(vs_endpoint, ecl_expr, count),
+                                expired=deadline_exceeded)
+    result = expansion_store.get(vs_endpoint, ecl_expr, count, version)
+    if result is None:
+        result = single_flight.do(key, lambda: _expand_and_store(vs_endpoint, ecl_expr, count),
+                                  recheck=lambda: expansion_store.get(vs_endpoint, ecl_expr, count, version),
+                                  expired=deadline_exceeded)
+    return result
+
+
+def _expand_and_store(vs_endpoint, ecl_expr, count):
+    result = expand_valueset(vs_endpoint, ecl_expr, count)
+    expansion_store.put(vs_endpoint, ecl_expr, count, result)
+    return result
+
+
+def load_expansion_store(max_rows=None, preload_limit=None):
+    """
+    Compact the on-disk expansion store and preload the in-memory cache from it.
+    Called once at startup so a restart does not begin with a cold cache. Only
+    one worker process compacts; a compaction failure does not stop the preload.
+    """
+    if expansion_store is None:
+        return 0
+    try:
+        expansion_store.try_compact(max_rows)
+    except sqlite3.Error as e:
+        logger.error(f'Failed to compact expansion store {expansion_store.path}: {e}')
+    try:
+        for endpoint, version in expansion_store.current_versions().items():
+            releases.observe(endpoint, version)
+        return expansion_store.preload(expansion_cache, preload_limit or expansion_cache.max_entries)
+    except sqlite3.Error as e:
+        logger.error(f'Failed to load expansion store {expansion_store.path}: {e}')
+        return 0
+
+
+def expand_valueset(vs_endpoint, ecl_expr, count, offset=0):
     """
     Expand a ValueSet using ECL expression and return both total count and first N results
+    (or the N results starting at offset). count=0 is the count-only mode: the server is
+    asked for the total alone and no concepts are decoded.
+    """
+    if local_engine.is_local(vs_endpoint):
+        # Evaluate against a local RF2 snapshot instead of a terminology server
+        return local_engine.expand_valueset(vs_endpoint, ecl_expr, count, offset)
+    pool = endpoint_pool
+    if pool is not None and vs_endpoint in pool:
+        return pool.expand(ecl_expr, count, offset)
+    return _expand_remote(vs_endpoint, ecl_expr, count, offset)
+
+
+def configure_resilience(retries=None, backoff=None, breaker_threshold=None, breaker_reset=None):
+    """Override the retry and circuit breaker settings; breaker state is reset"""
+    global TX_RETRIES, TX_RETRY_BACKOFF, breakers
+    if retries is not None:
+        TX_RETRIES = int(retries)
+    if backoff is not None:
+        TX_RETRY_BACKOFF = float(backoff)
+    breakers = BreakerRegistry(breaker_threshold if breaker_threshold is not None else breakers.failure_threshold,
+                               breaker_reset if breaker_reset is not None else breakers.reset_timeout)
+
+
+def _expand_remote(vs_endpoint, ecl_expr, count, offset=0, cancelled=None, retries=None):
+    """
+    One $expand call to one server behind its circuit breaker, retried on
+    transport failures (TX_RETRIES times unless `retries` is given) within the
+    request deadline. Stops reading early once `cancelled` is set.
     """
+    breaker = breakers.get(_server(vs_endpoint))
+
+    def attempt():
+        if not breaker.allow():
+            return {
+                'total': -1,
+                'concepts': [],
+                'error': f'API request failed: circuit open for {breaker.name}, '
+                         f'retrying in {breaker.retry_after():.0f}s',
+                'circuit_open': True
+            }
+        try:
+            result = _request_expansion(vs_endpoint, ecl_expr, count, offset, cancelled)
+        except BaseException:
+            breaker.release()
+            raise
+        # Our own deadline or a cancelled hedge says nothing about the server's health
+        if result.get('deadline_exceeded') or (cancelled is not None and cancelled.is_set()):
+            breaker.release()
+        elif is_failure(result):
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        return result
+
+    return resilience.retry(attempt, lambda r: is_failure(r) and not r.get('circuit_open')
+                            and not r.get('deadline_exceeded'),
+                            TX_RETRIES if retries is None else retries, TX_RETRY_BACKOFF, cancelled=cancelled)
+
+
+def deadline_exceeded():
+    """The result of an expansion given up on because the request deadline passed"""
+    return {
+        'total': -1,
+        'concepts': [],
+        'error': 'API request failed: request deadline exceeded',
+        'deadline_exceeded': True
+    }
+
+
+def _request_expansion(vs_endpoint, ecl_expr, count, offset, cancelled):
+    left = resilience.remaining()
+    if left is not None and left <= 0:
+        return deadline_exceeded()
+    timeout = (TX_CONNECT_TIMEOUT, TX_READ_TIMEOUT) if left is None else \
+        (min(TX_CONNECT_TIMEOUT, left), min(TX_READ_TIMEOUT, left))
+
+    start = time.perf_counter()
     vsexp=vs_endpoint+'/ValueSet/$expand?url=http://snomed.info/sct?fhir_vs=ecl/'
     query=vsexp+parse.quote(ecl_expr,safe='')
     query = f"{query}&count={count}"
-    command = ['curl', '-H', 'Accept: application/fhir+json', '--location', query]
+    if offset:
+        query = f"{query}&offset={offset}"
+    profiling.record('encode', time.perf_counter() - start)
     
-    result = subprocess.run(command, capture_output=True)
-    
-    # Log the response for debugging
-    if result.returncode != 0:
-        logger.error(f'Curl command failed with return code {result.returncode}')
-        logger.error(f'stderr: {result.stderr.decode()}')
-        return {
+    endpoint = _server(vs_endpoint)
+    transfer = _Transfer()
+    status = 'error'
+    metrics.upstream_in_flight.inc(endpoint)
+    try:
+        _connect_time.seconds = 0.0
+        sent = time.perf_counter()
+        try:
+            response = get_session(vs_endpoint).get(query, timeout=timeout, stream=True)
+        finally:
+            # get() returns once the headers are in: connecting plus time to first byte
+            connect = _connect_time.seconds
+            if connect:
+                profiling.record('connect', connect)
+            profiling.record('ttfb', time.perf_counter() - sent - connect)
+        with response:
+            status = str(response.status_code)
+            if response.status_code >= 500:
+                logger.error(f'FHIR server returned HTTP {response.status_code}')
+                return {
+                    'total': -1,
+                    'concepts': [],
+                    'error': f'API request failed: server returned HTTP {response.status_code}'
+                }
+            # Decode while downloading; the body is never held in memory as a whole
+            # count=0 asks for the total only; nothing is decoded even if a server sends concepts anyway
+            decode_start = time.perf_counter()
+            result = decode_response(_guarded(response.iter_content(RESPONSE_CHUNK_SIZE), cancelled, transfer),
+                                     total_only=count == 0)
+            decode = time.perf_counter() - decode_start - transfer.wait
+            metrics.upstream_decode.observe(decode, endpoint)
+            profiling.record('download', transfer.wait)
+            profiling.record('decode', decode)
+            return result
+    except requests.RequestException as e:
+        if cancelled is not None and cancelled.is_set():
+            status = 'cancelled'
+        elif isinstance(e, requests.Timeout):
+            status = 'timeout'
+        else:
+            status = 'error'
+        logger.error(f'Request to FHIR server failed: {e}')
+        result = {
             'total': -1,
             'concepts': [],
-            'error': f'API request failed: {result.stderr.decode()}'
+            'error': f'API request failed: {e}'
         }
-    
-    if not result.stdout:
+        if left is not None and resilience.remaining() <= 0:
+            result['deadline_exceeded'] = True
+        return result
+    finally:
+        metrics.upstream_in_flight.dec(endpoint)
+        metrics.upstream_requests.inc(endpoint, status)
+        metrics.upstream_duration.observe(time.perf_counter() - start, endpoint)
+        if transfer.bytes:
+            metrics.upstream_bytes.inc(endpoint, amount=transfer.bytes)
+
+
+class _Transfer:
+    """Bytes received and time spent waiting on the network while a response is decoded"""
+
+    __slots__ = ('bytes', 'wait')
+
+    def __init__(self):
+        self.bytes = 0
+        self.wait = 0.0
+
+
+def _server(vs_endpoint):
+    url = parse.urlsplit(vs_endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def _guarded(chunks, cancelled, transfer=None):
+    """Stop a download once it is cancelled or the request deadline passes"""
+    chunks = iter(chunks)
+    while True:
+        started = time.perf_counter()
+        chunk = next(chunks, None)
+        if transfer is not None:
+            transfer.wait += time.perf_counter() - started
+        if chunk is None:
+            return
+        if transfer is not None:
+            transfer.bytes += len(chunk)
+        if cancelled is not None and cancelled.is_set():
+            raise requests.ConnectionError('Cancelled: another endpoint answered first')
+        left = resilience.remaining()
+        if left is not None and left <= 0:
+            raise requests.Timeout('Request deadline exceeded while reading the response')
+        yield chunk
+
+
+def iter_expansion(vs_endpoint, ecl_expr, page_size=1000):
+    """
+    Walk a full expansion page by page with offset/count, fetching the next page
+    in the background while the current one is consumed. Yields one result dict
+    ({total, concepts} or {error}) per page, so at most two pages are held in memory.
+    When the server does not report a total (-1), paging goes on until a page
+    comes back with fewer than page_size concepts.
+    """
+    offset = 0
+    future = resilience.submit(_prefetch_executor, expand_valueset, vs_endpoint, ecl_expr, page_size, offset)
+    try:
+        while future is not None:
+            page = future.result()
+            future = None
+            if page.get('error'):
+                yield page
+                return
+            offset += len(page['concepts'])
+            if page['total'] < 0:
+                more = len(page['concepts']) >= page_size
+            else:
+                more = offset < page['total']
+            if page['concepts'] and more:
+                future = resilience.submit(_prefetch_executor, expand_valueset, vs_endpoint, ecl_expr, page_size, offset)
+            yield page
+    finally:
+        if future is not None:
+            future.cancel()
+
+
+def parse_expansion(content):
+    """
+    Turn the raw body of a $expand response into the {total, concepts, error} result
+    """
+    return decode_response([content])
+
+
+def operation_outcome_message(issues):
+    """Join the diagnostics of OperationOutcome issues into one readable message"""
+    error_messages = []
+    for issue in issues:
+        diagnostics = issue.get('diagnostics', '')
+        if diagnostics:
+            # Clean up the error message
+            clean_msg = diagnostics
+            # Remove "error: " prefix
+            if clean_msg.lower().startswith('error: '):
+                clean_msg = clean_msg[7:]
+            # Remove GUID pattern [xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx]
+            clean_msg = GUID_PATTERN.sub('', clean_msg)
+            error_messages.append(clean_msg)
+    return '; '.join(error_messages) if error_messages else 'Invalid ECL expression'
+
+
+def decode_response(chunks, total_only=False):
+    """
+    Decode a $expand response body, given as an iterable of byte chunks, into
+    the {total, concepts, error} result without building the full JSON tree.
+    total_only skips concept decoding and leaves 'concepts' empty.
+    """
+    try:
+        decoded = decode_expansion(chunks, total_only=total_only)
+    except EmptyResponseError:
         logger.error('Empty response from FHIR server')
         return {
             'total': -1,
             'concepts': [],
             'error': 'Empty response from FHIR server'
         }
-    
-    try:
-        data = json.loads(result.stdout)
-    except json.JSONDecodeError as e:
+    except ValueError as e:
         logger.error(f'Failed to parse JSON response: {e}')
-        logger.error(f'Response content: {result.stdout.decode()[:500]}')
         return {
             'total': -1,
             'concepts': [],
@@ -62,81 +609,41 @@ def expand_valueset(vs_endpoint, ecl_expr, count):
         }
     
     # Check if the response is an OperationOutcome (error response)
-    if data.get('resourceType') == 'OperationOutcome':
-        # Extract error message from OperationOutcome
-        error_messages = []
-        issues = data.get('issue', [])
-        for issue in issues:
-            diagnostics = issue.get('diagnostics', '')
-            if diagnostics:
-                # Clean up the error message
-                clean_msg = diagnostics
-                # Remove "error: " prefix
-                if clean_msg.lower().startswith('error: '):
-                    clean_msg = clean_msg[7:]
-                # Remove GUID pattern [xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx]
-                import re
-                clean_msg = re.sub(r'\[[\da-f]{8}-[\da-f]{4}-[\da-f]{4}-[\da-f]{4}-[\da-f]{12}\]:\s*', '', clean_msg, flags=re.IGNORECASE)
-                error_messages.append(clean_msg)
-        
-        error_msg = '; '.join(error_messages) if error_messages else 'Invalid ECL expression'
+    if decoded['resourceType'] == 'OperationOutcome':
+        error_msg = operation_outcome_message(decoded.get('issue', []))
         logger.error(f'FHIR OperationOutcome: {error_msg}')
         return {
             'total': -1,
             'concepts': [],
-            'error': error_msg
+            'error': error_msg,
+            'operation_outcome': True
         }
     
-    try:
-        # Get total count
-        total_result = evaluate(data,"expansion.total")
-        total = -1
-        if total_result:
-            if isinstance(total_result, list) and len(total_result) > 0:
-                total = total_result[0]
-            elif not isinstance(total_result, list):
-                total = total_result
-        
-        # Get the actual concept results
-        concepts = []
-        contains_result = evaluate(data, "expansion.contains")
-        if contains_result and isinstance(contains_result, list):
-            for concept in contains_result:
-                code = ""
-                display = ""
-                
-                # Extract code
-                code_result = evaluate(concept, "code")
-                if code_result:
-                    if isinstance(code_result, list) and len(code_result) > 0:
-                        code = str(code_result[0])
-                    elif not isinstance(code_result, list):
-                        code = str(code_result)
-                
-                # Extract display
-                display_result = evaluate(concept, "display")
-                if display_result:
-                    if isinstance(display_result, list) and len(display_result) > 0:
-                        display = str(display_result[0])
-                    elif not isinstance(display_result, list):
-                        display = str(display_result)
-                
-                if code:  # Only add if we have a code
-                    concepts.append({
-                        'code': code,
-                        'display': display or code  # Use code as fallback if no display
-                    })
-        
-        return {
-            'total': total,
-            'concepts': concepts
-        }
-        
-    except Exception as e:
-        logger.error(f'Failed to retrieve data for ValueSet: {e}')
-        return {
-            'total': -1,
-            'concepts': [],
-            'error': str(e)
-        }
+    result = {
+        'total': decoded['total'],
+        'concepts': decoded['concepts']
+    }
+    if decoded.get('version'):
+        result['version'] = decoded['version']
+    return result
+
 
+@metrics.registry.collector
+def _collect_metrics():
+    """Cache, single-flight and circuit breaker figures, read from their own counters at scrape time"""
+    cache = expansion_cache.stats()
+    coalesced = single_flight.stats()
+    return [
+        ('ecl_cache_hits_total', 'counter', 'Expansion cache hits',
+         [({'kind': 'expansion'}, cache['hits']), ({'kind': 'negative'}, cache['negative_hits'])]),
+        ('ecl_cache_misses_total', 'counter', 'Expansion cache misses', [({}, cache['misses'])]),
+        ('ecl_cache_evictions_total', 'counter', 'Expansion cache evictions by reason',
+         [({'reason': reason}, count) for reason, count in cache['evictions'].items()]),
+        ('ecl_cache_entries', 'gauge', 'Entries in the expansion cache',
+         [({'kind': 'expansion'}, cache['entries']), ({'kind': 'negative'}, cache['negative_entries'])]),
+        ('ecl_cache_bytes', 'gauge', 'Approximate size of the cached expansions', [({}, cache['bytes'])]),
+        ('ecl_single_flight_coalesced_total', 'counter', 'Expansions that shared another caller\'s upstream call',
+         [({'scope': 'thread'}, coalesced['coalesced']), ({'scope': 'process'}, coalesced['process_coalesced'])]),
+        ('ecl_circuit_breaker_open', 'gauge', 'Whether a terminology server\'s circuit breaker is open',
+         [({'endpoint': breaker['endpoint']}, int(breaker['state'] == 'open')) for breaker in breakers.stats()])
+    ]
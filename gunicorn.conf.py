@@ -0,0 +1,43 @@
+"""
+Production serving: gunicorn -c gunicorn.conf.py main:app
+
+Worker processes default to one per available core. Each runs gevent, so
+upstream $expand calls (requests/urllib3 sockets) yield while they wait and
+one process holds hundreds of in-flight expansions instead of one per
+thread. On SIGTERM gunicorn stops accepting connections and lets in-flight
+requests finish for GRACEFUL_TIMEOUT seconds; the worker_exit hook then
+stops the cache warmer and drains background page fetches and refreshes.
+"""
+
+import os
+
+
+def _cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5001')}"
+
+# WEB_CONCURRENCY is the worker count most hosts (including render.com) set
+workers = int(os.getenv("WEB_CONCURRENCY", 0)) or _cores()
+worker_class = os.getenv("WORKER_CLASS", "gevent")
+# Concurrent requests per worker (gevent); REQUEST_TIMEOUT still bounds each one
+worker_connections = int(os.getenv("WORKER_CONNECTIONS", 500))
+
+# Keep-alive connections per terminology server in each worker (read by fetcher.py when the
+# worker imports it); with gevent many more calls are in flight at once than under threads
+os.environ.setdefault("TX_POOL_SIZE", "100")
+
+# Longer than REQUEST_TIMEOUT, so a draining worker lets its slowest expansion finish
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", 0)) or int(float(os.getenv("REQUEST_TIMEOUT", 30))) + 5
+timeout = int(os.getenv("WORKER_TIMEOUT", 60))
+keepalive = 5
+
+
+def worker_exit(server, worker):
+    import main
+
+    main.shutdown(timeout=graceful_timeout)
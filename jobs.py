@@ -0,0 +1,407 @@
+"""
+Background jobs for work that outlasts an HTTP request.
+
+A client submits a job - a full expansion or a batch of expressions - and
+gets its ID straight away, then polls (or subscribes to) its progress and
+fetches the result once it has finished. Jobs live in a SQLite store, so
+queued work survives a restart and every worker process shares one queue.
+
+A JobRunner runs jobs on a fixed number of threads. Claiming a job takes a
+lease that the runner renews whenever the job reports progress; a job whose
+lease lapses (its worker process crashed or was killed) is queued again and
+picked up by the next free thread, up to `max_attempts` times. Finished jobs
+are deleted `ttl` seconds after they finish.
+
+A job whose output can be large (a full expansion) does not return it in one
+piece: it hands each page to its progress report, which appends it to the
+job's output in the store as one row, and readers fetch the output back a
+row at a time. Neither the job nor the reader holds all of it in memory.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import resilience
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED = (DONE, FAILED, CANCELLED)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id          TEXT PRIMARY KEY,
+    kind        TEXT NOT NULL,
+    params      TEXT NOT NULL,
+    state       TEXT NOT NULL,
+    done        INTEGER NOT NULL DEFAULT 0,
+    total       INTEGER,
+    result      TEXT,
+    error       TEXT,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    owner       TEXT,
+    lease_until REAL,
+    created_at  REAL NOT NULL,
+    started_at  REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created_at);
+CREATE TABLE IF NOT EXISTS job_output (
+    job_id      TEXT NOT NULL,
+    seq         INTEGER NOT NULL,
+    items       TEXT NOT NULL,
+    PRIMARY KEY (job_id, seq)
+) WITHOUT ROWID;
+"""
+
+
+class JobCancelled(Exception):
+    """Raised from a job's progress callback once the job should stop"""
+
+
+class JobStore:
+    """SQLite-backed job queue, progress and results, shared by every worker process"""
+
+    def __init__(self, path, clock=time.time):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._clock = clock
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    @resilience.offloaded
+    def submit(self, kind, params):
+        """Queue a job; returns its ID"""
+        job_id = uuid.uuid4().hex
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, params, state, created_at) VALUES (?, ?, ?, ?, ?)',
+                (job_id, kind, json.dumps(params, separators=(',', ':')), QUEUED, self._clock()))
+        return job_id
+
+    @resilience.offloaded
+    def claim(self, owner, lease, max_attempts=3):
+        """
+        Take the oldest queued job, or one whose lease has lapsed, for `lease`
+        seconds. Returns {'id', 'kind', 'params', 'attempts'} or None. Jobs that
+        have already been attempted `max_attempts` times are failed instead.
+        """
+        now = self._clock()
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'UPDATE jobs SET state = ?, error = ?, finished_at = ?, owner = NULL '
+                'WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                (FAILED, 'The worker running this job stopped', now, RUNNING, now, max_attempts))
+            # One statement picks and takes the job, so two workers never claim the same one
+            claimed = conn.execute(
+                'UPDATE jobs SET state = ?, owner = ?, lease_until = ?, attempts = attempts + 1, '
+                'started_at = COALESCE(started_at, ?) '
+                'WHERE id = (SELECT id FROM jobs WHERE state = ? OR (state = ? AND lease_until < ?) '
+                'ORDER BY created_at LIMIT 1)',
+                (RUNNING, owner, now + lease, now, QUEUED, RUNNING, now)).rowcount
+            if not claimed:
+                return None
+            row = conn.execute(
+                'SELECT id, kind, params, attempts FROM jobs WHERE owner = ? AND state = ?',
+                (owner, RUNNING)).fetchone()
+            # Output from an earlier attempt would be repeated by this one
+            conn.execute('DELETE FROM job_output WHERE job_id = ?', (row[0],))
+        return {'id': row[0], 'kind': row[1], 'params': json.loads(row[2]), 'attempts': row[3]}
+
+    @resilience.offloaded
+    def progress(self, job_id, owner, done, total, lease, output=None):
+        """
+        Record progress and renew the lease; False once the job is no longer
+        this owner's to run. A non-empty `output` list is appended to the
+        job's output in the same transaction.
+        """
+        conn = self._connect()
+        with conn:
+            running = conn.execute(
+                'UPDATE jobs SET done = ?, total = ?, lease_until = ? WHERE id = ? AND owner = ? AND state = ?',
+                (done, total, self._clock() + lease, job_id, owner, RUNNING)).rowcount > 0
+            if running and output:
+                conn.execute(
+                    'INSERT INTO job_output (job_id, seq, items) '
+                    'SELECT ?, COALESCE(MAX(seq) + 1, 0), ? FROM job_output WHERE job_id = ?',
+                    (job_id, json.dumps(output, separators=(',', ':')), job_id))
+        return running
+
+    @resilience.offloaded
+    def renew(self, job_id, owner, lease):
+        """Extend the lease of a job this owner is running; False once it is no longer theirs"""
+        conn = self._connect()
+        with conn:
+            return conn.execute(
+                'UPDATE jobs SET lease_until = ? WHERE id = ? AND owner = ? AND state = ?',
+                (self._clock() + lease, job_id, owner, RUNNING)).rowcount > 0
+
+    @resilience.offloaded
+    def finish(self, job_id, owner, result=None, error=None):
+        """Store the outcome of a job this owner ran"""
+        payload = json.dumps(result, separators=(',', ':')) if result is not None else None
+        conn = self._connect()
+        with conn:
+            finished = conn.execute(
+                'UPDATE jobs SET state = ?, result = ?, error = ?, finished_at = ?, owner = NULL '
+                'WHERE id = ? AND owner = ? AND state = ?',
+                (FAILED if error else DONE, payload, error, self._clock(), job_id, owner, RUNNING)).rowcount > 0
+            if finished and error:
+                conn.execute('DELETE FROM job_output WHERE job_id = ?', (job_id,))
+        return finished
+
+    @resilience.offloaded
+    def release(self, job_id, owner):
+        """Put a job this owner could not finish (e.g. at shutdown) back on the queue"""
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                'UPDATE jobs SET state = ?, owner = NULL, lease_until = NULL WHERE id = ? AND owner = ? AND state = ?',
+                (QUEUED, job_id, owner, RUNNING))
+
+    @resilience.offloaded
+    def cancel(self, job_id):
+        """Cancel a queued or running job; False if it had already finished or does not exist"""
+        conn = self._connect()
+        with conn:
+            cancelled = conn.execute(
+                'UPDATE jobs SET state = ?, finished_at = ?, owner = NULL WHERE id = ? AND state IN (?, ?)',
+                (CANCELLED, self._clock(), job_id, QUEUED, RUNNING)).rowcount > 0
+            if cancelled:
+                conn.execute('DELETE FROM job_output WHERE job_id = ?', (job_id,))
+        return cancelled
+
+    @staticmethod
+    def _status(row):
+        job_id, kind, state, done, total, error, attempts, created_at, started_at, finished_at = row
+        return {
+            'id': job_id,
+            'type': kind,
+            'state': state,
+            'progress': {'done': done, 'total': total},
+            'error': error,
+            'attempts': attempts,
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at
+        }
+
+    _STATUS_COLUMNS = 'id, kind, state, done, total, error, attempts, created_at, started_at, finished_at'
+
+    @resilience.offloaded
+    def get(self, job_id):
+        """Status of a job without its result, or None"""
+        row = self._connect().execute(
+            f'SELECT {self._STATUS_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._status(row) if row else None
+
+    @resilience.offloaded
+    def result(self, job_id):
+        """The result of a finished job, or None"""
+        row = self._connect().execute('SELECT result FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    @resilience.offloaded
+    def output(self, job_id, seq):
+        """Items of a job's output row `seq` (numbered from 0), or None past the last row"""
+        row = self._connect().execute(
+            'SELECT items FROM job_output WHERE job_id = ? AND seq = ?', (job_id, seq)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @resilience.offloaded
+    def recent(self, limit=50):
+        """Status of the most recently submitted jobs"""
+        rows = self._connect().execute(
+            f'SELECT {self._STATUS_COLUMNS} FROM jobs ORDER BY created_at DESC LIMIT ?', (int(limit),))
+        return [self._status(row) for row in rows]
+
+    @resilience.offloaded
+    def purge(self, ttl):
+        """Delete jobs that finished more than `ttl` seconds ago; returns the number removed"""
+        conn = self._connect()
+        with conn:
+            removed = conn.execute(
+                f'DELETE FROM jobs WHERE state IN ({", ".join("?" * len(FINISHED))}) AND finished_at < ?',
+                (*FINISHED, self._clock() - ttl)).rowcount
+            if removed:
+                conn.execute('DELETE FROM job_output WHERE job_id NOT IN (SELECT id FROM jobs)')
+        return removed
+
+    @resilience.offloaded
+    def stats(self):
+        counts = dict(self._connect().execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+        return {'path': self.path, **{state: counts.get(state, 0) for state in (QUEUED, RUNNING) + FINISHED}}
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class JobRunner:
+    """
+    Runs jobs from a JobStore on `workers` threads.
+
+    `handlers` maps a job type to handler(params, progress) returning the
+    job's (JSON-serializable) result. Handlers call progress(done, total) as
+    they go, which renews the lease and raises JobCancelled once the job has
+    been cancelled or the runner is stopping; progress(done, total, output)
+    also appends a list of items to the job's output. Each job runs under a
+    resilience deadline of `timeout` seconds.
+    """
+
+    def __init__(self, store, handlers, workers=2, lease=60.0, ttl=86400.0, timeout=3600.0, max_attempts=3,
+                 poll_interval=1.0, clock=time.time):
+        self.store = store
+        self.handlers = handlers
+        self.workers = workers
+        self.lease = lease
+        self.ttl = ttl
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._clock = clock
+        self._owner = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = {}  # job id -> owner token
+        self._completed = 0
+        self._failed = 0
+
+    def start(self):
+        if not self._threads:
+            self._stop.clear()
+            self._threads = [threading.Thread(target=self._work, name=f'job-{i}', daemon=True)
+                             for i in range(self.workers)]
+            self._threads.append(threading.Thread(target=self._maintain, name='job-maintenance', daemon=True))
+            for thread in self._threads:
+                thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        """
+        Stop claiming jobs and let running ones reach their next progress
+        report; jobs that have not finished by then go back on the queue.
+        Waits at most `timeout` seconds in all.
+        """
+        self._stop.set()
+        self._wake.set()
+        until = None if timeout is None else time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(None if until is None else max(0.0, until - time.monotonic()))
+        self._threads = []
+
+    def submit(self, kind, params):
+        """Queue a job and wake an idle worker; returns the job ID"""
+        if kind not in self.handlers:
+            raise ValueError(f'Unknown job type: {kind}')
+        job_id = self.store.submit(kind, params)
+        self._wake.set()
+        return job_id
+
+    def cancel(self, job_id):
+        return self.store.cancel(job_id)
+
+    def _work(self):
+        while not self._stop.is_set():
+            # Every claim has its own owner token, so a job re-claimed after its lease lapsed
+            # cannot be finished by the thread that lost it
+            owner = f'{self._owner}-{uuid.uuid4().hex[:8]}'
+            try:
+                job = self.store.claim(owner, self.lease, self.max_attempts)
+            except sqlite3.Error as e:
+                logger.error(f'Claiming a job failed: {e}')
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+                continue
+            self.run(job, owner)
+
+    def run(self, job, owner):
+        """Run one claimed job to completion, cancellation or release"""
+        job_id = job['id']
+        with self._lock:
+            self._running[job_id] = owner
+        logger.info(f'Running {job["kind"]} job {job_id} (attempt {job["attempts"]})')
+        start = time.perf_counter()
+
+        def progress(done, total=None, output=None):
+            if self._stop.is_set():
+                raise JobCancelled('Runner is stopping')
+            if not self.store.progress(job_id, owner, done, total, self.lease, output):
+                raise JobCancelled('Job was cancelled')
+
+        try:
+            with resilience.deadline(self.timeout):
+                result = self.handlers[job['kind']](job['params'], progress)
+        except JobCancelled:
+            if self._stop.is_set():
+                self.store.release(job_id, owner)
+                logger.info(f'Job {job_id} returned to the queue at shutdown')
+            else:
+                logger.info(f'Job {job_id} cancelled')
+            return
+        except Exception as e:
+            logger.error(f'Job {job_id} failed: {e}')
+            self.store.finish(job_id, owner, error=str(e))
+            with self._lock:
+                self._failed += 1
+            return
+        finally:
+            with self._lock:
+                self._running.pop(job_id, None)
+        if not self.store.finish(job_id, owner, result=result):
+            logger.info(f'Job {job_id} finished after it was cancelled; result discarded')
+            return
+        with self._lock:
+            self._completed += 1
+        logger.info(f'Job {job_id} finished in {time.perf_counter() - start:.1f}s')
+
+    def _maintain(self):
+        """Renew the leases of running jobs (handlers may go a while between progress reports) and purge old ones"""
+        next_purge = 0.0
+        while not self._stop.wait(self.lease / 3):
+            with self._lock:
+                running = list(self._running.items())
+            for job_id, owner in running:
+                self.store.renew(job_id, owner, self.lease)
+            if self._clock() >= next_purge:
+                removed = self.store.purge(self.ttl)
+                if removed:
+                    logger.info(f'Purged {removed} finished jobs')
+                next_purge = self._clock() + min(self.ttl, 3600.0)
+
+    def stats(self):
+        with self._lock:
+            running = len(self._running)
+            completed, failed = self._completed, self._failed
+        return {
+            'workers': self.workers,
+            'running_here': running,
+            'completed_here': completed,
+            'failed_here': failed,
+            'store': self.store.stats()
+        }
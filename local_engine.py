@@ -0,0 +1,435 @@
+"""
+Offline ECL evaluation over a SNOMED CT RF2 snapshot.
+
+An alternative backend to the remote terminology server, selected with a
+`local://` endpoint: `local://` uses the snapshot at LOCAL_RF2_PATH and
+`local:///path/to/snapshot` names one explicitly, which must lie under
+LOCAL_RF2_PATH or one of the LOCAL_RF2_ROOTS directories. The path is either an RF2
+snapshot directory, loaded into memory on first use, or a file written by
+compiled_snapshot.py, which is memory-mapped. ECL is evaluated against it
+locally, returning the same {total, concepts, version} result as
+fetcher.expand_valueset.
+
+Supported: all constraint operators, member-of, AND/OR/MINUS, attribute
+refinements (groups, cardinality, reverse, concrete values), dotted
+attributes, description term/type/language filters and concept
+active/moduleId/definitionStatus filters. Member filters and history
+supplements are reported as unsupported.
+"""
+
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import ecl_parser
+from closure_index import bits_from_ordinals, iter_ordinals
+from ecl_parser import (AlternateIdentifier, AttributeGroup, Compound, ConceptReference,
+                        ConcreteValue, Dotted, EclSyntaxError, HistorySupplement, Refined,
+                        RefinementCompound, SubExpression, Wildcard)
+from compiled_snapshot import CompiledSnapshot
+from rf2_snapshot import Rf2Snapshot
+
+logger = logging.getLogger(__name__)
+
+LOCAL_SCHEME = 'local://'
+LOCAL_RF2_PATH = os.getenv("LOCAL_RF2_PATH", "./rf2")
+# Directories (os.pathsep-separated) under which an endpoint may name other snapshots
+LOCAL_RF2_ROOTS = tuple(root for root in os.getenv("LOCAL_RF2_ROOTS", "").split(os.pathsep) if root)
+# Loaded snapshots kept in memory, least recently used dropped first
+LOCAL_MAX_SNAPSHOTS = int(os.getenv("LOCAL_MAX_SNAPSHOTS", 4))
+
+FSN = 900000000000003001
+SYNONYM = 900000000000013009
+DEFINITION = 900000000000550004
+PRIMITIVE = 900000000000074008
+DEFINED = 900000000000073002
+DESCRIPTION_TYPES = {'fsn': FSN, 'syn': SYNONYM, 'def': DEFINITION}
+DEFINITION_STATUSES = {'primitive': PRIMITIVE, 'defined': DEFINED}
+
+_WORD_RE = re.compile(r'\w+')
+
+
+class LocalEngineError(ValueError):
+    """An expression the local engine cannot evaluate"""
+
+
+def is_local(vs_endpoint):
+    return vs_endpoint.startswith(LOCAL_SCHEME)
+
+
+def snapshot_path(vs_endpoint):
+    """
+    Resolved snapshot directory or compiled file named by a local:// endpoint.
+    Endpoints come from clients, so a path outside LOCAL_RF2_PATH and
+    LOCAL_RF2_ROOTS raises LocalEngineError before anything is read.
+    """
+    path = os.path.realpath(vs_endpoint[len(LOCAL_SCHEME):].rstrip('/') or LOCAL_RF2_PATH)
+    for root in (LOCAL_RF2_PATH,) + LOCAL_RF2_ROOTS:
+        root = os.path.realpath(root)
+        if path == root or path.startswith(root.rstrip(os.sep) + os.sep):
+            return path
+    raise LocalEngineError(f'{path} is outside LOCAL_RF2_PATH and LOCAL_RF2_ROOTS')
+
+
+def open_snapshot(path):
+    """A compiled snapshot file is memory-mapped; a directory is loaded from the RF2 text files"""
+    if os.path.isfile(path):
+        return CompiledSnapshot(path)
+    return Rf2Snapshot(path)
+
+
+class LocalEngine:
+    """
+    Evaluates parsed ECL over an Rf2Snapshot or a CompiledSnapshot. Constraint
+    operators and compounds run as bitmap operations on the snapshot's
+    closure index; refinements and filters work on sets of concept ids.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.version = data.version
+
+    # -- hierarchy ----------------------------------------------------------
+
+    def _apply_operator(self, operator, focus, wildcard):
+        """Apply a constraint operator to a focus bitmap over closure ordinals"""
+        closure = self.data.closure()
+        if wildcard:
+            # Operators applied to every concept reduce to structural checks
+            if operator in ('descendantOf', 'childOf'):
+                return closure.all_bits & ~closure.roots()
+            if operator in ('ancestorOf', 'parentOf'):
+                return closure.all_bits & ~closure.leaves()
+            if operator == 'top':
+                return closure.roots()
+            if operator == 'bottom':
+                return closure.leaves()
+            return closure.all_bits
+
+        ordinals = list(iter_ordinals(focus))
+        if operator in ('descendantOf', 'descendantOrSelfOf'):
+            return closure.descendants_of(ordinals, include_self=operator == 'descendantOrSelfOf')
+        if operator in ('ancestorOf', 'ancestorOrSelfOf'):
+            return closure.ancestors_of(ordinals, include_self=operator == 'ancestorOrSelfOf')
+        if operator in ('childOf', 'childOrSelfOf'):
+            result = closure.bits(child for ordinal in ordinals for child in self.data.children(closure.order[ordinal]))
+        elif operator in ('parentOf', 'parentOrSelfOf'):
+            result = bits_from_ordinals((parent for ordinal in ordinals for parent in closure.parent_ordinals(ordinal)),
+                                        closure.size)
+        elif operator == 'top':
+            # Focus concepts below another focus concept are exactly the nested descendants
+            return focus & ~closure.descendants_of(ordinals)
+        elif operator == 'bottom':
+            return focus & ~closure.ancestors_of(ordinals)
+        else:
+            result = 0
+        if operator.endswith('OrSelfOf'):
+            result |= focus
+        return result
+
+    # -- evaluation ---------------------------------------------------------
+
+    def bits(self, node):
+        """
+        Bitmap over closure ordinals of the active concepts matched by a parsed
+        ECL expression. Constraint operators and AND/OR/MINUS stay in bitmap
+        form; refinements and dotted attributes go through concept id sets.
+        """
+        if isinstance(node, SubExpression):
+            return self._sub_expression(node)
+        if isinstance(node, Compound):
+            left, *rest = [self.bits(operand) for operand in node.operands]
+            for right in rest:
+                if node.operator == 'and':
+                    left &= right
+                elif node.operator == 'or':
+                    left |= right
+                else:
+                    left &= ~right
+            return left
+        return self.data.closure().bits(self.evaluate(node))
+
+    def evaluate(self, node):
+        """Set of concept ids matched by a parsed ECL expression"""
+        if isinstance(node, (SubExpression, Compound)):
+            return set(self.data.closure().sctids(self.bits(node)))
+        if isinstance(node, Refined):
+            candidates = self.evaluate(node.expression)
+            return self._refine(candidates, node.refinement)
+        if isinstance(node, Dotted):
+            result = self.evaluate(node.expression)
+            for attribute in node.attributes:
+                types = self.evaluate(attribute)
+                result = {destination for sctid in result for group, type_id, destination
+                          in self.data.outgoing(sctid) if type_id in types}
+            return result
+        raise LocalEngineError(f'Unsupported expression {type(node).__name__}')
+
+    def _sub_expression(self, node):
+        closure = self.data.closure()
+        focus = node.focus
+        wildcard = isinstance(focus, Wildcard) and not node.member_of
+        if isinstance(focus, AlternateIdentifier):
+            raise LocalEngineError('Alternate identifiers are not supported by the local engine')
+
+        if node.member_of:
+            if isinstance(focus, Wildcard):
+                refsets = self.data.refsets()
+            elif isinstance(focus, ConceptReference):
+                refsets = (int(focus.sctid),)
+            else:
+                refsets = closure.sctids(self.bits(focus))
+            result = closure.bits(member for refset in refsets for member in self.data.members(refset))
+        elif isinstance(focus, ConceptReference):
+            result = closure.bits((int(focus.sctid),))
+        elif isinstance(focus, Wildcard):
+            result = closure.all_bits
+        else:
+            result = self.bits(focus)
+
+        if node.operator:
+            result = self._apply_operator(node.operator, result, wildcard)
+        if node.filters:
+            concepts = set(closure.sctids(result))
+            for constraint in node.filters:
+                concepts = self._filter(concepts, constraint)
+            result = closure.bits(concepts)
+        return result
+
+    # -- refinements --------------------------------------------------------
+
+    def _refine(self, candidates, refinement):
+        prepared = {}
+        return {sctid for sctid in candidates
+                if self._satisfies(refinement, self.data.outgoing(sctid), self.data.concrete(sctid), sctid, prepared)}
+
+    def _satisfies(self, refinement, relationships, concrete, sctid, prepared):
+        if isinstance(refinement, RefinementCompound):
+            test = all if refinement.operator == 'and' else any
+            return test(self._satisfies(operand, relationships, concrete, sctid, prepared)
+                        for operand in refinement.operands)
+        if isinstance(refinement, AttributeGroup):
+            matched = sum(1 for group_relationships, group_concrete in self._groups(relationships, concrete)
+                          if self._satisfies(refinement.refinement, group_relationships, group_concrete,
+                                             sctid, prepared))
+            return self._in_cardinality(matched, refinement.cardinality)
+        return self._in_cardinality(self._attribute_count(refinement, relationships, concrete, sctid, prepared),
+                                    refinement.cardinality)
+
+    @staticmethod
+    def _groups(relationships, concrete):
+        """Relationships split into role groups; each ungrouped relationship is a group of its own"""
+        groups = {}
+        singles = []
+        for relationship in relationships:
+            if relationship[0]:
+                groups.setdefault(relationship[0], ([], []))[0].append(relationship)
+            else:
+                singles.append(([relationship], []))
+        for value in concrete:
+            if value[0]:
+                groups.setdefault(value[0], ([], []))[1].append(value)
+            else:
+                singles.append(([], [value]))
+        return list(groups.values()) + singles
+
+    @staticmethod
+    def _in_cardinality(count, cardinality):
+        if cardinality is None:
+            return count >= 1
+        return cardinality.min <= count and (cardinality.max is None or count <= cardinality.max)
+
+    def _attribute_count(self, attribute, relationships, concrete, sctid, prepared):
+        key = id(attribute)
+        sets = prepared.get(key)
+        if sets is None:
+            types = self.evaluate(attribute.name)
+            values = attribute.value if isinstance(attribute.value, ConcreteValue) else self.evaluate(attribute.value)
+            sets = prepared[key] = (types, values)
+        types, values = sets
+
+        if isinstance(values, ConcreteValue):
+            return sum(1 for group, type_id, value in concrete
+                       if type_id in types and self._compare(value, attribute.operator, values))
+        if attribute.reverse:
+            relationships = self.data.incoming(sctid)
+        if attribute.operator == '=':
+            return sum(1 for group, type_id, other in relationships if type_id in types and other in values)
+        if attribute.operator == '!=':
+            return sum(1 for group, type_id, other in relationships if type_id in types and other not in values)
+        raise LocalEngineError(f'Operator {attribute.operator} needs a numeric value')
+
+    @staticmethod
+    def _compare(actual, operator, expected):
+        target = expected.value
+        if expected.kind == 'numeric':
+            if isinstance(actual, bool) or not isinstance(actual, (int, float)):
+                return False
+            return {'=': actual == target, '!=': actual != target, '<': actual < target,
+                    '<=': actual <= target, '>': actual > target, '>=': actual >= target}[operator]
+        if expected.kind == 'string':
+            equal = isinstance(actual, str) and actual == target
+        else:
+            equal = isinstance(actual, bool) and actual == target
+        return equal == (operator == '=')
+
+    # -- filters ------------------------------------------------------------
+
+    def _filter(self, concepts, constraint):
+        if isinstance(constraint, HistorySupplement):
+            raise LocalEngineError('History supplements are not supported by the local engine')
+        if constraint.domain == 'M':
+            raise LocalEngineError('Member filters are not supported by the local engine')
+        if constraint.domain == 'C':
+            tests = [self._concept_test(condition) for condition in constraint.conditions]
+            combine = all if constraint.conjunction == 'and' else any
+            return {c for c in concepts if combine(test(c) for test in tests)}
+
+        tests = [self._description_test(condition) for condition in constraint.conditions]
+        combine = all if constraint.conjunction == 'and' else any
+        # A concept passes if one of its descriptions passes every condition
+        return {c for c in concepts
+                if any(combine(test(description) for test in tests) for description in self.data.descriptions(c))}
+
+    def _values(self, value):
+        """Flatten a filter value into a list of strings, ConcreteValues and concept id sets"""
+        if isinstance(value, list):
+            return [v for item in value for v in self._values(item)]
+        if isinstance(value, tuple):
+            raise LocalEngineError('Dialect acceptability is not supported by the local engine')
+        if isinstance(value, (str, ConcreteValue)):
+            return [value]
+        return [self.evaluate(value)]
+
+    def _concept_test(self, condition):
+        name = condition.name.lower()
+        negate = condition.operator == '!='
+        values = self._values(condition.value)
+        if name == 'active':
+            wanted = values[0].value if isinstance(values[0], ConcreteValue) else values[0] in ('1', 'true')
+            return lambda c: (self.data.is_active(c) == wanted) != negate
+        if name in ('moduleid', 'definitionstatusid', 'definitionstatus'):
+            allowed = set()
+            for value in values:
+                if isinstance(value, set):
+                    allowed |= value
+                elif str(value).lower() in DEFINITION_STATUSES:
+                    allowed.add(DEFINITION_STATUSES[str(value).lower()])
+            attribute = self.data.module if name == 'moduleid' else self.data.definition_status
+            return lambda c: (attribute(c) in allowed) != negate
+        raise LocalEngineError(f'Concept filter {condition.name!r} is not supported by the local engine')
+
+    def _description_test(self, condition):
+        name = condition.name.lower()
+        negate = condition.operator == '!='
+        values = self._values(condition.value)
+        if name == 'term':
+            matchers = [self._term_matcher(value) for value in values]
+            return lambda d: any(matcher(d[2]) for matcher in matchers) != negate
+        if name in ('type', 'typeid'):
+            allowed = set()
+            for value in values:
+                if isinstance(value, set):
+                    allowed |= value
+                elif str(value).lower() in DESCRIPTION_TYPES:
+                    allowed.add(DESCRIPTION_TYPES[str(value).lower()])
+                else:
+                    raise LocalEngineError(f'Unknown description type {value!r}')
+            return lambda d: (d[0] in allowed) != negate
+        if name == 'language':
+            languages = {str(value).lower() for value in values}
+            return lambda d: (d[1].lower() in languages) != negate
+        raise LocalEngineError(f'Description filter {condition.name!r} is not supported by the local engine')
+
+    @staticmethod
+    def _term_matcher(value):
+        if not isinstance(value, ConcreteValue) or value.kind != 'string':
+            raise LocalEngineError('Term filters need a quoted string')
+        if value.match == 'wild':
+            pattern = re.compile('.*'.join(re.escape(part) for part in value.value.split('*')), re.IGNORECASE)
+            return lambda term: pattern.fullmatch(term) is not None
+        # match: every search word is a prefix of some word in the term
+        words = [w.lower() for w in _WORD_RE.findall(value.value)]
+
+        def matcher(term):
+            term_words = [w.lower() for w in _WORD_RE.findall(term)]
+            return all(any(t.startswith(word) for t in term_words) for word in words)
+        return matcher
+
+    # -- expansion ----------------------------------------------------------
+
+    def expand(self, ecl_expr, count, offset=0):
+        """Evaluate an expression into the {total, concepts, version} result of expand_valueset"""
+        try:
+            matched = self.bits(ecl_parser.parse(ecl_expr))
+        except (EclSyntaxError, LocalEngineError) as e:
+            logger.error(f'Local ECL evaluation failed: {e}')
+            return {
+                'total': -1,
+                'concepts': [],
+                'error': str(e),
+                'operation_outcome': True
+            }
+        # Pages follow the hierarchy (preorder) order of the closure index
+        page = self.data.closure().sctids(matched, offset, count) if count else []
+        result = {
+            'total': matched.bit_count(),
+            'concepts': [{'code': str(c), 'display': self.data.display(c) or str(c)} for c in page]
+        }
+        if self.version:
+            result['version'] = self.version
+        return result
+
+
+_engines = OrderedDict()  # path -> LocalEngine, least recently used first
+_engines_lock = threading.Lock()
+_loading = {}  # path -> lock held while that snapshot loads
+
+
+def get_engine(vs_endpoint):
+    """
+    Shared engine for the snapshot named by a local:// endpoint, loaded on
+    first use. Each path loads under its own lock, so a slow load does not
+    hold up requests for snapshots that are already in memory.
+    """
+    path = snapshot_path(vs_endpoint)
+    with _engines_lock:
+        engine = _engines.get(path)
+        if engine is not None:
+            _engines.move_to_end(path)
+            return engine
+        loading = _loading.setdefault(path, threading.Lock())
+    with loading:
+        with _engines_lock:
+            engine = _engines.get(path)
+        if engine is not None:
+            return engine
+        try:
+            engine = LocalEngine(open_snapshot(path))
+        except BaseException:
+            with _engines_lock:
+                _loading.pop(path, None)
+            raise
+        with _engines_lock:
+            _engines[path] = engine
+            _loading.pop(path, None)
+            while len(_engines) > LOCAL_MAX_SNAPSHOTS:
+                _engines.popitem(last=False)
+    return engine
+
+
+def expand_valueset(vs_endpoint, ecl_expr, count, offset=0):
+    """expand_valueset for local:// endpoints"""
+    try:
+        engine = get_engine(vs_endpoint)
+    except (OSError, ValueError) as e:
+        # The details name server paths, so they stay in the log
+        logger.error(f'Failed to load RF2 snapshot for {vs_endpoint}: {e}')
+        return {
+            'total': -1,
+            'concepts': [],
+            'error': 'Local terminology unavailable: no usable snapshot at this endpoint'
+        }
+    return engine.expand(ecl_expr, count, offset)
@@ -1,9 +1,27 @@
 import os
-import glob
-from flask import Flask, render_template, request, jsonify, send_from_directory
+import csv
+import functools
+import io
+import itertools
+import json
+import math
+import time
+from flask import Flask, Response, g, render_template, request, jsonify, send_from_directory, stream_with_context
 from dotenv import load_dotenv
 import logging
 import fetcher
+import batch
+import metrics
+import profiling
+from profiling import profiler
+import ecl_parser
+import resilience
+from query_planner import planner
+from cache_warmer import CacheWarmer, InteractiveGate
+from jobs import JobRunner, JobStore
+from ecl_canonical import collapse_report
+from ecl_catalog import EclCatalog
+from search_index import SearchIndex
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,49 +42,160 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(filename=LOGFILE_NAME, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger.info('Flask application started')
 
-def read_ecl_files():
-    """Read all ECL files from the ecl_library directory and extract expressions"""
-    ecl_files = []
-    
-    # Find all .txt files in ecl_library subdirectories
-    pattern = os.path.join('ecl_library', '**', '*.txt')
-    files = glob.glob(pattern, recursive=True)
-    
-    for file_path in files:
+# Warm the expansion cache from the on-disk store so restarts start hot
+fetcher.load_expansion_store()
+
+# Page size used when streaming full expansions
+STREAM_PAGE_SIZE = int(os.getenv("STREAM_PAGE_SIZE", 1000))
+STREAM_MAX_PAGE_SIZE = int(os.getenv("STREAM_MAX_PAGE_SIZE", 5000))
+
+# Split compound expressions and combine shared sub-expressions locally; a request can also ask with "plan": true
+QUERY_PLANNER = os.getenv("QUERY_PLANNER", "false").lower() in ('1', 'true', 'yes')
+
+# Time budget for a request's upstream calls; clients can ask for less with X-Request-Timeout (seconds)
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", 30))
+
+# In-memory ECL library catalog; files are re-parsed only when they change
+ECL_LIBRARY = os.getenv("ECL_LIBRARY", "ecl_library")
+catalog = EclCatalog(ECL_LIBRARY, poll_interval=float(os.getenv("CATALOG_POLL_INTERVAL", 2)))
+
+# Full-text index over the catalog, updated incrementally as files change
+search_index = SearchIndex()
+catalog.subscribe(search_index.on_catalog_change)
+
+# Admin endpoints (profiler) need this token in X-Admin-Token; without one they only answer localhost
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+
+# Background warming of the expansion cache with every library expression. Warming
+# waits for interactive requests (the routes below that call the server) to finish.
+CACHE_WARMER = os.getenv("CACHE_WARMER", "true").lower() in ('1', 'true', 'yes')
+INTERACTIVE_ENDPOINTS = {'test_ecl', 'test_ecl_batch', 'count_ecl', 'expand_ecl'}
+interactive_gate = InteractiveGate()
+warmer = CacheWarmer(
+    TX_ENDPOINT, catalog.files, fetcher.cached_expand_valueset, fetcher.refresh_expansion, probe=fetcher.check_release,
+    gate=interactive_gate,
+    concurrency=int(os.getenv("WARM_CONCURRENCY", 2)),
+    interval=float(os.getenv("WARM_INTERVAL", 3000)),
+    check_interval=float(os.getenv("WARM_CHECK_INTERVAL", 300)))
+if CACHE_WARMER:
+    warmer.start()
+
+
+def shutdown(timeout=None):
+    """Stop background warming and jobs and drain in-flight upstream work; called as a gunicorn worker exits"""
+    logger.info('Shutting down: draining background expansions')
+    warmer.stop(timeout)
+    job_runner.stop(timeout)
+    fetcher.shutdown()
+    logger.info('Shutdown complete')
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    g.metrics_start = time.perf_counter()
+    metrics.http_in_flight.inc(g.metrics_route)
+
+@app.before_request
+def start_request_profiling():
+    g.timings_token = profiling.start()
+    if not request.path.startswith('/admin/') and request.endpoint != 'metrics_endpoint':
+        g.profile_token = profiler.begin(request.path)
+
+@app.after_request
+def record_response_status(response):
+    g.metrics_status = response.status_code
+    timings = profiling.current()
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc=None):
+    # Runs after a streamed body has been sent, so the latency covers the whole response
+    route = g.pop('metrics_route', None)
+    if route is None:
+        return
+    metrics.http_in_flight.dec(route)
+    metrics.http_requests.inc(route, request.method, str(g.pop('metrics_status', 500)))
+    metrics.http_request_duration.observe(time.perf_counter() - g.metrics_start, route)
+
+@app.teardown_request
+def finish_request_profiling(exc=None):
+    profiler.end(g.pop('profile_token', None))
+    token = g.pop('timings_token', None)
+    if token is not None:
+        profiling.finish(token)
+
+@app.before_request
+def enter_interactive():
+    if request.endpoint in INTERACTIVE_ENDPOINTS:
+        interactive_gate.enter()
+
+@app.teardown_request
+def exit_interactive(exc=None):
+    # Streaming responses tear down once the stream has been sent
+    if request.endpoint in INTERACTIVE_ENDPOINTS:
+        interactive_gate.exit()
+
+def request_deadline(view):
+    """Run a view with a deadline that every upstream call it makes must fit in"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        seconds = REQUEST_TIMEOUT
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                
-            # Extract the description (# line) and non-comment ECL expression
-            lines = content.split('\n')
-            description = ""
-            ecl_expression = []
-            
-            for line in lines:
-                line = line.strip()
-                if line.startswith('#'):
-                    # Extract description from comment line (remove the # and whitespace)
-                    if not description:  # Only take the first comment line as description
-                        description = line.lstrip('#').strip()
-                elif line and not line.startswith('#'):
-                    ecl_expression.append(line)
-            
-            if ecl_expression:
-                ecl_files.append({
-                    'filename': os.path.basename(file_path),
-                    'path': file_path,
-                    'description': description or "No description available",
-                    'expression': '\n'.join(ecl_expression),
-                    'category': os.path.basename(os.path.dirname(file_path))
-                })
-                
-        except Exception as e:
-            logger.error(f'Error reading file {file_path}: {e}')
-    
-    # Sort by category (folder) first, then by filename
-    ecl_files.sort(key=lambda x: (x['category'], x['filename']))
-    
-    return ecl_files
+            seconds = min(seconds, float(request.headers.get('X-Request-Timeout', seconds)))
+        except ValueError:
+            pass
+        with resilience.deadline(seconds):
+            return view(*args, **kwargs)
+    return wrapper
+
+def read_ecl_files():
+    """Return all ECL expressions in the library, sorted by category then filename"""
+    return catalog.files()
+
+def request_items(body):
+    """
+    {"expression", "filename"} items from {"expressions": [...]} (strings or
+    objects) and/or {"category": "AMT"} / {"category": "all"} library entries
+    """
+    items = []
+    for expression in body.get('expressions', []):
+        if isinstance(expression, str):
+            expression = {'expression': expression}
+        if expression.get('expression'):
+            items.append({'expression': expression['expression'], 'filename': expression.get('filename')})
+    category = body.get('category')
+    if category:
+        items.extend({'expression': f['expression'], 'filename': f['filename']}
+                     for f in read_ecl_files() if category == 'all' or f['category'] == category)
+    return items
+
+def int_field(values, name, default, minimum=None, maximum=None):
+    """
+    A whole-number request field (JSON body or query string), clamped to
+    [minimum, maximum]; the default when it is absent, None when it is not
+    a number
+    """
+    value = values.get(name)
+    if value is None:
+        value = default
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    if minimum is not None:
+        value = max(value, minimum)
+    if maximum is not None:
+        value = min(value, maximum)
+    return value
+
+def invalid_field(name):
+    return jsonify({
+        'success': False,
+        'error': f'{name} must be a whole number'
+    }), 400
 
 @app.route('/favicon.ico')
 def favicon():
@@ -87,29 +216,24 @@ def search_ecl():
     if not query or len(query) < 2:
         return jsonify([])
     
-    ecl_files = read_ecl_files()
+    # Poll the catalog so the index reflects recent library changes
+    read_ecl_files()
     matching_results = []
     
-    for ecl_file in ecl_files:
-        # Search in filename, description, and expression
-        searchable_text = f"{ecl_file['filename']} {ecl_file['description']} {ecl_file['expression']}".lower()
-        
-        if query in searchable_text:
-            matching_results.append({
-                'filename': ecl_file['filename'],
-                'description': ecl_file['description'],
-                'category': ecl_file['category'],
-                'expression': ecl_file['expression'][:100] + ('...' if len(ecl_file['expression']) > 100 else ''),  # Truncate for preview
-                'match_score': searchable_text.count(query)  # Simple relevance scoring
-            })
-    
-    # Sort by relevance (match score) and then by filename
-    matching_results.sort(key=lambda x: (-x['match_score'], x['filename']))
+    for score, ecl_file in search_index.search(query, limit=10):
+        matching_results.append({
+            'filename': ecl_file['filename'],
+            'description': ecl_file['description'],
+            'category': ecl_file['category'],
+            'expression': ecl_file['expression'][:100] + ('...' if len(ecl_file['expression']) > 100 else ''),  # Truncate for preview
+            'match_score': round(score, 3)  # BM25F relevance
+        })
     
-    # Limit results to prevent overwhelming the UI
-    return jsonify(matching_results[:10])
+    # Results are limited to 10 to prevent overwhelming the UI
+    return jsonify(matching_results)
 
 @app.route('/test_ecl', methods=['POST'])
+@request_deadline
 def test_ecl():
     """Test an ECL expression using the fetcher"""
     try:
@@ -130,20 +254,46 @@ def test_ecl():
                 'error': 'ECL expression is required'
             }), 400
         
+        # Reject malformed expressions locally instead of round-tripping to the server
+        with profiling.phase('parse'):
+            syntax_error = ecl_parser.validate(ecl_expression)
+        if syntax_error is not None:
+            logger.info(f'ECL syntax error in {filename}: {syntax_error}')
+            return jsonify({
+                'success': True,
+                'total': -1,
+                'concepts': [],
+                'filename': filename,
+                'error': f'Invalid ECL: {syntax_error}',
+                'syntax_error': syntax_error.to_dict()
+            })
+
         logger.info(f'Testing ECL expression from {filename} using endpoint: {endpoint}')
         
         # Call the fetcher function with the specified endpoint
-        result = fetcher.expand_valueset(endpoint, ecl_expression, 25)
+        plan = None
+        if request.json.get('count_only'):
+            # Total only: the server skips building the concept list and nothing is decoded
+            result = fetcher.count_valueset(endpoint, ecl_expression)
+        elif request.json.get('plan', QUERY_PLANNER):
+            result, plan = planner.expand(endpoint, ecl_expression, 25)
+        else:
+            result = fetcher.cached_expand_valueset(endpoint, ecl_expression, 25)
         
-        logger.info(f'ECL test result for {filename}: {result}')
+        # Only the outcome is logged; the concept list would make every line kilobytes long
+        logger.info(f'ECL test result for {filename}: total={result.get("total", -1)} error={result.get("error")}')
         
-        return jsonify({
+        response = {
             'success': True,
             'total': result.get('total', -1),
             'concepts': result.get('concepts', []),
             'filename': filename,
             'error': result.get('error')
-        })
+        }
+        if plan is not None:
+            response['plan'] = plan
+        with profiling.phase('serialize'):
+            return jsonify(response)
         
     except Exception as e:
         logger.error(f'Error testing ECL expression: {e}')
@@ -152,6 +302,558 @@ def test_ecl():
             'error': str(e)
         }), 500
 
+@app.route('/validate_ecl', methods=['POST'])
+def validate_ecl():
+    """Check ECL syntax locally; cheap enough to call on every keystroke"""
+    if not request.json:
+        return jsonify({
+            'success': False,
+            'error': 'No JSON data provided'
+        }), 400
+
+    syntax_error = ecl_parser.validate(request.json.get('expression') or '')
+    if syntax_error is not None:
+        return jsonify({'valid': False, 'error': str(syntax_error), 'syntax_error': syntax_error.to_dict()})
+    return jsonify({'valid': True})
+
+@app.route('/test_ecl_batch', methods=['POST'])
+def test_ecl_batch():
+    """
+    Test many ECL expressions concurrently and stream each result as it finishes.
+
+    Accepts {"expressions": [...]} (strings or {"expression", "filename"} objects)
+    or {"category": "AMT"} / {"category": "all"} to test library entries.
+    Streams NDJSON by default, or Server-Sent Events with {"format": "sse"}.
+    {"plan": true} sends compound expressions through the query planner.
+    """
+    if not request.json:
+        return jsonify({
+            'success': False,
+            'error': 'No JSON data provided'
+        }), 400
+
+    endpoint = request.json.get('endpoint', TX_ENDPOINT)
+    count = int_field(request.json, 'count', 25, minimum=0, maximum=STREAM_MAX_PAGE_SIZE)
+    if count is None:
+        return invalid_field('count')
+    stream_format = request.json.get('format', 'ndjson')
+    items = request_items(request.json)
+
+    if not items:
+        return jsonify({
+            'success': False,
+            'error': 'At least one ECL expression or a library category is required'
+        }), 400
+    if stream_format not in ('ndjson', 'sse'):
+        return jsonify({
+            'success': False,
+            'error': 'format must be "ndjson" or "sse"'
+        }), 400
+
+    logger.info(f'Batch testing {len(items)} ECL expressions using endpoint: {endpoint}')
+
+    def encode(message):
+        line = json.dumps(message)
+        return f'data: {line}\n\n' if stream_format == 'sse' else line + '\n'
+
+    # Syntax errors are reported straight away and never sent to the server
+    invalid = []
+    valid = []
+    for item in items:
+        syntax_error = ecl_parser.validate(item['expression'])
+        if syntax_error is None:
+            valid.append(item)
+        else:
+            invalid.append((item, syntax_error))
+
+    expand = None
+    if request.json.get('plan', QUERY_PLANNER):
+        expand = lambda endpoint, expression, count: planner.expand(endpoint, expression, count)[0]
+
+    def generate():
+        start = time.perf_counter()
+        failures = len(invalid)
+        for item, syntax_error in invalid:
+            yield encode({
+                'filename': item['filename'],
+                'expression': item['expression'],
+                'total': -1,
+                'concepts': [],
+                'error': f'Invalid ECL: {syntax_error}',
+                'syntax_error': syntax_error.to_dict(),
+                'elapsed_ms': 0.0
+            })
+        for item, result, elapsed_ms in batch.expand_many(endpoint, valid, count, expand):
+            if result.get('error'):
+                failures += 1
+            yield encode({
+                'filename': item['filename'],
+                'expression': item['expression'],
+                'total': result.get('total', -1),
+                'concepts': result.get('concepts', []),
+                'error': result.get('error'),
+                'elapsed_ms': round(elapsed_ms, 1)
+            })
+        elapsed = (time.perf_counter() - start) * 1000
+        logger.info(f'Batch of {len(items)} finished in {elapsed:.0f} ms with {failures} errors')
+        yield encode({'done': True, 'count': len(items), 'errors': failures, 'elapsed_ms': round(elapsed, 1)})
+
+    mimetype = 'text/event-stream' if stream_format == 'sse' else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+@app.route('/count_ecl', methods=['POST'])
+@request_deadline
+def count_ecl():
+    """
+    Count the concepts matched by many ECL expressions in one response.
+
+    Accepts {"expressions": [...]} (strings or {"expression", "filename"} objects)
+    and/or {"category": "AMT"} / {"category": "all"} for library entries. Only
+    totals are requested from the server, so this is cheap enough to count the
+    whole library. Results keep the order of the request.
+    """
+    if not request.json:
+        return jsonify({
+            'success': False,
+            'error': 'No JSON data provided'
+        }), 400
+
+    endpoint = request.json.get('endpoint', TX_ENDPOINT)
+    items = request_items(request.json)
+
+    if not items:
+        return jsonify({
+            'success': False,
+            'error': 'At least one ECL expression or a library category is required'
+        }), 400
+
+    start = time.perf_counter()
+    counts = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        syntax_error = ecl_parser.validate(item['expression'])
+        if syntax_error is None:
+            valid.append(dict(item, index=index))
+        else:
+            counts[index] = {
+                'filename': item['filename'],
+                'expression': item['expression'],
+                'total': -1,
+                'error': f'Invalid ECL: {syntax_error}'
+            }
+    expand = lambda endpoint, expression, count: fetcher.count_valueset(endpoint, expression)
+    for item, result, elapsed_ms in batch.expand_many(endpoint, valid, 0, expand):
+        counts[item['index']] = {
+            'filename': item['filename'],
+            'expression': item['expression'],
+            'total': result.get('total', -1),
+            'error': result.get('error')
+        }
+    errors = sum(1 for entry in counts if entry['error'])
+    elapsed = (time.perf_counter() - start) * 1000
+    logger.info(f'Counted {len(items)} ECL expressions in {elapsed:.0f} ms with {errors} errors')
+    return jsonify({
+        'success': True,
+        'counts': counts,
+        'errors': errors,
+        'elapsed_ms': round(elapsed, 1)
+    })
+
+class StreamAborted(Exception):
+    """Raised inside a streamed response to cut the connection, so a truncated body is not taken for a complete one"""
+
+@app.route('/expand_ecl', methods=['POST'])
+def expand_ecl():
+    """
+    Stream the full expansion of an ECL expression as NDJSON (default) or CSV.
+
+    The expansion is fetched in pages of `page_size` concepts, so memory use
+    does not grow with the size of the expansion.
+    """
+    if not request.json:
+        return jsonify({
+            'success': False,
+            'error': 'No JSON data provided'
+        }), 400
+
+    ecl_expression = request.json.get('expression')
+    endpoint = request.json.get('endpoint', TX_ENDPOINT)
+    stream_format = request.json.get('format', 'ndjson')
+    page_size = int_field(request.json, 'page_size', STREAM_PAGE_SIZE, minimum=1, maximum=STREAM_MAX_PAGE_SIZE)
+
+    if page_size is None:
+        return invalid_field('page_size')
+    if not ecl_expression:
+        return jsonify({
+            'success': False,
+            'error': 'ECL expression is required'
+        }), 400
+    if stream_format not in ('ndjson', 'csv'):
+        return jsonify({
+            'success': False,
+            'error': 'format must be "ndjson" or "csv"'
+        }), 400
+    syntax_error = ecl_parser.validate(ecl_expression)
+    if syntax_error is not None:
+        return jsonify({
+            'success': False,
+            'error': f'Invalid ECL: {syntax_error}',
+            'syntax_error': syntax_error.to_dict()
+        }), 400
+
+    logger.info(f'Streaming full expansion in pages of {page_size} using endpoint: {endpoint}')
+
+    # The first page decides the status code; once the response has started an error can only go in the body
+    pages = fetcher.iter_expansion(endpoint, ecl_expression, page_size)
+    first = next(pages)
+    if first.get('error'):
+        pages.close()
+        return jsonify({
+            'success': False,
+            'error': first['error']
+        }), 400 if first.get('operation_outcome') else 502
+
+    def generate_ndjson():
+        sent = 0
+        try:
+            for page in itertools.chain([first], pages):
+                if page.get('error'):
+                    yield json.dumps({'error': page['error']}) + '\n'
+                    return
+                if sent == 0:
+                    yield json.dumps({'total': page['total']}) + '\n'
+                yield ''.join(json.dumps(concept) + '\n' for concept in page['concepts'])
+                sent += len(page['concepts'])
+        finally:
+            pages.close()
+        logger.info(f'Streamed {sent} concepts')
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['code', 'display'])
+        yield buffer.getvalue()
+        try:
+            for page in itertools.chain([first], pages):
+                if page.get('error'):
+                    # CSV has no room for an error row, so drop the connection rather than end the file cleanly
+                    logger.error(f'Streaming expansion failed: {page["error"]}')
+                    raise StreamAborted(page['error'])
+                buffer.seek(0)
+                buffer.truncate()
+                writer.writerows((concept['code'], concept['display']) for concept in page['concepts'])
+                yield buffer.getvalue()
+        finally:
+            pages.close()
+
+    if stream_format == 'csv':
+        return Response(stream_with_context(generate_csv()), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=expansion.csv'})
+    return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+
+# Background jobs for expansions and batches that outlast HTTP timeouts. Jobs are kept in
+# JOB_STORE, shared by every worker process, and deleted JOB_TTL seconds after finishing.
+JOBS = os.getenv("JOBS", "true").lower() in ('1', 'true', 'yes')
+JOB_STORE = os.getenv("JOB_STORE", "./cache/jobs.sqlite3")
+JOB_PAGE_SIZE = int(os.getenv("JOB_PAGE_SIZE", 1000))
+JOB_EVENT_INTERVAL = float(os.getenv("JOB_EVENT_INTERVAL", 0.5))
+
+# Job types whose output is spooled to the job store, and the result key it is streamed back under
+JOB_OUTPUT = {'expand': 'concepts'}
+
+def run_expand_job(params, progress):
+    """Full expansion of one expression, fetched page by page; each page goes to the job's output as it arrives"""
+    done = 0
+    total = 0
+    for page in fetcher.iter_expansion(params['endpoint'], params['expression'], params['page_size']):
+        if page.get('error'):
+            raise RuntimeError(page['error'])
+        total = page['total']
+        done += len(page['concepts'])
+        progress(done, total, page['concepts'])
+    return {'expression': params['expression'], 'total': total}
+
+def run_batch_job(params, progress):
+    """Expand (or only count) many expressions; results keep the order of the request"""
+    items = params['items']
+    results = [None] * len(items)
+    valid = []
+    for index, item in enumerate(items):
+        syntax_error = ecl_parser.validate(item['expression'])
+        if syntax_error is None:
+            valid.append(dict(item, index=index))
+        else:
+            results[index] = {
+                'filename': item['filename'],
+                'expression': item['expression'],
+                'total': -1,
+                'concepts': [],
+                'error': f'Invalid ECL: {syntax_error}'
+            }
+    done = len(items) - len(valid)
+    progress(done, len(items))
+    count = params['count']
+    expand = None
+    if params['count_only']:
+        count = 0
+        expand = lambda endpoint, expression, count: fetcher.count_valueset(endpoint, expression)
+    for item, result, elapsed_ms in batch.expand_many(params['endpoint'], valid, count, expand):
+        results[item['index']] = {
+            'filename': item['filename'],
+            'expression': item['expression'],
+            'total': result.get('total', -1),
+            'concepts': result.get('concepts', []),
+            'error': result.get('error'),
+            'elapsed_ms': round(elapsed_ms, 1)
+        }
+        done += 1
+        progress(done, len(items))
+    return {'results': results, 'errors': sum(1 for entry in results if entry['error'])}
+
+job_runner = JobRunner(
+    JobStore(JOB_STORE), {'expand': run_expand_job, 'batch': run_batch_job},
+    workers=int(os.getenv("JOB_WORKERS", 2)),
+    lease=float(os.getenv("JOB_LEASE", 60)),
+    ttl=float(os.getenv("JOB_TTL", 86400)),
+    timeout=float(os.getenv("JOB_TIMEOUT", 3600)))
+if JOBS:
+    job_runner.start()
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """
+    Queue a long-running job and return its ID straight away (202).
+
+    {"type": "expand", "expression": ...} fetches a full expansion;
+    {"type": "batch", "expressions": [...]} and/or {"category": ...} tests many
+    expressions, with {"count_only": true} to only count them. Poll
+    /jobs/<id>, or subscribe to /jobs/<id>/events, then fetch /jobs/<id>/result.
+    """
+    if not request.json:
+        return jsonify({
+            'success': False,
+            'error': 'No JSON data provided'
+        }), 400
+
+    kind = request.json.get('type')
+    endpoint = request.json.get('endpoint', TX_ENDPOINT)
+    if kind == 'expand':
+        ecl_expression = request.json.get('expression')
+        if not ecl_expression:
+            return jsonify({
+                'success': False,
+                'error': 'ECL expression is required'
+            }), 400
+        syntax_error = ecl_parser.validate(ecl_expression)
+        if syntax_error is not None:
+            return jsonify({
+                'success': False,
+                'error': f'Invalid ECL: {syntax_error}',
+                'syntax_error': syntax_error.to_dict()
+            }), 400
+        page_size = int_field(request.json, 'page_size', JOB_PAGE_SIZE, minimum=1, maximum=STREAM_MAX_PAGE_SIZE)
+        if page_size is None:
+            return invalid_field('page_size')
+        params = {'expression': ecl_expression, 'endpoint': endpoint, 'page_size': page_size}
+    elif kind == 'batch':
+        # Library entries are resolved now, so the job runs what the client saw
+        items = request_items(request.json)
+        if not items:
+            return jsonify({
+                'success': False,
+                'error': 'At least one ECL expression or a library category is required'
+            }), 400
+        count = int_field(request.json, 'count', 25, minimum=0, maximum=STREAM_MAX_PAGE_SIZE)
+        if count is None:
+            return invalid_field('count')
+        params = {'items': items, 'endpoint': endpoint, 'count': count,
+                  'count_only': bool(request.json.get('count_only', False))}
+    else:
+        return jsonify({
+            'success': False,
+            'error': 'type must be "expand" or "batch"'
+        }), 400
+
+    job_id = job_runner.submit(kind, params)
+    logger.info(f'Queued {kind} job {job_id} using endpoint: {endpoint}')
+    return jsonify({'success': True, 'job': job_runner.store.get(job_id)}), 202, {'Location': f'/jobs/{job_id}'}
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """Recently submitted jobs and the job runner's counters"""
+    limit = int_field(request.args, 'limit', 50, minimum=0)
+    if limit is None:
+        return invalid_field('limit')
+    return jsonify({'jobs': job_runner.store.recent(limit), 'runner': job_runner.stats()})
+
+def job_not_found(job_id):
+    return jsonify({'success': False, 'error': f'Unknown or expired job: {job_id}'}), 404
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """State and progress ({done, total}) of a job"""
+    status = job_runner.store.get(job_id)
+    if status is None:
+        return job_not_found(job_id)
+    return jsonify({'success': True, 'job': status})
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """
+    Result of a finished job; 409 while it is queued or running. The output
+    of an expansion job is streamed from the job store a page at a time.
+    """
+    status = job_runner.store.get(job_id)
+    if status is None:
+        return job_not_found(job_id)
+    if status['state'] not in ('done', 'failed', 'cancelled'):
+        return jsonify({'success': False, 'error': f'Job is {status["state"]}', 'job': status}), 409
+    result = job_runner.store.result(job_id)
+    output_key = JOB_OUTPUT.get(status['type'])
+    if status['state'] != 'done' or output_key is None:
+        return jsonify({'success': status['state'] == 'done', 'job': status, 'result': result})
+
+    def generate():
+        # The result object is written without its closing brace, then the output key and array are added
+        head = json.dumps(result or {})[:-1]
+        yield f'{{"success": true, "job": {json.dumps(status)}, "result": {head}'
+        yield f'{", " if result else ""}{json.dumps(output_key)}: ['
+        seq = 0
+        sent = 0
+        while True:
+            items = job_runner.store.output(job_id, seq)
+            if items is None:
+                break
+            if items:
+                yield (', ' if sent else '') + ', '.join(json.dumps(item) for item in items)
+                sent += len(items)
+            seq += 1
+        yield ']}}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Server-Sent Events with the job's status whenever its state or progress changes, until it finishes"""
+    if job_runner.store.get(job_id) is None:
+        return job_not_found(job_id)
+
+    def generate():
+        last = None
+        while True:
+            status = job_runner.store.get(job_id)
+            if status is None:
+                return
+            current = (status['state'], status['progress']['done'], status['progress']['total'])
+            if current != last:
+                last = current
+                yield f'data: {json.dumps(status)}\n\n'
+            if status['state'] in ('done', 'failed', 'cancelled'):
+                return
+            time.sleep(JOB_EVENT_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a queued or running job; a running job stops at its next progress report"""
+    status = job_runner.store.get(job_id)
+    if status is None:
+        return job_not_found(job_id)
+    if not job_runner.cancel(job_id):
+        return jsonify({'success': False, 'error': f'Job is already {status["state"]}', 'job': status}), 409
+    return jsonify({'success': True, 'job': job_runner.store.get(job_id)})
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    """Expansion cache hit ratio, size and eviction counters"""
+    stats = fetcher.expansion_cache.stats()
+    if fetcher.expansion_store is not None:
+        stats['store'] = fetcher.expansion_store.stats()
+    stats['single_flight'] = fetcher.single_flight.stats()
+    stats['planner'] = planner.stats()
+    stats['releases'] = fetcher.releases.stats()
+    # How many library expressions share a cache entry with another one
+    report = collapse_report(read_ecl_files())
+    stats['library'] = {key: report[key] for key in ('expressions', 'canonical_forms', 'collapsed')}
+    return jsonify(stats)
+
+@app.route('/endpoint_stats', methods=['GET'])
+def endpoint_stats():
+    """Endpoint pool latency, health and hedging counters, and circuit breaker states and trips"""
+    pool = fetcher.endpoint_pool
+    return jsonify({'endpoints': pool.stats() if pool is not None else [], 'breakers': fetcher.breakers.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Request, upstream and cache metrics in the Prometheus text format"""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+def admin_only(view):
+    """Allow a view with the ADMIN_TOKEN header, or from localhost when no token is configured"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if ADMIN_TOKEN:
+            allowed = request.headers.get('X-Admin-Token') == ADMIN_TOKEN
+        else:
+            allowed = request.remote_addr in ('127.0.0.1', '::1')
+        if not allowed:
+            return jsonify({'success': False, 'error': 'Admin access denied'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+@admin_only
+def admin_profile():
+    """
+    Sampling profiler control. POST {"requests": N, "interval_ms": 5} profiles
+    the next N requests, DELETE clears the collected samples and GET shows the
+    status. The samples are served by /admin/profile/stacks.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True) or {}
+        if not isinstance(body, dict):
+            return jsonify({'success': False, 'error': 'Expected a JSON object'}), 400
+        count = int_field(body, 'requests', 10, minimum=0)
+        if count is None:
+            return invalid_field('requests')
+        interval = body.get('interval_ms')
+        if interval is not None:
+            try:
+                interval = float(interval)
+            except (TypeError, ValueError):
+                interval = math.nan
+            if not math.isfinite(interval) or interval <= 0:
+                return jsonify({'success': False, 'error': 'interval_ms must be a positive number'}), 400
+        profiler.arm(count, interval / 1000 if interval else None)
+        logger.info(f'Profiling the next {profiler.status()["armed"]} requests')
+    elif request.method == 'DELETE':
+        profiler.arm(0)
+        profiler.reset()
+    return jsonify(profiler.status())
+
+@app.route('/admin/profile/stacks', methods=['GET'])
+@admin_only
+def admin_profile_stacks():
+    """Collected samples as collapsed stacks for flamegraph.pl or speedscope"""
+    return Response(profiler.collapsed(), mimetype='text/plain')
+
+@app.route('/warm_status', methods=['GET'])
+def warm_status():
+    """Progress of the background cache warmer"""
+    status = warmer.status()
+    status['enabled'] = CACHE_WARMER
+    return jsonify(status)
+
+@app.route('/warm', methods=['POST'])
+def warm():
+    """Ask the cache warmer to refresh every library expression now"""
+    if not CACHE_WARMER:
+        return jsonify({'success': False, 'error': 'Cache warming is disabled (CACHE_WARMER=false)'}), 409
+    warmer.trigger()
+    return jsonify({'success': True})
+
 if __name__ == '__main__':
     # Use PORT from environment (for render.com) or default to 5001 for local development
     port = int(os.getenv('PORT', 5001))
@@ -167,5 +869,6 @@ if __name__ == '__main__':
     print(f"🔗 Terminology Server: {TX_ENDPOINT}")
     print(f"{'='*60}\n")
     
+    # Development server; production runs under gunicorn (see gunicorn.conf.py)
     app.run(debug=debug, host='0.0.0.0', port=port)
    
\ No newline at end of file
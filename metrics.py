@@ -0,0 +1,247 @@
+"""
+Prometheus-style metrics with cheap recording.
+
+Counters, gauges and histograms are recorded into a per-thread shard: the
+recording thread is the only writer of its shard, so the hot path takes no
+lock - just a dict update. A scrape (`render()`) sums the shards of every
+thread; shards of threads that have exited are folded into a retired total so
+short-lived request threads do not accumulate. Exits are noticed when the
+thread-local storage is released, which also works for greenlets under a
+gevent worker. Values that already live
+elsewhere (cache sizes and hit counts) are read at scrape time through
+collector callbacks instead of being recorded twice.
+
+The output is the Prometheus text exposition format (version 0.0.4), so
+`/metrics` can be scraped without the prometheus_client package.
+"""
+
+import bisect
+import threading
+import weakref
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name, help, labelnames):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def _merge(self, total, value):
+        return total + value
+
+    def _samples(self, values):
+        for labels, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+
+
+class Counter(_Metric):
+    """Monotonic count, e.g. requests or bytes"""
+
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self._registry._shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down, e.g. requests in flight"""
+
+    kind = 'gauge'
+
+    def inc(self, *labels, amount=1):
+        shard = self._registry._shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    """Distribution of observations in cumulative buckets, plus their sum and count"""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, labelnames, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        shard = self._registry._shard()
+        key = (self.name, labels)
+        state = shard.get(key)
+        if state is None:
+            # One slot per bucket plus +Inf, then sum and count
+            state = shard[key] = [0] * (len(self.buckets) + 3)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def _merge(self, total, value):
+        if total == 0:
+            return list(value)
+        return [a + b for a, b in zip(total, value)]
+
+    def _samples(self, values):
+        bounds = self.buckets + (float('inf'),)
+        for labels, state in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, state):
+                cumulative += count
+                le = 'le="' + _number(bound) + '"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(round(state[-2], 6))}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {state[-1]}'
+
+
+class _ShardOwner:
+    """Lives in thread-local storage; its finalizer reports that the thread has exited"""
+
+
+class Registry:
+    """Named metrics, their per-thread shards and scrape-time collectors"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._shards = {}  # id(shard) -> shard for every live thread that has recorded something
+        self._exited = []  # shards of exited threads, appended by finalizers and folded by _retire()
+        self._retired = {}
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter(self, name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge(self, name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(self, name, help, labelnames, buckets))
+
+    def collector(self, collect):
+        """
+        Register collect(), called on every scrape, returning (name, kind, help,
+        [(labels dict, value)]) tuples for values kept elsewhere.
+        """
+        self._collectors.append(collect)
+        return collect
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            self._local.owner = owner = _ShardOwner()
+            # Finalizers may run during garbage collection on any thread, so
+            # this only queues the shard (list.append is atomic); the lock is
+            # taken later by _retire()
+            weakref.finalize(owner, self._exited.append, shard)
+            with self._lock:
+                self._retire()
+                self._shards[id(shard)] = shard
+        return shard
+
+    def _retire(self):
+        """Fold the shards of exited threads into the retired totals (lock held)"""
+        while self._exited:
+            shard = self._exited.pop()
+            self._shards.pop(id(shard), None)
+            for key, value in shard.items():
+                metric = self._metrics[key[0]]
+                self._retired[key] = metric._merge(self._retired.get(key, 0), value)
+
+    def snapshot(self):
+        """{metric name: {labels: value}} summed over every thread"""
+        with self._lock:
+            self._retire()
+            totals = {key: (list(value) if isinstance(value, list) else value)
+                      for key, value in self._retired.items()}
+            shards = list(self._shards.values())
+            metrics = dict(self._metrics)
+        for shard in shards:
+            for key, value in list(shard.items()):
+                metric = metrics[key[0]]
+                totals[key] = metric._merge(totals.get(key, 0), value)
+        values = {}
+        for (name, labels), value in totals.items():
+            values.setdefault(name, {})[labels] = value
+        return values
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        values = self.snapshot()
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric._samples(values.get(metric.name, {})))
+        for collect in self._collectors:
+            for name, kind, help, samples in collect():
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_labels(labels.keys(), labels.values())} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry and the metrics recorded by the app
+registry = Registry()
+
+http_requests = registry.counter(
+    'ecl_http_requests_total', 'HTTP requests handled, by route, method and status', ('route', 'method', 'status'))
+http_request_duration = registry.histogram(
+    'ecl_http_request_duration_seconds', 'Time to handle an HTTP request, including streamed bodies', ('route',))
+http_in_flight = registry.gauge(
+    'ecl_http_requests_in_flight', 'HTTP requests being handled', ('route',))
+
+upstream_requests = registry.counter(
+    'ecl_upstream_requests_total', 'Calls to terminology servers by outcome (HTTP status or error kind)',
+    ('endpoint', 'status'))
+upstream_duration = registry.histogram(
+    'ecl_upstream_request_duration_seconds', 'Time of one $expand call, from sending to the decoded result',
+    ('endpoint',))
+upstream_bytes = registry.counter(
+    'ecl_upstream_response_bytes_total', 'Response body bytes received from terminology servers', ('endpoint',))
+upstream_decode = registry.histogram(
+    'ecl_upstream_decode_seconds', 'Time spent decoding a $expand response, excluding network waits',
+    ('endpoint',), buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+upstream_in_flight = registry.gauge(
+    'ecl_upstream_requests_in_flight', 'Calls to terminology servers in progress', ('endpoint',))
@@ -0,0 +1,225 @@
+"""
+Per-request phase timing and an on-demand sampling profiler.
+
+Phase timing: start() attaches a PhaseTimings to the current context and
+code on the request path reports how long each phase took with record() or
+phase() - URL encoding, connecting, waiting for the first byte, downloading
+and decoding upstream responses, parsing ECL and serializing the response.
+Worker threads started with resilience.submit() share the caller's context,
+so their phases land in the same request. The result is sent back in a
+Server-Timing header that browser dev tools display per request.
+
+Sampling profiler: arm(n) profiles the next n requests. While one of them is
+running, a background thread samples its stack every `interval` seconds;
+the counts are available as collapsed stacks ("a;b;c 12" per line), the
+input format of flamegraph.pl and speedscope. Nothing is sampled unless
+armed, so it can be switched on in production without a restart. Under a
+gevent worker requests run on greenlets rather than threads, and a patched
+threading.Thread would be one more greenlet that only runs while requests
+are parked. The sampler therefore runs on a real OS thread (gevent's
+original start_new_thread) and reads the stack of a greenlet that is
+running from the worker thread's frame, and of one that is waiting from
+the greenlet itself, so CPU time and waiting time both show up.
+"""
+
+import contextlib
+import contextvars
+import importlib
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+_timings = contextvars.ContextVar('phase_timings', default=None)
+
+# Server-Timing order; phases not listed here follow in the order they were recorded
+PHASES = ('parse', 'encode', 'connect', 'ttfb', 'download', 'decode', 'serialize')
+
+
+class PhaseTimings:
+    """Accumulated seconds per phase for one request; phases may be recorded from several threads"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._phases = {}
+        self._counts = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            self._phases[name] = self._phases.get(name, 0.0) + seconds
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def phases(self):
+        with self._lock:
+            phases = dict(self._phases)
+        ordered = {name: phases.pop(name) for name in PHASES if name in phases}
+        ordered.update(phases)
+        return ordered
+
+    def server_timing(self):
+        """Server-Timing header value in milliseconds, ending with the total time so far"""
+        with self._lock:
+            counts = dict(self._counts)
+        parts = []
+        for name, seconds in self.phases().items():
+            part = f'{name};dur={seconds * 1000:.2f}'
+            if counts.get(name, 1) > 1:
+                part += f';desc="{counts[name]} calls"'
+            parts.append(part)
+        parts.append(f'total;dur={(time.perf_counter() - self.started) * 1000:.2f}')
+        return ', '.join(parts)
+
+
+def start():
+    """Begin timing the current request; returns a token for finish()"""
+    return _timings.set(PhaseTimings())
+
+
+def finish(token):
+    _timings.reset(token)
+
+
+def current():
+    return _timings.get()
+
+
+def record(name, seconds):
+    """Add seconds to a phase of the current request; a no-op outside a timed request"""
+    timings = _timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    """Time the enclosed block as one phase of the current request"""
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start_time)
+
+
+def _original(module, name):
+    """module.name as it was before gevent monkey-patched it (the current one without gevent)"""
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None:
+        return monkey.get_original(module, name)
+    return getattr(importlib.import_module(module), name)
+
+
+def _current_greenlet():
+    """The running greenlet when requests are served on greenlets (gevent), else None"""
+    greenlet = sys.modules.get('greenlet')
+    if greenlet is None or threading.get_ident() in sys._current_frames():
+        return None
+    return greenlet.getcurrent()
+
+
+class SamplingProfiler:
+    """Statistical profiler for the next N requests, producing collapsed stacks"""
+
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval
+        self.max_depth = max_depth
+        # Shared with the sampler's OS thread, so neither may be a gevent primitive
+        self._lock = _original('_thread', 'allocate_lock')()
+        self._sleep = _original('time', 'sleep')
+        self._thread_ident = _original('_thread', 'get_ident')
+        self._remaining = 0
+        self._active = {}  # thread or greenlet id -> (request label, greenlet or None, OS thread id)
+        self._stacks = Counter()
+        self._samples = 0
+        self._profiled = 0
+        self._sampling = False
+
+    def arm(self, requests, interval=None):
+        """Profile the next `requests` requests (0 disarms); earlier samples are kept"""
+        with self._lock:
+            self._remaining = max(0, int(requests))
+            if interval is not None:
+                self.interval = max(0.001, float(interval))
+
+    def reset(self):
+        with self._lock:
+            self._stacks.clear()
+            self._samples = 0
+            self._profiled = 0
+
+    def begin(self, label=''):
+        """Called at the start of a request; returns a token if this request is profiled, else None"""
+        if not self._remaining:
+            return None
+        with self._lock:
+            if not self._remaining:
+                return None
+            self._remaining -= 1
+            ident = threading.get_ident()
+            self._active[ident] = (label, _current_greenlet(), self._thread_ident())
+            if not self._sampling:
+                self._sampling = True
+                _original('_thread', 'start_new_thread')(self._sample, ())
+        return ident
+
+    def end(self, token):
+        if token is None:
+            return
+        with self._lock:
+            if self._active.pop(token, None) is not None:
+                self._profiled += 1
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._sampling = False
+                    return
+                active = list(self._active.values())
+            frames = sys._current_frames()
+            stacks = []
+            for label, greenlet, thread_ident in active:
+                frame = None
+                if greenlet is not None:
+                    # A parked greenlet keeps its stack in gr_frame; the running one is its thread's frame
+                    frame = greenlet.gr_frame
+                    if frame is None and greenlet.dead:
+                        continue
+                if frame is None:
+                    frame = frames.get(thread_ident)
+                if frame is not None:
+                    stacks.append(self._collapse(frame))
+            with self._lock:
+                for stack in stacks:
+                    self._stacks[stack] += 1
+                    self._samples += 1
+            self._sleep(self.interval)
+
+    def _collapse(self, frame):
+        names = []
+        while frame is not None and len(names) < self.max_depth:
+            code = frame.f_code
+            names.append(f'{os.path.basename(code.co_filename)}:{code.co_name}'.replace(';', ':').replace(' ', '_'))
+            frame = frame.f_back
+        return ';'.join(reversed(names))
+
+    def collapsed(self):
+        """Samples as collapsed stacks, heaviest first"""
+        with self._lock:
+            return ''.join(f'{stack} {count}\n' for stack, count in self._stacks.most_common())
+
+    def status(self):
+        with self._lock:
+            return {
+                'armed': self._remaining,
+                'active': len(self._active),
+                'profiled_requests': self._profiled,
+                'samples': self._samples,
+                'stacks': len(self._stacks),
+                'interval_ms': round(self.interval * 1000, 3)
+            }
+
+
+# Shared profiler driven by the /admin/profile endpoints
+profiler = SamplingProfiler(interval=float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000)
@@ -0,0 +1,233 @@
+"""
+Query planner for compound ECL expressions.
+
+Library expressions are built from a handful of shared blocks - the AMT
+reference sets, `< 404684003 |Clinical finding|` and so on - joined with
+AND/OR/MINUS. Sent as monoliths, every expression makes the server evaluate
+those blocks again. The planner splits the parsed expression at compound
+boundaries instead:
+
+- every operand is first expanded on its own with the normal page size,
+  which both hits the shared expansion cache and gives its total as a size
+  estimate;
+- a compound whose operands are all small enough (max_local codes) and
+  cheap to fetch in full is combined locally with set operations over the
+  operands' full code sets, which are fetched once and cached by canonical
+  form. Cheap means no leaf needs more than max_fetch_pages further page
+  requests: its first expansion was already complete, its code set is
+  cached, or it fits in that many pages. Otherwise one remote $expand of
+  the whole compound costs less than paging through its operands;
+- anything else is sent upstream as one expression, as before.
+
+Each call returns the expansion result together with the plan: the strategy,
+estimate, total and elapsed time of every node.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import ecl_parser
+import fetcher
+import local_engine
+from ecl_canonical import render, split
+from ecl_parser import EclSyntaxError
+from expansion_cache import ExpansionCache
+
+logger = logging.getLogger(__name__)
+
+PLANNER_MAX_LOCAL = int(os.getenv("PLANNER_MAX_LOCAL", 20000))
+PLANNER_PAGE_SIZE = int(os.getenv("PLANNER_PAGE_SIZE", 1000))
+PLANNER_MAX_FETCH_PAGES = int(os.getenv("PLANNER_MAX_FETCH_PAGES", 1))
+
+
+class QueryPlanner:
+    """
+    Plans and runs compound expressions. `expand(endpoint, ecl, count)` is
+    the cached single-expression expansion and `iter_pages(endpoint, ecl,
+    page_size)` walks a full expansion page by page.
+    """
+
+    def __init__(self, expand=None, iter_pages=None, code_sets=None, max_local=PLANNER_MAX_LOCAL,
+                 page_size=PLANNER_PAGE_SIZE, max_fetch_pages=PLANNER_MAX_FETCH_PAGES):
+        self._expand = expand or fetcher.cached_expand_valueset
+        self._iter_pages = iter_pages or fetcher.iter_expansion
+        self.code_sets = code_sets or ExpansionCache(
+            max_entries=int(os.getenv("PLANNER_CACHE_ENTRIES", 200)),
+            max_bytes=int(os.getenv("PLANNER_CACHE_BYTES", 128 * 1024 * 1024)),
+            ttl=float(os.getenv("CACHE_TTL", 3600)))
+        self.max_local = max_local
+        self.page_size = page_size
+        self.max_fetch_pages = max_fetch_pages
+        self._lock = threading.Lock()
+        self._counters = {'plans': 0, 'local_nodes': 0, 'remote_nodes': 0, 'code_set_fetches': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def expand(self, vs_endpoint, ecl_expr, count):
+        """Expand an expression through the planner; returns (result, plan)"""
+        start = time.perf_counter()
+        try:
+            tree = ecl_parser.parse(ecl_expr)
+        except EclSyntaxError:
+            tree = None
+        if tree is None or local_engine.is_local(vs_endpoint) or split(tree) is None:
+            # Nothing to split, or the local engine already evaluates compounds in-process
+            result = self._expand(vs_endpoint, ecl_expr, count)
+            return result, self._node(render(tree) if tree is not None else ecl_expr, 'remote', result, start)
+
+        self._count('plans')
+        estimates = {}
+        result, plan = self._run(vs_endpoint, tree, count, False, estimates)
+        logger.info(f'Planned {plan["expression"]}: {plan["strategy"]} in {plan["elapsed_ms"]} ms')
+        return result, plan
+
+    # -- planning -----------------------------------------------------------
+
+    def _estimate(self, vs_endpoint, node, count, estimates):
+        """
+        Upper bound on the size of a node's result: the total of a normal
+        expansion for leaves, combined over operands for compounds. The leaf
+        expansion is kept so a small leaf never needs a second fetch.
+        """
+        text = render(node)
+        if text in estimates:
+            return estimates[text][0]
+        parts = split(node)
+        if parts is None:
+            result = self._expand(vs_endpoint, text, count)
+            estimate = result.get('total', -1) if not result.get('error') else -1
+            estimates[text] = (estimate, result)
+            return estimate
+        operator, operands = parts
+        sizes = [self._estimate(vs_endpoint, operand, count, estimates) for operand in operands]
+        if any(size < 0 for size in sizes):
+            estimate = -1
+        elif operator == 'and':
+            estimate = min(sizes)
+        elif operator == 'or':
+            estimate = sum(sizes)
+        else:
+            estimate = sizes[0]
+        estimates[text] = (estimate, None)
+        return estimate
+
+    def _fetch_pages(self, vs_endpoint, node, estimates):
+        """
+        Page requests each leaf under an estimated node still needs before its
+        full code set is at hand: none when its estimate expansion already
+        held every concept or its code set is cached.
+        """
+        parts = split(node)
+        if parts is not None:
+            return [pages for operand in parts[1] for pages in self._fetch_pages(vs_endpoint, operand, estimates)]
+        text = render(node)
+        estimate, result = estimates[text]
+        if result is not None and not result.get('error') and len(result['concepts']) >= result['total']:
+            return [0]
+        if ExpansionCache.make_key(vs_endpoint, text, 0, fetcher.releases.current(vs_endpoint)) in self.code_sets:
+            return [0]
+        return [-(-estimate // self.page_size)]
+
+    def _run(self, vs_endpoint, node, count, full, estimates):
+        """Result (first `count` concepts, or every concept if full) and plan for one node"""
+        start = time.perf_counter()
+        text = render(node)
+        parts = split(node)
+        if parts is not None:
+            operator, operands = parts
+            self._estimate(vs_endpoint, node, count, estimates)
+            sizes = [estimates[render(operand)][0] for operand in operands]
+            if all(0 <= size <= self.max_local for size in sizes) and \
+                    max(self._fetch_pages(vs_endpoint, node, estimates)) <= self.max_fetch_pages:
+                return self._combine(vs_endpoint, text, operator, operands, count, full, estimates, start)
+
+        self._count('remote_nodes')
+        estimate, result = estimates.get(text, (None, None))
+        if full:
+            if result is None or result.get('error') or len(result['concepts']) < result['total']:
+                result = self._code_set(vs_endpoint, text)
+        elif result is None:
+            result = self._expand(vs_endpoint, text, count)
+        plan = self._node(text, 'remote', result, start, estimate)
+        if parts is not None:
+            plan['operator'] = parts[0]
+        return result, plan
+
+    def _combine(self, vs_endpoint, text, operator, operands, count, full, estimates, start):
+        self._count('local_nodes')
+        estimate = estimates.get(text, (None,))[0]
+        results, children = [], []
+        for operand in operands:
+            result, child = self._run(vs_endpoint, operand, count, True, estimates)
+            children.append(child)
+            if result.get('error'):
+                plan = self._node(text, 'local', result, start, estimate)
+                plan.update(operator=operator, children=children)
+                return result, plan
+            results.append(result)
+
+        codes = [{concept['code'] for concept in result['concepts']} for result in results]
+        if operator == 'and':
+            matched = codes[0].intersection(*codes[1:])
+        elif operator == 'or':
+            matched = codes[0].union(*codes[1:])
+        else:
+            matched = codes[0].difference(*codes[1:])
+        # Keep the order in which the operands listed the concepts
+        concepts, seen = [], set()
+        for result in results:
+            for concept in result['concepts']:
+                if concept['code'] in matched and concept['code'] not in seen:
+                    seen.add(concept['code'])
+                    concepts.append(concept)
+        combined = {'total': len(concepts), 'concepts': concepts if full else concepts[:count]}
+        version = next((result['version'] for result in results if result.get('version')), None)
+        if version:
+            combined['version'] = version
+        plan = self._node(text, 'local', combined, start, estimate)
+        plan.update(operator=operator, children=children)
+        return combined, plan
+
+    def _code_set(self, vs_endpoint, text):
+        """Every concept of an expression, fetched page by page and cached by canonical form"""
+        def fetch(vs_endpoint, ecl_expr, count):
+            self._count('code_set_fetches')
+            concepts = []
+            result = {'total': 0, 'concepts': concepts}
+            for page in self._iter_pages(vs_endpoint, ecl_expr, self.page_size):
+                if page.get('error'):
+                    return page
+                concepts.extend(page['concepts'])
+                result['total'] = page['total']
+                if page.get('version'):
+                    result['version'] = page['version']
+            return result
+        return self.code_sets.get_or_expand(fetch, vs_endpoint, text, 0, fetcher.releases.current(vs_endpoint))
+
+    @staticmethod
+    def _node(text, strategy, result, start, estimate=None):
+        return {
+            'expression': text,
+            'strategy': strategy,
+            'estimate': estimate,
+            'total': result.get('total', -1),
+            'error': result.get('error'),
+            'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)
+        }
+
+    def stats(self):
+        """Plan counters and the code set cache statistics"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats['max_local'] = self.max_local
+        stats['max_fetch_pages'] = self.max_fetch_pages
+        stats['code_sets'] = self.code_sets.stats()
+        return stats
+
+
+# Shared planner used by /test_ecl and the batch endpoint
+planner = QueryPlanner()
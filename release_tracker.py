@@ -0,0 +1,106 @@
+"""
+SNOMED CT release tracking per terminology server.
+
+Expansions are only valid for the release the server was serving when it
+answered, so the expansion cache is keyed on the version each endpoint
+currently reports. The tracker holds that version, learnt from the version
+parameter of every expansion and from a cheap periodic probe. When an
+endpoint starts reporting a new version, the previous one is kept for an
+`overlap` period in which its cached entries may still be served while the
+new release warms up; after that the old entries are due to be discarded.
+"""
+
+import threading
+import time
+
+
+class ReleaseTracker:
+    """Current (and, for `overlap` seconds after a change, previous) version of every endpoint"""
+
+    def __init__(self, overlap=600.0, check_interval=300.0, clock=time.monotonic):
+        self.overlap = overlap
+        self.check_interval = check_interval
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._endpoints = {}  # endpoint -> {'current', 'previous', 'changed_at', 'checked_at', 'changes'}
+        self._expired = []    # (endpoint, version) whose overlap has ended
+
+    @staticmethod
+    def _endpoint(vs_endpoint):
+        return vs_endpoint.rstrip('/')
+
+    def _state(self, endpoint):
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = {'current': None, 'previous': None, 'changed_at': None,
+                                                 'checked_at': None, 'changes': 0}
+        return state
+
+    def observe(self, vs_endpoint, version):
+        """
+        Record the version an endpoint reported. Returns the version it
+        replaced when this is a release change, otherwise None.
+        """
+        if not version:
+            return None
+        with self._lock:
+            state = self._state(self._endpoint(vs_endpoint))
+            previous = state['current']
+            if previous == version:
+                return None
+            state['current'] = version
+            if previous is None:
+                return None
+            if state['previous'] is not None and state['previous'] != version:
+                self._expired.append((self._endpoint(vs_endpoint), state['previous']))
+            state['previous'] = previous
+            state['changed_at'] = self._clock()
+            state['changes'] += 1
+            return previous
+
+    def current(self, vs_endpoint):
+        with self._lock:
+            state = self._endpoints.get(self._endpoint(vs_endpoint))
+            return state['current'] if state else None
+
+    def versions(self, vs_endpoint):
+        """(current, previous) for an endpoint; previous is None outside the overlap period"""
+        endpoint = self._endpoint(vs_endpoint)
+        with self._lock:
+            state = self._endpoints.get(endpoint)
+            if state is None:
+                return None, None
+            if state['previous'] is not None and self._clock() - state['changed_at'] >= self.overlap:
+                self._expired.append((endpoint, state['previous']))
+                state['previous'] = None
+            return state['current'], state['previous']
+
+    def take_expired(self):
+        """(endpoint, version) pairs whose overlap has ended since the last call"""
+        with self._lock:
+            expired, self._expired = self._expired, []
+            return expired
+
+    def due_for_check(self, vs_endpoint):
+        """
+        True at most once per check_interval for an endpoint; the caller is
+        expected to probe it. An endpoint is not due before its first answer.
+        """
+        with self._lock:
+            state = self._endpoints.get(self._endpoint(vs_endpoint))
+            if state is None:
+                return False
+            now = self._clock()
+            if state['checked_at'] is None:
+                state['checked_at'] = now
+                return False
+            if now - state['checked_at'] < self.check_interval:
+                return False
+            state['checked_at'] = now
+            return True
+
+    def stats(self):
+        with self._lock:
+            return [{'endpoint': endpoint, 'version': state['current'], 'previous': state['previous'],
+                     'changes': state['changes']}
+                    for endpoint, state in self._endpoints.items()]
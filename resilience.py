@@ -0,0 +1,201 @@
+"""
+Deadlines, retries and circuit breakers for upstream calls.
+
+A deadline is set once per incoming request (deadline()) and carried in a
+context variable, so every upstream call made while handling it - including
+calls on worker pools submitted with submit() - sees the time left and
+shortens its timeout to fit. Idempotent calls are retried a bounded number
+of times with full-jitter exponential backoff, and never past the deadline.
+Each terminology server has a circuit breaker: after repeated failures it
+opens and calls fail fast; after reset_timeout one probe is let through
+(half-open) and its outcome closes or re-opens the breaker.
+
+Calls that block outside Python - SQLite queries on the expansion and job
+stores - go through offload(), which moves them onto the gevent hub's thread
+pool when the worker runs under gevent so they do not stall its other
+requests.
+"""
+
+import contextlib
+import contextvars
+import functools
+import random
+import sys
+import threading
+import time
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Run the enclosed block with a deadline `seconds` from now (None for no deadline)"""
+    if seconds is None:
+        yield
+        return
+    at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Seconds left before the current deadline, or None without one"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def submit(executor, fn, *args):
+    """executor.submit that carries the caller's deadline into the worker thread"""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def offload(fn, *args, **kwargs):
+    """
+    fn(*args, **kwargs) on the gevent hub's thread pool when threading is monkey-patched,
+    so a call that blocks in C does not freeze every greenlet of the worker;
+    a plain call otherwise. Calls made from a pool thread run inline.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is None or not monkey.is_module_patched('threading'):
+        return fn(*args, **kwargs)
+    import gevent
+    return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+
+
+def offloaded(method):
+    """Decorator running every call of `method` through offload()"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        return offload(method, *args, **kwargs)
+    return wrapper
+
+
+def retry(call, is_retryable, retries=2, backoff=0.1, max_backoff=2.0, cancelled=None, sleep=time.sleep,
+          rng=random.random):
+    """
+    Call call() up to 1 + retries times while is_retryable(result) holds,
+    sleeping a random time up to backoff * 2**attempt (capped) in between.
+    Stops early when the deadline would pass during the sleep or `cancelled`
+    is set, returning the last result.
+    """
+    attempt = 0
+    while True:
+        result = call()
+        if attempt >= retries or not is_retryable(result) or (cancelled is not None and cancelled.is_set()):
+            return result
+        delay = rng() * min(max_backoff, backoff * 2 ** attempt)
+        left = remaining()
+        if left is not None and left <= delay:
+            return result
+        sleep(delay)
+        attempt += 1
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one upstream server"""
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.trips = 0
+        self.rejected = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probing = False
+        return self._state
+
+    def allow(self):
+        """True if a call may go ahead; in half-open state only one probe at a time is allowed"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def retry_after(self):
+        """Seconds until an open breaker lets a probe through"""
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (self._clock() - self._opened_at))
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self._probing = False
+
+    def release(self):
+        """Give back a half-open probe slot whose call ended without saying anything about the server"""
+        with self._lock:
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            state = self._current_state()
+            if state == HALF_OPEN or (state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = self._clock()
+                self._probing = False
+                self.trips += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'endpoint': self.name,
+                'state': self._current_state(),
+                'consecutive_failures': self._failures,
+                'trips': self.trips,
+                'rejected': self.rejected
+            }
+
+
+class BreakerRegistry:
+    """One CircuitBreaker per key, created on first use"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def get(self, key):
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(key, self.failure_threshold, self.reset_timeout,
+                                                               self._clock)
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [breaker.stats() for breaker in breakers]
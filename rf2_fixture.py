@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Synthetic SNOMED CT RF2 snapshots for testing the local ECL engine offline.
+
+write_snapshot() lays out RF2 files the way a real release does; the sample
+content is a small, hand-picked slice of the international edition
+(clinical findings, body structures, substances and products) with a few
+attribute relationships, a concrete value, a simple refset and an inactive
+concept.
+
+Usage:
+    python rf2_fixture.py <directory>
+    python rf2_fixture.py <directory> --synthetic 300000
+"""
+
+import os
+import random
+import sys
+
+EFFECTIVE_TIME = '20250101'
+MODULE = '900000000000207008'
+IS_A = '116680003'
+PRIMITIVE = '900000000000074008'
+DEFINED = '900000000000073002'
+FSN = '900000000000003001'
+SYNONYM = '900000000000013009'
+INFERRED = '900000000000011006'
+STATED = '900000000000010007'
+EXISTENTIAL = '900000000000451002'
+US_ENGLISH = '900000000000509007'
+PREFERRED = '900000000000548007'
+ACCEPTABLE = '900000000000549004'
+
+# (sctid, preferred term, semantic tag, parent ids)
+SAMPLE_CONCEPTS = [
+    ('138875005', 'SNOMED CT Concept', 'SNOMED RT+CTV3', []),
+    ('404684003', 'Clinical finding', 'finding', ['138875005']),
+    ('64572001', 'Disease', 'disorder', ['404684003']),
+    ('19829001', 'Disorder of lung', 'disorder', ['64572001']),
+    ('233604007', 'Pneumonia', 'disorder', ['19829001']),
+    ('53084003', 'Bacterial pneumonia', 'disorder', ['233604007']),
+    ('195967001', 'Asthma', 'disorder', ['19829001']),
+    ('73211009', 'Diabetes mellitus', 'disorder', ['64572001']),
+    ('46635009', 'Type 1 diabetes mellitus', 'disorder', ['73211009']),
+    ('44054006', 'Type 2 diabetes mellitus', 'disorder', ['73211009']),
+    ('11687002', 'Gestational diabetes mellitus', 'disorder', ['73211009']),
+    ('125605004', 'Fracture of bone', 'disorder', ['64572001']),
+    ('71620000', 'Fracture of femur', 'disorder', ['125605004']),
+    ('123037004', 'Body structure', 'body structure', ['138875005']),
+    ('39607008', 'Lung structure', 'body structure', ['123037004']),
+    ('3341006', 'Right lung structure', 'body structure', ['39607008']),
+    ('272673000', 'Bone structure', 'body structure', ['123037004']),
+    ('71341001', 'Bone structure of femur', 'body structure', ['272673000']),
+    ('410607006', 'Organism', 'organism', ['138875005']),
+    ('409822003', 'Domain Bacteria', 'organism', ['410607006']),
+    ('105590001', 'Substance', 'substance', ['138875005']),
+    ('387517004', 'Paracetamol', 'substance', ['105590001']),
+    ('387494007', 'Codeine', 'substance', ['105590001']),
+    ('373873005', 'Pharmaceutical / biologic product', 'product', ['138875005']),
+    ('763158003', 'Medicinal product', 'medicinal product', ['373873005']),
+    ('322236009', 'Paracetamol 500 mg oral tablet', 'clinical drug', ['763158003']),
+    ('322280009', 'Paracetamol and codeine oral tablet', 'clinical drug', ['763158003']),
+    ('900000000000441003', 'SNOMED CT Model Component', 'metadata', ['138875005']),
+    ('410662002', 'Concept model attribute', 'attribute', ['900000000000441003']),
+    ('762705008', 'Concept model object attribute', 'attribute', ['410662002']),
+    ('116680003', 'Is a', 'attribute', ['762705008']),
+    ('363698007', 'Finding site', 'attribute', ['762705008']),
+    ('246075003', 'Causative agent', 'attribute', ['762705008']),
+    ('127489000', 'Has active ingredient', 'attribute', ['762705008']),
+    ('762706009', 'Concept model data attribute', 'attribute', ['410662002']),
+    ('1142135004', 'Has presentation strength numerator value', 'attribute', ['762706009']),
+    ('900000000000455006', 'Reference set', 'foundation metadata concept', ['900000000000441003']),
+    ('446609009', 'Simple type reference set', 'foundation metadata concept', ['900000000000455006']),
+    ('723264001', 'Lateralizable body structure reference set', 'foundation metadata concept', ['446609009']),
+]
+
+# (source, type, destination, group)
+SAMPLE_RELATIONSHIPS = [
+    ('19829001', '363698007', '39607008', 1),
+    ('233604007', '363698007', '39607008', 1),
+    ('53084003', '363698007', '39607008', 1),
+    ('53084003', '246075003', '409822003', 1),
+    ('195967001', '363698007', '39607008', 1),
+    ('125605004', '363698007', '272673000', 1),
+    ('71620000', '363698007', '71341001', 1),
+    ('322236009', '127489000', '387517004', 1),
+    ('322280009', '127489000', '387517004', 1),
+    ('322280009', '127489000', '387494007', 2),
+]
+
+# (source, type, value, group)
+SAMPLE_CONCRETE_VALUES = [
+    ('322236009', '1142135004', '#500', 1),
+]
+
+SAMPLE_REFSETS = {
+    '723264001': ['39607008', '3341006', '71341001'],
+}
+
+# Retired concepts: present in the release but inactive
+SAMPLE_INACTIVE = [
+    ('900000000000001000', 'Retired lung disorder', 'disorder'),
+]
+
+
+def _write(path, header, rows):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.write('\t'.join(header) + '\r\n')
+        for row in rows:
+            f.write('\t'.join(str(value) for value in row) + '\r\n')
+
+
+def write_snapshot(root, concepts, relationships=(), concrete_values=(), refsets=None, inactive=(),
+                   effective_time=EFFECTIVE_TIME, module=MODULE):
+    """
+    Write an RF2 snapshot under root/Snapshot. `concepts` holds (sctid, term,
+    semantic tag, parent ids) tuples; parents become inferred and stated IS A
+    relationships. Returns the snapshot directory.
+    """
+    snapshot = os.path.join(root, 'Snapshot')
+    terminology = os.path.join(snapshot, 'Terminology')
+    suffix = f'Snapshot_INT_{effective_time}.txt'
+
+    concept_rows = [(sctid, effective_time, 1, module, PRIMITIVE) for sctid, _, _, _ in concepts]
+    concept_rows += [(sctid, effective_time, 0, module, PRIMITIVE) for sctid, _, _ in inactive]
+    _write(os.path.join(terminology, f'sct2_Concept_{suffix}'),
+           ['id', 'effectiveTime', 'active', 'moduleId', 'definitionStatusId'], concept_rows)
+
+    description_rows = []
+    language_rows = []
+    all_terms = [(sctid, term, tag, True) for sctid, term, tag, _ in concepts]
+    all_terms += [(sctid, term, tag, False) for sctid, term, tag in inactive]
+    for index, (sctid, term, tag, active) in enumerate(all_terms):
+        fsn_id = f'{index + 1}0011'
+        synonym_id = f'{index + 1}0012'
+        description_rows.append((fsn_id, effective_time, int(active), module, sctid, 'en', FSN,
+                                 f'{term} ({tag})', '900000000000448009'))
+        description_rows.append((synonym_id, effective_time, int(active), module, sctid, 'en', SYNONYM,
+                                 term, '900000000000448009'))
+        language_rows.append((f'{index}-fsn', effective_time, 1, module, US_ENGLISH, fsn_id, PREFERRED))
+        language_rows.append((f'{index}-syn', effective_time, 1, module, US_ENGLISH, synonym_id, PREFERRED))
+    _write(os.path.join(terminology, f'sct2_Description_{suffix.replace("_INT", "-en_INT")}'),
+           ['id', 'effectiveTime', 'active', 'moduleId', 'conceptId', 'languageCode', 'typeId', 'term',
+            'caseSignificanceId'], description_rows)
+
+    relationship_header = ['id', 'effectiveTime', 'active', 'moduleId', 'sourceId', 'destinationId',
+                           'relationshipGroup', 'typeId', 'characteristicTypeId', 'modifierId']
+    is_a = [(sctid, IS_A, parent, 0) for sctid, _, _, parents in concepts for parent in parents]
+    inferred = [(f'{i + 1}0024', effective_time, 1, module, source, destination, group, type_id, INFERRED,
+                 EXISTENTIAL)
+                for i, (source, type_id, destination, group) in enumerate(is_a + list(relationships))]
+    stated = [(f'{i + 1}0025', effective_time, 1, module, source, destination, group, type_id, STATED,
+               EXISTENTIAL)
+              for i, (source, type_id, destination, group) in enumerate(is_a)]
+    _write(os.path.join(terminology, f'sct2_Relationship_{suffix}'), relationship_header, inferred)
+    _write(os.path.join(terminology, f'sct2_StatedRelationship_{suffix}'), relationship_header, stated)
+    _write(os.path.join(terminology, f'sct2_RelationshipConcreteValues_{suffix}'),
+           ['id', 'effectiveTime', 'active', 'moduleId', 'sourceId', 'value', 'relationshipGroup', 'typeId',
+            'characteristicTypeId', 'modifierId'],
+           [(f'{i + 1}0026', effective_time, 1, module, source, value, group, type_id, INFERRED, EXISTENTIAL)
+            for i, (source, type_id, value, group) in enumerate(concrete_values)])
+
+    refset_rows = [(f'{refset_id}-{i}', effective_time, 1, module, refset_id, member)
+                   for refset_id, members in (refsets or {}).items() for i, member in enumerate(members)]
+    _write(os.path.join(snapshot, 'Refset', 'Content', f'der2_Refset_Simple{suffix}'),
+           ['id', 'effectiveTime', 'active', 'moduleId', 'refsetId', 'referencedComponentId'], refset_rows)
+    _write(os.path.join(snapshot, 'Refset', 'Language', f'der2_cRefset_Language{suffix.replace("_INT", "-en_INT")}'),
+           ['id', 'effectiveTime', 'active', 'moduleId', 'refsetId', 'referencedComponentId', 'acceptabilityId'],
+           language_rows)
+    return snapshot
+
+
+SYNTHETIC_WORDS = ['acute', 'chronic', 'disorder', 'lesion', 'infection', 'fracture', 'structure', 'left',
+                   'right', 'upper', 'lower', 'neoplasm', 'injury', 'syndrome', 'deficiency', 'tablet',
+                   'injection', 'finding', 'procedure', 'pain']
+FINDING_SITE = '363698007'
+CAUSATIVE_AGENT = '246075003'
+
+
+def synthetic_sctid(i):
+    """Distinct SCTID-shaped identifiers for generated concepts"""
+    return str(10000000 + i) + '1'
+
+
+def write_synthetic_snapshot(root, concepts=100000, seed=1):
+    """
+    Write a randomly generated snapshot of roughly `concepts` concepts: a deep
+    multi-parent hierarchy under the root plus finding site and causative
+    agent relationships into two separate branches, and a few refsets.
+    """
+    rng = random.Random(seed)
+    root_id = '138875005'
+    rows = [(root_id, 'SNOMED CT Concept', 'SNOMED RT+CTV3', []),
+            (FINDING_SITE, 'Finding site', 'attribute', [root_id]),
+            (CAUSATIVE_AGENT, 'Causative agent', 'attribute', [root_id])]
+    ids = []
+    for i in range(concepts):
+        sctid = synthetic_sctid(i)
+        if i < 3:
+            parents = [root_id]
+        else:
+            # Mostly attach to recent concepts so the hierarchy gets deep; sometimes add a second parent
+            parents = {ids[max(0, i - 1 - int(rng.expovariate(1 / 50)))]}
+            if rng.random() < 0.3:
+                parents.add(ids[rng.randrange(i)])
+        term = ' '.join(rng.choice(SYNTHETIC_WORDS) for _ in range(3)) + f' {i}'
+        rows.append((sctid, term, 'disorder', sorted(parents)))
+        ids.append(sctid)
+
+    sites = ids[1::3][:concepts // 10]
+    agents = ids[2::3][:concepts // 10]
+    relationships = []
+    for sctid in ids[::2]:
+        relationships.append((sctid, FINDING_SITE, rng.choice(sites), 1))
+        if rng.random() < 0.2:
+            relationships.append((sctid, CAUSATIVE_AGENT, rng.choice(agents), 1))
+    refsets = {synthetic_sctid(concepts + r): rng.sample(ids, min(len(ids), 1000)) for r in range(3)}
+    rows.extend((refset, f'Synthetic reference set {r}', 'foundation metadata concept', [root_id])
+                for r, refset in enumerate(refsets))
+    return write_snapshot(root, rows, relationships, refsets=refsets)
+
+
+def write_sample_snapshot(root):
+    """Write the small sample snapshot used by the tests"""
+    return write_snapshot(root, SAMPLE_CONCEPTS, SAMPLE_RELATIONSHIPS, SAMPLE_CONCRETE_VALUES,
+                          SAMPLE_REFSETS, SAMPLE_INACTIVE)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[2] == '--synthetic':
+        print(write_synthetic_snapshot(sys.argv[1], int(sys.argv[3])))
+    elif len(sys.argv) == 2:
+        print(write_sample_snapshot(sys.argv[1]))
+    else:
+        sys.exit(__doc__)
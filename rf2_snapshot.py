@@ -0,0 +1,204 @@
+"""
+SNOMED CT RF2 snapshot loaded from the release text files into dicts.
+
+Rf2Snapshot and compiled_snapshot.CompiledSnapshot expose the same lookup
+methods, so the local ECL engine can run on either: the text files are
+convenient for small or synthetic snapshots, the compiled file for a full
+release.
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from closure_index import ClosureIndex
+
+logger = logging.getLogger(__name__)
+
+IS_A = 116680003
+FSN = 900000000000003001
+SYNONYM = 900000000000013009
+DEFINITION = 900000000000550004
+PREFERRED = '900000000000548007'
+
+
+def _rows(path):
+    """Data rows of an RF2 file as lists of strings, skipping the header"""
+    with open(path, 'r', encoding='utf-8') as f:
+        next(f, None)
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line:
+                yield line.split('\t')
+
+
+def find_release_files(root):
+    """Classify the snapshot files under root by RF2 file type"""
+    files = {'concepts': [], 'descriptions': [], 'relationships': [], 'stated': [], 'concrete': [],
+             'refsets': [], 'language': []}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in sorted(filenames):
+            if 'Snapshot' not in name or not name.endswith('.txt'):
+                continue
+            path = os.path.join(dirpath, name)
+            if name.startswith('sct2_Concept_'):
+                files['concepts'].append(path)
+            elif name.startswith('sct2_Description_'):
+                files['descriptions'].append(path)
+            elif name.startswith('sct2_RelationshipConcreteValues_'):
+                files['concrete'].append(path)
+            elif name.startswith('sct2_Relationship_'):
+                files['relationships'].append(path)
+            elif name.startswith('sct2_StatedRelationship_'):
+                files['stated'].append(path)
+            elif name.startswith('der2_'):
+                if 'Language' in name:
+                    files['language'].append(path)
+                files['refsets'].append(path)
+    return files
+
+
+def parse_concrete_value(text):
+    """RF2 concrete values: #number, "string" or true/false"""
+    if text.startswith('#'):
+        number = text[1:]
+        return float(number) if '.' in number else int(number)
+    if text.startswith('"'):
+        return text[1:-1]
+    return text.lower() == 'true'
+
+
+class Rf2Snapshot:
+    """
+    Active content of an RF2 snapshot: concepts, relationships (inferred, or
+    stated if there is no inferred file), concrete values, descriptions and
+    reference set members.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        start = time.perf_counter()
+        files = find_release_files(path)
+        if not files['concepts']:
+            raise FileNotFoundError(f'No RF2 concept snapshot found under {path}')
+
+        self._active = set()
+        self._module = {}
+        self._definition_status = {}
+        effective_times = Counter()
+        for file in files['concepts']:
+            for row in _rows(file):
+                if row[2] == '1':
+                    sctid = int(row[0])
+                    self._active.add(sctid)
+                    self._module[sctid] = int(row[3])
+                    self._definition_status[sctid] = int(row[4])
+                    effective_times[row[1]] += 1
+
+        self._parents = {}
+        self._children = {}
+        self._outgoing = {}   # source -> [(group, type, destination)]
+        self._incoming = {}   # destination -> [(group, type, source)]
+        self._concrete = {}   # source -> [(group, type, value)]
+        for file in files['relationships'] or files['stated']:
+            for row in _rows(file):
+                if row[2] != '1':
+                    continue
+                source, destination, group, type_id = int(row[4]), int(row[5]), int(row[6]), int(row[7])
+                if type_id == IS_A:
+                    self._parents.setdefault(source, set()).add(destination)
+                    self._children.setdefault(destination, set()).add(source)
+                else:
+                    self._outgoing.setdefault(source, []).append((group, type_id, destination))
+                    self._incoming.setdefault(destination, []).append((group, type_id, source))
+        for file in files['concrete']:
+            for row in _rows(file):
+                if row[2] == '1':
+                    self._concrete.setdefault(int(row[4]), []).append(
+                        (int(row[6]), int(row[7]), parse_concrete_value(row[5])))
+
+        self._members = {}
+        for file in files['refsets']:
+            for row in _rows(file):
+                if row[2] == '1' and row[5].isdigit():
+                    self._members.setdefault(int(row[4]), set()).add(int(row[5]))
+
+        preferred = set()
+        for file in files['language']:
+            for row in _rows(file):
+                if row[2] == '1' and row[6] == PREFERRED:
+                    preferred.add(row[5])
+
+        self._descriptions = {}  # concept -> [(type, language, term)]
+        self._display = {}
+        display_rank = {}
+        for file in files['descriptions']:
+            for row in _rows(file):
+                if row[2] != '1':
+                    continue
+                concept, type_id, term = int(row[4]), int(row[6]), row[7]
+                self._descriptions.setdefault(concept, []).append((type_id, row[5], term))
+                # Preferred synonym, then any synonym, then the FSN
+                rank = 0 if type_id == SYNONYM and row[0] in preferred else 1 if type_id == SYNONYM else 2
+                if rank < display_rank.get(concept, 3):
+                    display_rank[concept] = rank
+                    self._display[concept] = term
+
+        self._closure = None
+        self._closure_lock = threading.Lock()
+
+        modules = Counter(self._module.values())
+        self.version = (f'http://snomed.info/sct/{modules.most_common(1)[0][0]}/version/{max(effective_times)}'
+                        if effective_times else None)
+        logger.info(f'Loaded RF2 snapshot {path}: {len(self._active)} active concepts in '
+                    f'{time.perf_counter() - start:.1f}s')
+
+    def concepts(self):
+        """Set of active concept ids"""
+        return self._active
+
+    def is_active(self, sctid):
+        return sctid in self._active
+
+    def parents(self, sctid):
+        return self._parents.get(sctid, ())
+
+    def children(self, sctid):
+        return self._children.get(sctid, ())
+
+    def outgoing(self, sctid):
+        return self._outgoing.get(sctid, ())
+
+    def incoming(self, sctid):
+        return self._incoming.get(sctid, ())
+
+    def concrete(self, sctid):
+        return self._concrete.get(sctid, ())
+
+    def refsets(self):
+        return self._members.keys()
+
+    def members(self, refset):
+        return self._members.get(refset, ())
+
+    def descriptions(self, sctid):
+        return self._descriptions.get(sctid, ())
+
+    def display(self, sctid):
+        return self._display.get(sctid)
+
+    def module(self, sctid):
+        return self._module.get(sctid)
+
+    def definition_status(self, sctid):
+        return self._definition_status.get(sctid)
+
+    def closure(self):
+        """Transitive-closure index of the is-a hierarchy, built on first use"""
+        with self._closure_lock:
+            if self._closure is None:
+                self._closure = ClosureIndex.build(self)
+                logger.info(f'Built closure index for {self.path} in {self._closure.build_seconds:.1f}s')
+        return self._closure
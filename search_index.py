@@ -0,0 +1,294 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+CONCEPT_ID_RE = re.compile(r'\b\d{6,18}\b')
+TERM_RE = re.compile(r'\|([^|]*)\|')
+
+# Searchable fields and their BM25F weights
+FIELDS = ('filename', 'description', 'category', 'expression', 'codes', 'terms')
+FIELD_WEIGHTS = (2.0, 3.0, 1.5, 1.0, 2.0, 2.5)
+
+K1 = 1.2
+B = 0.75
+PREFIX_WEIGHT = 0.6
+SUBSTRING_WEIGHT = 0.4
+MAX_EXPANSIONS = 16
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+def trigrams(term):
+    return {term[i:i + 3] for i in range(len(term) - 2)}
+
+
+def entry_fields(entry):
+    """Split a catalog entry into the token lists of each searchable field"""
+    expression = entry['expression']
+    return (
+        tokenize(entry['filename']),
+        tokenize(entry['description']),
+        tokenize(entry['category']),
+        tokenize(expression),
+        CONCEPT_ID_RE.findall(expression),
+        tokenize(' '.join(TERM_RE.findall(expression)))
+    )
+
+
+class SearchIndex:
+    """
+    Inverted index over the ECL catalog with BM25F ranking.
+
+    Each query token matches exact vocabulary terms, terms it is a prefix of
+    (so typeahead works mid-word) and, through a trigram index over the
+    vocabulary, terms containing it. All query tokens must match. Per-term
+    posting lists are kept sorted by impact so the top results are found with
+    the threshold algorithm instead of scoring every matching document.
+    Entries are added and removed incrementally, keyed on their path.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = []        # doc id -> entry, None once removed
+        self._doc_ids = {}        # path -> doc id
+        self._doc_terms = {}      # doc id -> {term: per-field tf tuple}
+        self._doc_lengths = {}    # doc id -> per-field length tuple
+        self._length_sums = [0] * len(FIELDS)
+        self._postings = {}       # term -> {doc id: per-field tf tuple}
+        self._vocab = []          # sorted terms, for prefix lookups
+        self._trigrams = {}       # trigram -> set of terms
+        self._impacts = {}        # term -> (sorted [(-score, doc id)], {doc id: score})
+        self._impacts_doc_count = 0
+        self._expansions = {}     # query token -> matched terms, until the vocabulary changes
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    def on_catalog_change(self, added, changed, removed):
+        """EclCatalog listener keeping the index in step with the library"""
+        with self._lock:
+            for entry in removed:
+                self.remove(entry['path'])
+            self.add_many(added + changed)
+
+    def add(self, entry):
+        self.add_many([entry])
+
+    def add_many(self, entries):
+        """Index (or re-index) entries; the vocabulary is re-sorted once per batch"""
+        with self._lock:
+            new_terms = []
+            for entry in entries:
+                self.remove(entry['path'])
+                doc_id = len(self._entries)
+                self._entries.append(entry)
+                self._doc_ids[entry['path']] = doc_id
+
+                fields = entry_fields(entry)
+                lengths = tuple(len(tokens) for tokens in fields)
+                term_freqs = {}
+                for field, tokens in enumerate(fields):
+                    for token in tokens:
+                        tfs = term_freqs.setdefault(token, [0] * len(FIELDS))
+                        tfs[field] += 1
+                self._doc_lengths[doc_id] = lengths
+                self._doc_terms[doc_id] = {t: tuple(tfs) for t, tfs in term_freqs.items()}
+                for i, length in enumerate(lengths):
+                    self._length_sums[i] += length
+
+                for term, tfs in self._doc_terms[doc_id].items():
+                    postings = self._postings.get(term)
+                    if postings is None:
+                        postings = self._postings[term] = {}
+                        new_terms.append(term)
+                    postings[doc_id] = tfs
+                    impacts = self._impacts.get(term)
+                    if impacts is not None:
+                        # Keep the cached impact list sorted instead of rebuilding it
+                        score = self._doc_impact(doc_id, tfs, self._idf(len(postings)))
+                        bisect.insort(impacts[0], (-score, doc_id))
+                        impacts[1][doc_id] = score
+
+            if new_terms:
+                self._expansions.clear()
+                if len(new_terms) > 100:
+                    self._vocab = sorted(self._postings)
+                else:
+                    for term in new_terms:
+                        bisect.insort(self._vocab, term)
+                for term in new_terms:
+                    for gram in trigrams(term):
+                        self._trigrams.setdefault(gram, set()).add(term)
+            self._check_impact_drift()
+            if len(entries) > 100:
+                # Bulk load: build every impact list now rather than on first query
+                for term in self._postings:
+                    self._term_impacts(term)
+
+    def remove(self, path):
+        """Drop an entry from the index; unknown paths are ignored"""
+        with self._lock:
+            doc_id = self._doc_ids.pop(path, None)
+            if doc_id is None:
+                return
+            self._entries[doc_id] = None
+            for i, length in enumerate(self._doc_lengths.pop(doc_id)):
+                self._length_sums[i] -= length
+            for term in self._doc_terms.pop(doc_id):
+                postings = self._postings[term]
+                del postings[doc_id]
+                impacts = self._impacts.get(term)
+                if impacts is not None:
+                    score = impacts[1].pop(doc_id)
+                    ordered = impacts[0]
+                    index = bisect.bisect_left(ordered, (-score, doc_id))
+                    if index < len(ordered) and ordered[index][1] == doc_id:
+                        del ordered[index]
+                if not postings:
+                    del self._postings[term]
+                    self._impacts.pop(term, None)
+                    self._expansions.clear()
+                    index = bisect.bisect_left(self._vocab, term)
+                    if index < len(self._vocab) and self._vocab[index] == term:
+                        del self._vocab[index]
+                    for gram in trigrams(term):
+                        self._trigrams[gram].discard(term)
+
+    def _check_impact_drift(self):
+        # idf and average lengths depend on the collection size; cached impact
+        # lists are rebuilt once it has drifted by more than 10%
+        size = len(self._doc_ids)
+        if abs(size - self._impacts_doc_count) > 0.1 * max(self._impacts_doc_count, 1):
+            self._impacts.clear()
+            self._impacts_doc_count = size
+
+    def _idf(self, doc_freq):
+        n = max(len(self._doc_ids), 1)
+        return math.log(1 + (n - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def _doc_impact(self, doc_id, tfs, idf):
+        n = max(len(self._doc_ids), 1)
+        lengths = self._doc_lengths[doc_id]
+        tf = 0.0
+        for field, count in enumerate(tfs):
+            if count:
+                average = max(self._length_sums[field] / n, 1e-9)
+                tf += FIELD_WEIGHTS[field] * count / (1 - B + B * lengths[field] / average)
+        return idf * tf / (K1 + tf)
+
+    def _term_impacts(self, term):
+        cached = self._impacts.get(term)
+        if cached is not None:
+            return cached
+        postings = self._postings[term]
+        idf = self._idf(len(postings))
+        scores = {doc_id: self._doc_impact(doc_id, tfs, idf) for doc_id, tfs in postings.items()}
+        ordered = sorted((-score, doc_id) for doc_id, score in scores.items())
+        cached = self._impacts[term] = (ordered, scores)
+        return cached
+
+    def _expand_token(self, token):
+        """Vocabulary terms matched by a query token, with their match weight"""
+        matches = self._expansions.get(token)
+        if matches is not None:
+            return matches
+        if len(self._expansions) > 10000:
+            self._expansions.clear()
+        matches = self._expansions[token] = {}
+        if token in self._postings:
+            matches[token] = 1.0
+        # Terms are [a-z0-9]+ so every term starting with token sorts before token + '{'
+        start = bisect.bisect_left(self._vocab, token)
+        end = bisect.bisect_left(self._vocab, token + '{', start)
+        prefixed = [term for term in self._vocab[start:end] if term != token]
+        by_frequency = lambda term: -len(self._postings[term])
+        for term in sorted(prefixed, key=by_frequency)[:MAX_EXPANSIONS]:
+            matches[term] = PREFIX_WEIGHT
+
+        # Mid-word matches are a fallback for tokens with few prefix matches
+        if len(token) >= 3 and len(matches) < MAX_EXPANSIONS:
+            candidates = None
+            for gram in sorted(trigrams(token), key=lambda g: len(self._trigrams.get(g, ()))):
+                terms = self._trigrams.get(gram, set())
+                candidates = terms if candidates is None else candidates & terms
+                if not candidates:
+                    break
+            substrings = [t for t in candidates or () if token in t and not t.startswith(token)]
+            for term in sorted(substrings, key=by_frequency)[:MAX_EXPANSIONS - len(matches)]:
+                matches[term] = SUBSTRING_WEIGHT
+        return matches
+
+    def _token_stream(self, matches):
+        """Sorted (descending) stream of (score, doc id) over a token's expansions"""
+        streams = [((-neg_score * weight, doc_id) for neg_score, doc_id in self._term_impacts(term)[0])
+                   for term, weight in matches.items()]
+        if len(streams) == 1:
+            return streams[0]
+        return heapq.merge(*streams, reverse=True)
+
+    def _token_lookups(self, matches):
+        """(score dict, weight) pairs used for random access to a token's scores"""
+        return [(self._term_impacts(term)[1], weight) for term, weight in matches.items()]
+
+    @staticmethod
+    def _token_score(lookups, doc_id):
+        best = 0.0
+        for scores, weight in lookups:
+            score = scores.get(doc_id)
+            if score is not None and score * weight > best:
+                best = score * weight
+        return best
+
+    def search(self, query, limit=10):
+        """Return up to `limit` (score, entry) pairs, best first"""
+        tokens = list(dict.fromkeys(tokenize(query)))
+        if not tokens:
+            return []
+        with self._lock:
+            expansions = [self._expand_token(token) for token in tokens]
+            if not all(expansions):
+                return []
+            streams = [self._token_stream(matches) for matches in expansions]
+            lookups = [self._token_lookups(matches) for matches in expansions]
+            frontier = [float('inf')] * len(streams)
+            seen = set()
+            top = []  # min-heap of (score, doc id)
+
+            # Threshold algorithm: round-robin sorted access, random access to
+            # complete each new document's score, stop once no unseen document
+            # can beat the current k-th best
+            active = True
+            while active:
+                for i, stream in enumerate(streams):
+                    item = next(stream, None)
+                    if item is None:
+                        # Every document matching all tokens appears in this stream
+                        active = False
+                        break
+                    score, doc_id = item
+                    frontier[i] = score
+                    if doc_id in seen:
+                        continue
+                    seen.add(doc_id)
+                    total = 0.0
+                    for j, token_lookups in enumerate(lookups):
+                        part = score if j == i else self._token_score(token_lookups, doc_id)
+                        if part == 0.0:
+                            break
+                        total += part
+                    else:
+                        if len(top) < limit:
+                            heapq.heappush(top, (total, -doc_id))
+                        elif total > top[0][0]:
+                            heapq.heapreplace(top, (total, -doc_id))
+                if active and len(top) >= limit and top[0][0] >= sum(frontier):
+                    break
+
+            results = [(score, self._entries[-neg_id]) for score, neg_id in top]
+        results.sort(key=lambda item: (-item[0], item[1]['filename']))
+        return results
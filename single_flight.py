@@ -0,0 +1,176 @@
+"""
+Coalescing of identical concurrent calls ("single flight").
+
+Within a process, the first caller for a key runs the call and every caller
+that arrives while it is in flight waits for and shares its result. Across
+worker processes, the leader also holds an exclusive lock file for the key;
+a leader in another process blocks on that lock and then re-checks a shared
+result store (the on-disk expansion store) before calling upstream itself.
+Lock files need fcntl, so on platforms without it only threads are coalesced.
+
+Nobody waits past their own request deadline (resilience.remaining()): a
+follower whose deadline passes while the leader is still busy, or a leader
+that cannot get the lock file in time, gives up with the caller's `expired`
+result instead, so an interactive request never hangs on a call led by a
+background job or the cache warmer.
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+import resilience
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. `lock_dir` enables the
+    cross-process lock files; None coalesces threads only.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir if fcntl is not None else None
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {'calls': 0, 'upstream_calls': 0, 'coalesced': 0, 'process_coalesced': 0,
+                          'expired': 0}
+
+    def do(self, key, func, recheck=None, expired=None):
+        """
+        Return func() for key, sharing one execution between concurrent
+        callers. With lock files, recheck() is called once the process lock
+        is held; a result other than None means another process already did
+        the work and func is skipped. A caller whose deadline passes while it
+        waits gets expired() (TimeoutError is raised when expired is None).
+        """
+        with self._lock:
+            self._counters['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._counters['coalesced'] += 1
+        if not leader:
+            if not call.done.wait(resilience.remaining()):
+                return self._expired(expired)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._lead(key, func, recheck, expired)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _lead(self, key, func, recheck, expired):
+        if not self.lock_dir:
+            self._count('upstream_calls')
+            return func()
+        lock = self._process_lock(key)
+        if not lock.acquire(resilience.remaining()):
+            return self._expired(expired)
+        try:
+            if recheck is not None:
+                result = recheck()
+                if result is not None:
+                    self._count('process_coalesced')
+                    return result
+            self._count('upstream_calls')
+            return func()
+        finally:
+            lock.release()
+
+    def _expired(self, expired):
+        self._count('expired')
+        if expired is None:
+            raise TimeoutError('Request deadline exceeded while waiting for a coalesced call')
+        return expired()
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def _process_lock(self, key):
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).hexdigest()
+        return _LockFile(os.path.join(self.lock_dir, f'{digest}.lock'))
+
+    def stats(self):
+        """How many calls were made and how many shared another caller's result"""
+        with self._lock:
+            stats = dict(self._counters)
+            stats['in_flight'] = len(self._calls)
+        stats['cross_process'] = bool(self.lock_dir)
+        return stats
+
+
+class _LockFile:
+    """
+    Exclusive flock on a per-key file, removed again on release. A waiter that
+    wakes up holding the lock on a file that has since been removed retries on
+    the new one, so two processes never both hold the lock for a key. The
+    lock is polled rather than waited for in flock, which can neither time
+    out nor give way to other greenlets under gevent (time.sleep does).
+    """
+
+    POLL_INTERVAL = 0.01
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, timeout=None):
+        """Take the lock; False if `timeout` seconds passed first (None waits for as long as it takes)"""
+        until = None if timeout is None else time.monotonic() + timeout
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            if not self._flock(fd, until):
+                os.close(fd)
+                return False
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    self.fd = fd
+                    return True
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    def _flock(self, fd, until):
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                left = None if until is None else until - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                time.sleep(self.POLL_INTERVAL if left is None else min(self.POLL_INTERVAL, left))
+
+    def release(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
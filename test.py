@@ -1,9 +1,44 @@
 import os, shutil
+import tempfile
+import threading
 import json
+import time
 import urllib
 import unittest
+
+# Keep test runs out of the on-disk expansion store and away from the live server
+os.environ.setdefault('EXPANSION_STORE', '')
+os.environ.setdefault('CACHE_WARMER', 'false')
+os.environ.setdefault('JOB_STORE', os.path.join(tempfile.mkdtemp(prefix='ecl-test-jobs-'), 'jobs.sqlite3'))
+
 import fetcher
 import glob
+from fake_tx_server import FakeTerminologyServer
+from expansion_cache import ExpansionCache
+from expansion_store import ExpansionStore
+from single_flight import SingleFlight
+import resilience
+from resilience import CircuitBreaker
+from ecl_catalog import EclCatalog
+from search_index import SearchIndex
+from expansion_decoder import decode_expansion, EmptyResponseError
+import ecl_parser
+from ecl_parser import EclSyntaxError
+from ecl_canonical import canonicalize, canonical_key, collapse_report
+from fake_tx_server import build_expansion, operation_outcome, SNOMED_VERSION
+import local_engine
+from rf2_fixture import write_sample_snapshot, write_synthetic_snapshot
+from rf2_snapshot import Rf2Snapshot
+from compiled_snapshot import compile_snapshot, CompiledSnapshot
+from closure_index import iter_ordinals
+from query_planner import QueryPlanner
+from cache_warmer import CacheWarmer, InteractiveGate
+from release_tracker import ReleaseTracker
+import metrics
+from metrics import Registry
+from jobs import JobRunner, JobStore
+import profiling
+from profiling import PhaseTimings, SamplingProfiler
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -19,6 +54,9 @@ def create_test_folder():
     os.makedirs(npm_dir) 
     return npm_dir
 
+# Test snapshots are written under the test folder, which local:// endpoints may name
+local_engine.LOCAL_RF2_ROOTS = (os.path.join(os.environ['HOME'], 'tmp'),)
+
 def read_ecl_files():
     """Read all ECL files from the ecl_library directory - same logic as main.py"""
     ecl_files = []
@@ -138,6 +176,533 @@ class TestECLLibrary(unittest.TestCase):
                     )
 
 
+class TestEclParser(unittest.TestCase):
+    """Test the local ECL parser"""
+
+    def test_library_expressions_parse(self):
+        """Test that every expression in the library is accepted"""
+        for ecl_file in read_ecl_files():
+            with self.subTest(filename=ecl_file['filename']):
+                self.assertIsNone(ecl_parser.validate(ecl_file['expression']))
+
+    def test_constraint_operators(self):
+        """Test symbolic and long-form constraint operators"""
+        for text, operator in [('< 404684003', 'descendantOf'), ('<<404684003', 'descendantOrSelfOf'),
+                               ('<! 404684003', 'childOf'), ('>> 404684003', 'ancestorOrSelfOf'),
+                               ('>! 404684003', 'parentOf'), ('!!> 404684003', 'top'),
+                               ('descendantOrSelfOf 404684003', 'descendantOrSelfOf')]:
+            with self.subTest(text=text):
+                self.assertEqual(ecl_parser.parse(text).operator, operator)
+        reference = ecl_parser.parse('404684003 |Clinical finding (finding)|')
+        self.assertIsNone(reference.operator)
+        self.assertEqual(reference.focus, ecl_parser.ConceptReference('404684003', 'Clinical finding (finding)'))
+        self.assertIsInstance(ecl_parser.parse('*').focus, ecl_parser.Wildcard)
+
+    def test_member_of_and_compounds(self):
+        """Test member-of and AND/OR/MINUS"""
+        member = ecl_parser.parse('^ [referencedComponentId] 929360061000036106 |Medicinal product reference set|')
+        self.assertTrue(member.member_of)
+        self.assertEqual(member.refset_fields, ['referencedComponentId'])
+
+        compound = ecl_parser.parse('< 19829001 OR < 301867009 or < 128139000')
+        self.assertEqual((compound.operator, len(compound.operands)), ('or', 3))
+        self.assertEqual(ecl_parser.parse('< 19829001, < 301867009').operator, 'and')
+        minus = ecl_parser.parse('(< 19829001 AND < 301867009) MINUS < 128139000')
+        self.assertEqual(minus.operator, 'minus')
+        self.assertIsInstance(minus.operands[0].focus, ecl_parser.Compound)
+
+    def test_refinements(self):
+        """Test attributes, groups, cardinality, reverse flags, concrete values and dotted attributes"""
+        refined = ecl_parser.parse(
+            '< 404684003 : [1..*] { 363698007 = << 39057004, 116676008 != << 79654002 }, R 246075003 = *')
+        self.assertIsInstance(refined, ecl_parser.Refined)
+        group, reverse = refined.refinement.operands
+        self.assertEqual(group.cardinality, ecl_parser.Cardinality(1, None))
+        self.assertEqual([a.operator for a in group.refinement.operands], ['=', '!='])
+        self.assertTrue(reverse.reverse)
+
+        numeric = ecl_parser.parse('< 763158003 : 1142135004 >= #2.5').refinement
+        self.assertEqual(numeric.value, ecl_parser.ConcreteValue('numeric', 2.5))
+        dotted = ecl_parser.parse('< 125605004 . 363698007')
+        self.assertEqual(dotted.attributes[0].focus.sctid, '363698007')
+        unspaced = ecl_parser.parse('<404684003.363698007')
+        self.assertEqual((unspaced.expression.focus.sctid, unspaced.attributes[0].focus.sctid),
+                         ('404684003', '363698007'))
+        self.assertIsNone(ecl_parser.validate('< 125605004.363698007.272741003'))
+        negative = ecl_parser.parse('< 763158003 : 1142135004 = #-0.25').refinement
+        self.assertEqual(negative.value, ecl_parser.ConcreteValue('numeric', -0.25))
+
+    def test_filters(self):
+        """Test description and concept filters and history supplements"""
+        expression = ecl_parser.parse('< 404684003 {{ D term = "heart", language = en }} {{ C active = true }}'
+                                      ' {{ +HISTORY-MIN }}')
+        description, concept, history = expression.filters
+        self.assertEqual(description.domain, 'D')
+        self.assertEqual(description.conditions[0].value, ecl_parser.ConcreteValue('string', 'heart'))
+        self.assertEqual(concept.conditions[0].value, ecl_parser.ConcreteValue('boolean', True))
+        self.assertEqual(history.profile, 'MIN')
+
+    def test_error_positions(self):
+        """Test that syntax errors report the offending line and column"""
+        cases = [
+            ('<< 404684003 :', 1, 15),
+            ('<< 404684003 |Clinical finding', 1, 14),
+            ('< 19829001 AND < 301867009 OR < 128139000', 1, 28),
+            ('< 404684003 :\n  363698007 << 39057004', 2, 13),
+            ('< 12345', 1, 3),
+            ('< 404684003 {{ term = "heart" ', 1, 31),
+            ('(< 19829001', 1, 12),
+            ('', 1, 1),
+        ]
+        for text, line, column in cases:
+            with self.subTest(text=text), self.assertRaises(EclSyntaxError) as raised:
+                ecl_parser.parse(text)
+            self.assertEqual((raised.exception.line, raised.exception.column), (line, column))
+            self.assertIsInstance(raised.exception, ValueError)
+
+    def test_test_ecl_rejects_locally(self):
+        """Test that /test_ecl reports syntax errors without calling the server"""
+        from main import app
+        app.config['TESTING'] = True
+        with FakeTerminologyServer() as server:
+            response = app.test_client().post('/test_ecl', json={
+                'expression': '<< 404684003 |x| AND', 'filename': 'bad.txt', 'endpoint': server.url})
+            self.assertEqual(server.request_count, 0)
+        self.assertEqual(response.json['total'], -1)
+        self.assertIn('Invalid ECL', response.json['error'])
+        self.assertEqual(response.json['syntax_error']['position'], 20)
+
+        response = app.test_client().post('/validate_ecl', json={'expression': '< 404684003 |Clinical finding|'})
+        self.assertEqual(response.json, {'valid': True})
+
+
+class TestEclCanonical(unittest.TestCase):
+    """Test canonical ECL forms used for cache keys"""
+
+    def test_cosmetic_variants_share_a_key(self):
+        """Test that terms, whitespace, operator spellings, parentheses and operand order are ignored"""
+        variants = [
+            '^ 929360061000036106 |Medicinal product reference set| AND << 404684003',
+            '<< 404684003 |Clinical finding|, ^ 929360061000036106 | Medicinal product reference set |',
+            '(descendantOrSelfOf 404684003)\n  and\n(memberOf 929360061000036106)',
+            '((^ 929360061000036106)) AND << 404684003 AND << 404684003',
+        ]
+        self.assertEqual({canonicalize(v) for v in variants}, {'<< 404684003 AND ^ 929360061000036106'})
+        self.assertEqual(len({canonical_key(v) for v in variants}), 1)
+
+    def test_meaning_is_preserved(self):
+        """Test that operators, MINUS order and needed parentheses are kept"""
+        self.assertNotEqual(canonical_key('< 404684003'), canonical_key('<< 404684003'))
+        self.assertEqual(canonicalize('< 73211009 MINUS << 11687002'), '< 73211009 MINUS << 11687002')
+        self.assertNotEqual(canonical_key('< 73211009 MINUS < 11687002'), canonical_key('< 11687002 MINUS < 73211009'))
+        self.assertEqual(canonicalize('(< 19829001 OR < 301867009) : 363698007 = *'),
+                         '(< 19829001 OR < 301867009) : 363698007 = *')
+        self.assertEqual(canonicalize('< 404684003 : { 363698007 = *, 116676008 = * }'),
+                         '< 404684003 : { 116676008 = * AND 363698007 = * }')
+
+    def test_library_round_trip(self):
+        """Test that canonical forms parse and are stable when canonicalized again"""
+        for ecl_file in read_ecl_files():
+            with self.subTest(filename=ecl_file['filename']):
+                canonical = canonicalize(ecl_file['expression'])
+                self.assertEqual(canonicalize(canonical), canonical)
+
+    def test_collapse_report(self):
+        """Test counting library expressions that share a canonical form"""
+        entries = [{'filename': 'a.txt', 'expression': '< 404684003 |Clinical finding|'},
+                   {'filename': 'b.txt', 'expression': '<  404684003'},
+                   {'filename': 'c.txt', 'expression': '<< 404684003'},
+                   {'filename': 'd.txt', 'expression': '< 404684003 :'}]
+        report = collapse_report(entries)
+        self.assertEqual((report['expressions'], report['canonical_forms'], report['collapsed']), (4, 3, 1))
+        self.assertEqual(report['groups'], [{'canonical': '< 404684003', 'files': ['a.txt', 'b.txt']}])
+        self.assertEqual(report['invalid'], ['d.txt'])
+
+    def test_cache_hit_across_spellings(self):
+        """Test that an equivalent spelling is served from the cache"""
+        calls = []
+        cache = ExpansionCache()
+        expand = lambda endpoint, ecl, count: calls.append(ecl) or {'total': 1, 'concepts': []}
+        cache.get_or_expand(expand, 'http://tx/fhir', '<< 404684003 |Clinical finding|', 25)
+        cache.get_or_expand(expand, 'http://tx/fhir', 'descendantOrSelfOf 404684003', 25)
+        self.assertEqual(len(calls), 1)
+
+
+class TestLocalEngine(unittest.TestCase):
+    """Test offline ECL evaluation against a synthetic RF2 snapshot"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.snapshot = write_sample_snapshot(os.path.join(create_test_folder(), 'rf2'))
+        cls.endpoint = 'local://' + cls.snapshot
+
+    def codes(self, ecl):
+        result = fetcher.expand_valueset(self.endpoint, ecl, 100)
+        self.assertIsNone(result.get('error'), result.get('error'))
+        self.assertEqual(result['total'], len(result['concepts']))
+        return {concept['code'] for concept in result['concepts']}
+
+    def test_hierarchy_operators(self):
+        """Test descendant, ancestor, child, parent, top and bottom operators"""
+        self.assertEqual(self.codes('< 73211009'), {'46635009', '44054006', '11687002'})
+        self.assertEqual(self.codes('<< 233604007'), {'233604007', '53084003'})
+        self.assertEqual(self.codes('<! 19829001'), {'233604007', '195967001'})
+        self.assertEqual(self.codes('> 53084003'), {'233604007', '19829001', '64572001', '404684003', '138875005'})
+        self.assertEqual(self.codes('>>! 53084003'), {'53084003', '233604007'})
+        self.assertEqual(self.codes('!!> (< 64572001)'), {'19829001', '73211009', '125605004'})
+        self.assertEqual(self.codes('!!< (<< 19829001)'), {'53084003', '195967001'})
+        self.assertEqual(self.codes('404684003 |Clinical finding|'), {'404684003'})
+
+    def test_member_of_and_compounds(self):
+        """Test member-of and AND/OR/MINUS"""
+        self.assertEqual(self.codes('^ 723264001'), {'39607008', '3341006', '71341001'})
+        self.assertEqual(self.codes('^ 723264001 AND << 39607008'), {'39607008', '3341006'})
+        self.assertEqual(self.codes('< 73211009 MINUS << 11687002'), {'46635009', '44054006'})
+        self.assertEqual(self.codes('<< 233604007 OR 195967001'), {'233604007', '53084003', '195967001'})
+
+    def test_refinements(self):
+        """Test attributes, groups, cardinality, reverse flags, concrete values and dotted attributes"""
+        self.assertEqual(self.codes('< 64572001 : 363698007 = << 272673000'), {'125605004', '71620000'})
+        self.assertEqual(self.codes('< 404684003 : 246075003 = *, 363698007 = 39607008'), {'53084003'})
+        self.assertEqual(self.codes('< 763158003 : [2..*] 127489000 = *'), {'322280009'})
+        self.assertEqual(self.codes('< 763158003 : [0..0] 127489000 = 387494007'), {'322236009'})
+        self.assertEqual(self.codes('< 763158003 : { 127489000 = 387517004, 127489000 = 387494007 }'), set())
+        self.assertEqual(self.codes('< 763158003 : 1142135004 >= #500'), {'322236009'})
+        self.assertEqual(self.codes('< 763158003 : 1142135004 < #500'), set())
+        self.assertEqual(self.codes('< 123037004 : R 363698007 = << 125605004'), {'272673000', '71341001'})
+        self.assertEqual(self.codes('(< 763158003 : 127489000 = 387494007) . 127489000'), {'387517004', '387494007'})
+
+    def test_filters(self):
+        """Test description and concept filters"""
+        self.assertEqual(self.codes('< 64572001 {{ term = "diab mell" }}'),
+                         {'73211009', '46635009', '44054006', '11687002'})
+        self.assertEqual(self.codes('< 64572001 {{ D term = wild:"*lung", type = syn }}'), {'19829001'})
+        self.assertEqual(len(self.codes('< 138875005 {{ C active = true }}')), 38)
+
+    def test_result_shape(self):
+        """Test paging, displays, version and that inactive concepts are excluded"""
+        result = fetcher.expand_valueset(self.endpoint, '< 138875005', 5, offset=5)
+        self.assertEqual(result['total'], 38)
+        self.assertEqual(len(result['concepts']), 5)
+        self.assertEqual(result['version'], 'http://snomed.info/sct/900000000000207008/version/20250101')
+        displays = {c['code']: c['display'] for c in fetcher.expand_valueset(self.endpoint, '<< 73211009', 10)['concepts']}
+        self.assertEqual(displays['73211009'], 'Diabetes mellitus')
+        self.assertNotIn('900000000000001000', self.codes('*'))
+
+    def test_errors(self):
+        """Test unsupported features, syntax errors and a missing snapshot"""
+        for ecl in ['< 404684003 {{ +HISTORY }}', '< 404684003 :']:
+            with self.subTest(ecl=ecl):
+                result = fetcher.expand_valueset(self.endpoint, ecl, 10)
+                self.assertEqual(result['total'], -1)
+                self.assertTrue(result['operation_outcome'])
+        result = fetcher.expand_valueset('local:///nonexistent/rf2', '< 404684003', 10)
+        self.assertIn('Local terminology unavailable', result['error'])
+
+    def test_snapshot_paths_are_confined(self):
+        """Test that endpoints naming paths outside the allowed roots are refused without reading them"""
+        for endpoint in ['local:///etc', self.endpoint + '/../../../../../..']:
+            with self.subTest(endpoint=endpoint):
+                with self.assertRaises(local_engine.LocalEngineError):
+                    local_engine.snapshot_path(endpoint)
+                result = fetcher.expand_valueset(endpoint, '< 404684003', 10)
+                self.assertEqual(result['error'], 'Local terminology unavailable: no usable snapshot at this endpoint')
+        # The bare scheme (with or without a trailing slash) is the configured snapshot
+        self.assertEqual(local_engine.snapshot_path('local:///'), os.path.realpath(local_engine.LOCAL_RF2_PATH))
+
+    def test_loaded_snapshots_are_capped(self):
+        """Test that only LOCAL_MAX_SNAPSHOTS engines stay loaded, least recently used dropped first"""
+        saved = local_engine.LOCAL_MAX_SNAPSHOTS
+        local_engine.LOCAL_MAX_SNAPSHOTS = 1
+        try:
+            folder = os.path.dirname(local_engine.snapshot_path(self.endpoint))
+            other = write_sample_snapshot(os.path.join(folder, 'rf2-other'))
+            fetcher.expand_valueset('local://' + other, '< 404684003', 10)
+            self.codes('< 404684003')
+            self.assertEqual(list(local_engine._engines), [local_engine.snapshot_path(self.endpoint)])
+        finally:
+            local_engine.LOCAL_MAX_SNAPSHOTS = saved
+
+    def test_test_ecl_route(self):
+        """Test that /test_ecl accepts a local:// endpoint"""
+        from main import app
+        app.config['TESTING'] = True
+        response = app.test_client().post('/test_ecl', json={'expression': '<< 19829001 |Disorder of lung|',
+                                                             'endpoint': self.endpoint})
+        self.assertEqual(response.json['total'], 4)
+
+
+class TestCompiledSnapshot(TestLocalEngine):
+    """Test the memory-mapped compiled snapshot, re-running the local engine tests against it"""
+
+    @classmethod
+    def setUpClass(cls):
+        folder = create_test_folder()
+        cls.text = Rf2Snapshot(write_sample_snapshot(os.path.join(folder, 'rf2')))
+        cls.compiled_path = compile_snapshot(cls.text, os.path.join(folder, 'snapshot.sctbin'))
+        cls.compiled = CompiledSnapshot(cls.compiled_path)
+        cls.endpoint = 'local://' + cls.compiled_path
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.compiled.close()
+
+    def test_lookups_match_text_snapshot(self):
+        """Test that every lookup returns the same data as the RF2 text loader"""
+        self.assertEqual(self.compiled.concepts(), self.text.concepts())
+        self.assertEqual(self.compiled.version, self.text.version)
+        for sctid in sorted(self.text.concepts()) + [999999999]:
+            with self.subTest(sctid=sctid):
+                self.assertEqual(set(self.compiled.parents(sctid)), set(self.text.parents(sctid)))
+                self.assertEqual(set(self.compiled.children(sctid)), set(self.text.children(sctid)))
+                self.assertEqual(sorted(self.compiled.outgoing(sctid)), sorted(self.text.outgoing(sctid)))
+                self.assertEqual(sorted(self.compiled.incoming(sctid)), sorted(self.text.incoming(sctid)))
+                self.assertEqual(list(self.compiled.concrete(sctid)), list(self.text.concrete(sctid)))
+                self.assertEqual(sorted(self.compiled.descriptions(sctid)), sorted(self.text.descriptions(sctid)))
+                self.assertEqual(self.compiled.display(sctid), self.text.display(sctid))
+                self.assertEqual(self.compiled.module(sctid), self.text.module(sctid))
+        for refset in self.text.refsets():
+            self.assertEqual(set(self.compiled.members(refset)), set(self.text.members(refset)))
+        self.assertEqual(self.compiled.members(404684003), ())
+
+    def test_rejects_other_files(self):
+        """Test that a file that is not a compiled snapshot is refused"""
+        path = os.path.join(os.path.dirname(self.compiled_path), 'not-a-snapshot.sctbin')
+        with open(path, 'wb') as f:
+            f.write(b'id\teffectiveTime\n')
+        with self.assertRaises(ValueError):
+            CompiledSnapshot(path)
+
+
+class TestClosureIndex(unittest.TestCase):
+    """Test the precomputed transitive closure against a graph walk on a multi-parent hierarchy"""
+
+    @classmethod
+    def setUpClass(cls):
+        folder = create_test_folder()
+        cls.snapshot = Rf2Snapshot(write_synthetic_snapshot(os.path.join(folder, 'rf2'), 2000))
+        cls.closure = cls.snapshot.closure()
+        cls.compiled = CompiledSnapshot(compile_snapshot(cls.snapshot, os.path.join(folder, 'snapshot.sctbin')))
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.compiled.close()
+
+    def walk(self, sctid, edges):
+        seen, stack = set(), list(edges(sctid))
+        while stack:
+            node = stack.pop()
+            if node not in seen:
+                seen.add(node)
+                stack.extend(edges(node))
+        return seen
+
+    def test_matches_graph_walk(self):
+        """Test descendant and ancestor bitmaps for every concept"""
+        closure = self.closure
+        for sctid in sorted(self.snapshot.concepts()):
+            with self.subTest(sctid=sctid):
+                ordinal = closure.ordinal(sctid)
+                self.assertEqual(set(closure.sctids(closure.descendants(ordinal))),
+                                 self.walk(sctid, self.snapshot.children))
+                self.assertEqual(set(closure.sctids(closure.ancestors(ordinal))),
+                                 self.walk(sctid, self.snapshot.parents))
+
+    def test_is_subsumed(self):
+        """Test the subsumption check in both directions and for unknown concepts"""
+        ids = sorted(self.snapshot.concepts())
+        for sctid in ids[::50]:
+            descendants = self.walk(sctid, self.snapshot.children)
+            for other in ids[::7]:
+                self.assertEqual(self.closure.is_subsumed(other, sctid), other == sctid or other in descendants)
+        self.assertTrue(self.closure.is_subsumed(ids[0], ids[0]))
+        self.assertFalse(self.closure.is_subsumed(999999999, ids[0]))
+
+    def test_set_operations(self):
+        """Test that bitmap AND/OR/MINUS and paging agree with set algebra"""
+        closure = self.closure
+        ids = sorted(self.snapshot.concepts())
+        a, b = closure.ordinal(ids[10]), closure.ordinal(ids[20])
+        left = set(closure.sctids(closure.descendants(a, include_self=True)))
+        right = set(closure.sctids(closure.descendants(b, include_self=True)))
+        bits_a, bits_b = closure.descendants(a, include_self=True), closure.descendants(b, include_self=True)
+        self.assertEqual(set(closure.sctids(bits_a & bits_b)), left & right)
+        self.assertEqual(set(closure.sctids(bits_a | bits_b)), left | right)
+        self.assertEqual(set(closure.sctids(bits_a & ~bits_b)), left - right)
+        self.assertEqual(closure.sctids(bits_a, 3, 5), closure.sctids(bits_a)[3:8])
+        focus = [closure.ordinal(sctid) for sctid in ids[100:400]]
+        expected = set().union(*(self.walk(closure.order[o], self.snapshot.children) for o in focus))
+        self.assertEqual(set(closure.sctids(closure.descendants_of(focus))), expected)
+        self.assertEqual(list(iter_ordinals(closure.bits(ids[:5]))), sorted(closure.ordinal(s) for s in ids[:5]))
+
+    def test_compiled_snapshot_carries_index(self):
+        """Test that the compiled file stores the same closure"""
+        compiled = self.compiled.closure()
+        for sctid in sorted(self.snapshot.concepts())[::25]:
+            ordinal = self.closure.ordinal(sctid)
+            self.assertEqual(compiled.ordinal(sctid), ordinal)
+            self.assertEqual(compiled.descendants(ordinal), self.closure.descendants(ordinal))
+            self.assertEqual(compiled.ancestors(ordinal), self.closure.ancestors(ordinal))
+
+    def test_engine_matches_graph_walk(self):
+        """Test that the engine's hierarchy operators give the graph walk results"""
+        engine = local_engine.LocalEngine(self.compiled)
+        sctid = sorted(self.snapshot.concepts())[30]
+        descendants = self.walk(sctid, self.snapshot.children)
+        ancestors = self.walk(sctid, self.snapshot.parents)
+        self.assertEqual(engine.evaluate(ecl_parser.parse(f'< {sctid}')), descendants)
+        self.assertEqual(engine.evaluate(ecl_parser.parse(f'>> {sctid}')), ancestors | {sctid})
+        self.assertEqual(engine.evaluate(ecl_parser.parse(f'<< {sctid} MINUS < {sctid}')), {sctid})
+        self.assertEqual(engine.expand(f'< {sctid}', 10)['total'], len(descendants))
+
+
+class TestQueryPlanner(unittest.TestCase):
+    """Test splitting compound expressions and combining shared sub-expressions locally"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.endpoint = 'local://' + write_sample_snapshot(os.path.join(create_test_folder(), 'rf2'))
+
+    def setUp(self):
+        # The local engine stands in for the terminology server; calls are recorded per expression
+        self.calls = []
+
+        def upstream(vs_endpoint, ecl, count):
+            self.calls.append(ecl)
+            return fetcher.expand_valueset(self.endpoint, ecl, count)
+
+        cache = ExpansionCache()
+        self.expand = lambda vs_endpoint, ecl, count: cache.get_or_expand(upstream, vs_endpoint, ecl, count)
+
+        def iter_pages(vs_endpoint, ecl, page_size):
+            self.calls.append(ecl)
+            yield fetcher.expand_valueset(self.endpoint, ecl, 1000)
+
+        self.iter_pages = iter_pages
+        self.planner = QueryPlanner(self.expand, iter_pages, ExpansionCache(), max_local=10)
+
+    def codes(self, result):
+        return {concept['code'] for concept in result['concepts']}
+
+    def test_matches_monolithic_expansion(self):
+        """Test that planned results equal expanding the whole expression"""
+        for ecl in ['< 73211009 MINUS << 11687002', '<< 233604007 OR 195967001 OR < 73211009',
+                    '^ 723264001 AND << 39607008', '(< 64572001 AND < 19829001) OR (< 123037004 MINUS < 39607008)']:
+            with self.subTest(ecl=ecl):
+                expected = fetcher.expand_valueset(self.endpoint, ecl, 100)
+                result, plan = self.planner.expand('http://tx/fhir', ecl, 100)
+                self.assertEqual(result['total'], expected['total'])
+                self.assertEqual(self.codes(result), self.codes(expected))
+                self.assertEqual(plan['strategy'], 'local')
+
+    def test_plan_reports_nodes(self):
+        """Test the plan tree, estimates and per-node timings"""
+        result, plan = self.planner.expand('http://tx/fhir', '< 73211009 |Diabetes| MINUS << 11687002', 2)
+        self.assertEqual(result['total'], 2)
+        self.assertEqual(plan['operator'], 'minus')
+        self.assertEqual(plan['estimate'], 3)
+        self.assertEqual([child['expression'] for child in plan['children']], ['< 73211009', '<< 11687002'])
+        self.assertTrue(all(child['strategy'] == 'remote' for child in plan['children']))
+        self.assertTrue(all(node['elapsed_ms'] >= 0 for node in [plan] + plan['children']))
+
+    def test_large_operands_go_remote(self):
+        """Test that a compound with an operand above max_local is sent as one expression"""
+        result, plan = self.planner.expand('http://tx/fhir', '< 138875005 MINUS < 64572001', 5)
+        self.assertEqual(plan['strategy'], 'remote')
+        self.assertIn('< 138875005 MINUS < 64572001', self.calls)
+        self.assertEqual(result['total'], fetcher.expand_valueset(self.endpoint, '< 138875005 MINUS < 64572001', 5)['total'])
+
+    def test_operands_needing_many_pages_go_remote(self):
+        """Test that a compound goes remote when its operands take several page fetches, unless they are cached"""
+        ecl = '< 73211009 MINUS << 11687002'
+        code_sets = ExpansionCache()
+        paged = QueryPlanner(self.expand, self.iter_pages, code_sets, max_local=10, page_size=1)
+        result, plan = paged.expand('http://tx/fhir', ecl, 1)
+        self.assertEqual(plan['strategy'], 'remote')
+        self.assertIn(ecl, self.calls)
+        self.assertEqual(paged.stats()['code_set_fetches'], 0)
+
+        # Once another plan has cached the operands' code sets, combining them costs no fetches
+        QueryPlanner(self.expand, self.iter_pages, code_sets, max_local=10).expand('http://tx/fhir', ecl, 1)
+        result, plan = paged.expand('http://tx/fhir', ecl, 1)
+        self.assertEqual(plan['strategy'], 'local')
+        self.assertEqual(result['total'], fetcher.expand_valueset(self.endpoint, ecl, 1)['total'])
+
+    def test_shared_sub_expressions_expanded_once(self):
+        """Test that a building block shared by several expressions is fetched once"""
+        self.planner.expand('http://tx/fhir', '< 64572001 MINUS < 73211009', 2)
+        self.planner.expand('http://tx/fhir', '< 73211009 OR < 125605004', 2)
+        result, plan = self.planner.expand('http://tx/fhir', '< 73211009 AND << 46635009', 2)
+        self.assertEqual(self.codes(result), {'46635009'})
+        # One page-sized expansion for the estimate and one full code set fetch
+        self.assertEqual(self.calls.count('< 73211009'), 2)
+        self.assertEqual(self.planner.stats()['code_sets']['hits'], 2)
+
+    def test_errors_and_simple_expressions(self):
+        """Test that errors propagate and non-compound expressions pass straight through"""
+        result, plan = self.planner.expand('http://tx/fhir', '< 73211009 AND < 404684003 {{ +HISTORY }}', 10)
+        self.assertEqual(result['total'], -1)
+        self.assertTrue(result['error'])
+        result, plan = self.planner.expand('http://tx/fhir', '<< 73211009', 10)
+        self.assertEqual((plan['strategy'], result['total']), ('remote', 4))
+        self.assertEqual(self.planner.stats()['plans'], 1)
+
+
+class TestEclCatalog(unittest.TestCase):
+    """Test the in-memory, change-detecting ECL library catalog"""
+
+    def setUp(self):
+        self.root = os.path.join(create_test_folder(), 'library')
+        os.makedirs(os.path.join(self.root, 'AMT'))
+        self.write('AMT/a.txt', '# First\n< 1')
+        self.write('AMT/b.txt', '# Second\n< 2')
+        self.catalog = EclCatalog(self.root, poll_interval=0)
+        self.events = []
+        self.catalog.subscribe(lambda *changes: self.events.append([len(c) for c in changes]))
+
+    def write(self, name, content):
+        path = os.path.join(self.root, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def test_matches_library_reader(self):
+        """Test that the catalog returns the same entries as read_ecl_files"""
+        catalog = EclCatalog('ecl_library')
+        expected = sorted(read_ecl_files(), key=lambda x: (x['category'], x['filename']))
+        self.assertEqual(catalog.files(), expected)
+
+    def test_unchanged_library_keeps_generation(self):
+        """Test that polling an unchanged library does not re-parse or bump the generation"""
+        self.catalog.files()
+        generation = self.catalog.generation
+        self.assertFalse(self.catalog.refresh())
+        self.assertEqual(self.catalog.generation, generation)
+        self.assertEqual(self.events, [[2, 0, 0]])
+
+    def test_detects_added_changed_removed(self):
+        """Test incremental detection of library changes"""
+        self.catalog.files()
+        self.write('AMT/c.txt', '# Third\n< 3')
+        self.write('AMT/a.txt', '# First, edited\n<< 1')
+        os.remove(os.path.join(self.root, 'AMT', 'b.txt'))
+        self.assertTrue(self.catalog.refresh())
+        self.assertEqual(self.events[-1], [1, 1, 1])
+        self.assertEqual([f['filename'] for f in self.catalog.files()], ['a.txt', 'c.txt'])
+        self.assertEqual(self.catalog.files()[0]['expression'], '<< 1')
+        self.assertEqual(self.catalog.generation, 2)
+
+    def test_poll_interval_limits_scans(self):
+        """Test that files() only rescans once the poll interval has elapsed"""
+        now = [0.0]
+        catalog = EclCatalog(self.root, poll_interval=5, clock=lambda: now[0])
+        catalog.files()
+        self.write('AMT/c.txt', '# Third\n< 3')
+        self.assertEqual(len(catalog.files()), 2)
+        now[0] = 6
+        self.assertEqual(len(catalog.files()), 3)
+
+
 class TestFetcher(unittest.TestCase):    
 
     def test_expand_valueset_with_simple_ecl(self):
@@ -195,6 +760,1442 @@ class TestFetcher(unittest.TestCase):
                                       f"Total for {ecl_file['filename']} should be >= 0 or -1 for errors")
 
 
+class TestTransport(unittest.TestCase):
+    """Test the pooled HTTP transport against a local stand-in server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeTerminologyServer(total=40).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        fetcher.close_sessions()
+
+    def test_expand_returns_same_shape(self):
+        """Test that the pooled transport returns the total/concepts result dict"""
+        result = fetcher.expand_valueset(self.server.url, "< 404684003 |Clinical finding|", 5)
+        self.assertEqual(result['total'], 40)
+        self.assertEqual(len(result['concepts']), 5)
+        self.assertEqual(set(result['concepts'][0]), {'code', 'display'})
+        self.assertNotIn('error', result)
+        self.assertTrue(result['version'].startswith('http://snomed.info/sct/'))
+
+    def test_operation_outcome_is_reported(self):
+        """Test that an OperationOutcome body is turned into a cleaned error"""
+        result = fetcher.expand_valueset(self.server.url, "invalid ecl expression", 5)
+        self.assertEqual(result['total'], -1)
+        self.assertTrue(result['error'].startswith('Unable to parse ECL'))
+
+    def test_sessions_are_pooled_per_endpoint(self):
+        """Test that calls to the same server reuse one session"""
+        first = fetcher.get_session(self.server.url)
+        second = fetcher.get_session(self.server.url + '/other')
+        self.assertIs(first, second)
+        self.assertIsNot(first, fetcher.get_session('http://example.invalid/fhir'))
+
+    def test_connection_failure_returns_error(self):
+        """Test that an unreachable server yields an error result instead of hanging"""
+        result = fetcher.expand_valueset('http://127.0.0.1:9/fhir', "< 404684003", 5)
+        self.assertEqual(result['total'], -1)
+        self.assertIn('API request failed', result['error'])
+
+
+class TestEndpointPool(unittest.TestCase):
+    """Test hedged requests and failover across two stand-in servers with injected delays"""
+
+    def setUp(self):
+        self.slow = FakeTerminologyServer(total=40).start()
+        self.fast = FakeTerminologyServer(total=40).start()
+        self.pool = fetcher.configure_endpoint_pool([self.slow.url, self.fast.url], hedge_delay=0.05,
+                                                    min_samples=5, failure_threshold=2, cooldown=60)
+
+    def tearDown(self):
+        fetcher.configure_endpoint_pool([])
+        self.slow.stop()
+        self.fast.stop()
+        fetcher.close_sessions()
+
+    def stats(self):
+        return {s['endpoint']: s for s in self.pool.stats()}
+
+    def test_slow_primary_is_hedged(self):
+        """Test that a slow first endpoint is hedged and the faster answer wins"""
+        self.slow.latency = 0.5
+        start = time.perf_counter()
+        result = fetcher.expand_valueset(self.slow.url, '< 404684003', 5)
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertEqual(result['total'], 40)
+        stats = self.stats()
+        self.assertEqual((stats[self.fast.url]['hedges'], stats[self.fast.url]['hedge_wins']), (1, 1))
+        self.assertEqual(stats[self.slow.url]['cancelled'], 1)
+        # The cancelled call still ranks the slow endpoint behind the fast one
+        self.assertEqual(self.pool.ranked(), [self.fast.url, self.slow.url])
+
+    def test_failover_and_recovery(self):
+        """Test that failing endpoints are routed around until their cooldown ends"""
+        self.slow.fail_status = 503
+        for _ in range(3):
+            self.assertEqual(fetcher.expand_valueset(self.fast.url, '< 404684003', 5)['total'], 40)
+        stats = self.stats()
+        self.assertFalse(stats[self.slow.url]['healthy'])
+        self.assertEqual(stats[self.slow.url]['failures'], 2)
+        requests_before = self.slow.request_count
+        fetcher.expand_valueset(self.slow.url, '< 404684003', 5)
+        self.assertEqual(self.slow.request_count, requests_before)
+        self.assertEqual(self.pool.ranked(), [self.fast.url])
+
+    def test_operation_outcome_is_not_a_failure(self):
+        """Test that invalid ECL is answered once and does not mark the endpoint unhealthy"""
+        result = fetcher.expand_valueset(self.slow.url, 'invalid ecl', 5)
+        self.assertTrue(result['operation_outcome'])
+        self.assertTrue(all(s['healthy'] and s['failures'] == 0 for s in self.pool.stats()))
+
+    def test_deadline_is_not_an_endpoint_failure(self):
+        """Test that calls cut short by the client's deadline leave both endpoints healthy"""
+        self.slow.latency = self.fast.latency = 0.5
+        for n in range(3):
+            with resilience.deadline(0.15):
+                result = fetcher.expand_valueset(self.slow.url, f'< 404684003 |Deadline {n}|', 5)
+            self.assertTrue(result['deadline_exceeded'])
+        self.assertTrue(all(s['healthy'] and s['failures'] == 0 for s in self.pool.stats()))
+
+    def test_executor_matches_connection_pool(self):
+        """Test that the hedging executor has a thread for every pooled connection"""
+        self.assertEqual(self.pool._executor._max_workers, fetcher.TX_POOL_SIZE * 2)
+
+    def test_other_endpoints_bypass_pool(self):
+        """Test that endpoints outside the pool are called directly"""
+        with FakeTerminologyServer(total=7) as other:
+            self.assertEqual(fetcher.expand_valueset(other.url, '< 1', 5)['total'], 7)
+        self.assertEqual(sum(s['requests'] for s in self.pool.stats()), 0)
+
+
+class TestResilience(unittest.TestCase):
+    """Test deadlines, retries with backoff and the circuit breaker around upstream calls"""
+
+    def setUp(self):
+        self.server = FakeTerminologyServer(total=40).start()
+        fetcher.configure_resilience(retries=2, backoff=0.001, breaker_threshold=3, breaker_reset=60)
+
+    def tearDown(self):
+        self.server.stop()
+        fetcher.configure_resilience(retries=fetcher.TX_RETRIES, backoff=0.1, breaker_threshold=5, breaker_reset=30)
+        fetcher.close_sessions()
+
+    def test_breaker_states(self):
+        """Test closed -> open -> half-open -> open/closed transitions"""
+        now = [0.0]
+        breaker = CircuitBreaker('tx', failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())  # one probe at a time
+        breaker.record_failure()
+        self.assertEqual((breaker.state, breaker.trips), ('open', 2))
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.stats()['state'], 'closed')
+        self.assertEqual(breaker.stats()['rejected'], 2)
+        breaker.record_failure()
+        breaker.record_failure()
+        now[0] = 40
+        self.assertTrue(breaker.allow())
+        breaker.release()  # neither success nor failure: the next call is the probe
+        self.assertTrue(breaker.allow())
+
+    def test_retry_backoff_is_bounded(self):
+        """Test jittered exponential backoff, the retry limit and the deadline cut-off"""
+        sleeps = []
+        calls = []
+        result = resilience.retry(lambda: calls.append(1) or 'bad', lambda r: True, retries=3, backoff=0.1,
+                                  max_backoff=0.3, sleep=sleeps.append, rng=lambda: 1.0)
+        self.assertEqual((result, len(calls)), ('bad', 4))
+        self.assertEqual(sleeps, [0.1, 0.2, 0.3])
+        with resilience.deadline(0.05):
+            resilience.retry(lambda: calls.append(1), lambda r: True, retries=3, backoff=1, sleep=sleeps.append,
+                             rng=lambda: 1.0)
+        self.assertEqual(len(sleeps), 3)
+
+    def test_server_errors_are_retried_then_trip_breaker(self):
+        """Test that a failing server is retried, then failed fast while the breaker is open"""
+        self.server.fail_status = 503
+        result = fetcher.expand_valueset(self.server.url, '< 404684003', 5)
+        self.assertIn('HTTP 503', result['error'])
+        self.assertEqual(self.server.request_count, 3)
+        result = fetcher.expand_valueset(self.server.url, '< 404684003', 5)
+        self.assertIn('circuit open', result['error'])
+        self.assertEqual(self.server.request_count, 3)
+        stats = fetcher.breakers.stats()[0]
+        self.assertEqual((stats['state'], stats['trips']), ('open', 1))
+
+    def test_operation_outcome_is_not_retried(self):
+        """Test that invalid ECL is a final answer"""
+        result = fetcher.expand_valueset(self.server.url, 'invalid ecl', 5)
+        self.assertTrue(result['operation_outcome'])
+        self.assertEqual(self.server.request_count, 1)
+
+    def test_deadline_limits_slow_calls(self):
+        """Test that the request deadline cuts a slow call short without tripping the breaker"""
+        self.server.latency = 0.5
+        start = time.perf_counter()
+        with resilience.deadline(0.1):
+            result = fetcher.expand_valueset(self.server.url, '< 404684003', 5)
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertTrue(result['deadline_exceeded'])
+        self.assertEqual(self.server.request_count, 1)
+        self.assertEqual(fetcher.breakers.stats()[0]['consecutive_failures'], 0)
+
+    def test_deadline_exceeded_probe_frees_half_open_slot(self):
+        """Test that a half-open probe cut short by the deadline lets the next call through to the server"""
+        fetcher.configure_resilience(breaker_reset=0.05)
+        self.server.fail_status = 503
+        fetcher.expand_valueset(self.server.url, '< 404684003', 5)
+        self.assertEqual(fetcher.breakers.stats()[0]['state'], 'open')
+        time.sleep(0.06)
+        self.server.fail_status = None
+        self.server.latency = 0.5
+        with resilience.deadline(0.1):
+            self.assertTrue(fetcher.expand_valueset(self.server.url, '< 404684003', 5)['deadline_exceeded'])
+        self.assertEqual(fetcher.breakers.stats()[0]['state'], 'half_open')
+        self.server.latency = 0.0
+        requests_before = self.server.request_count
+        result = fetcher.expand_valueset(self.server.url, '< 404684003', 5)
+        self.assertNotIn('error', result)
+        self.assertEqual(self.server.request_count, requests_before + 1)
+        self.assertEqual(fetcher.breakers.stats()[0]['state'], 'closed')
+
+    def test_deadline_from_request_header(self):
+        """Test that /test_ecl propagates X-Request-Timeout to upstream calls"""
+        from main import app
+        app.config['TESTING'] = True
+        self.server.latency = 0.5
+        start = time.perf_counter()
+        response = app.test_client().post('/test_ecl', json={'expression': '< 73211009', 'endpoint': self.server.url},
+                                          headers={'X-Request-Timeout': '0.1'})
+        self.assertLess(time.perf_counter() - start, 0.4)
+        self.assertEqual(response.json['total'], -1)
+        self.assertIn('API request failed', response.json['error'])
+
+
+class TestExpansionDecoder(unittest.TestCase):
+    """Test the streaming $expand response decoder"""
+
+    def encode(self, resource):
+        return json.dumps(resource, indent=1, ensure_ascii=False).encode('utf-8')
+
+    def test_decodes_expansion(self):
+        """Test total, version and concept extraction"""
+        decoded = decode_expansion([self.encode(build_expansion('< 1', 30, 0, 5))], full=True)
+        self.assertEqual(decoded['resourceType'], 'ValueSet')
+        self.assertEqual(decoded['total'], 30)
+        self.assertTrue(decoded['version'].startswith('http://snomed.info/sct/'))
+        self.assertEqual(len(decoded['concepts']), 5)
+        self.assertEqual(decoded['concepts'][0]['system'], 'http://snomed.info/sct')
+
+    def test_byte_at_a_time(self):
+        """Test that chunk boundaries anywhere, including inside UTF-8 and numbers, are handled"""
+        resource = build_expansion('< 1', 12345, 0, 3)
+        resource['expansion']['contains'][0]['display'] = 'Ménière\'s disease'
+        content = self.encode(resource)
+        decoded = decode_expansion(content[i:i + 1] for i in range(len(content)))
+        self.assertEqual(decoded['total'], 12345)
+        self.assertEqual(decoded['concepts'][0]['display'], 'Ménière\'s disease')
+        self.assertEqual(decoded['concepts'], decode_expansion([content])['concepts'])
+
+    def test_skipped_values_across_chunks(self):
+        """Test that skipped values with brackets and escaped quotes in strings are stepped over at any chunk size"""
+        resource = build_expansion('< 1', 3, 0, 3)
+        resource['meta'] = {'tag': ['a"]}', {'nested': [1, 2.5e3, None, True]}, '\\"[{']}
+        resource['expansion']['extension'] = [{'url': 'x', 'valueString': '}}]]"\\'}]
+        resource['expansion']['contains'][1]['display'] = 'Quote " and ] bracket'
+        content = self.encode(resource)
+        for size in (1, 2, 7, len(content)):
+            chunks = [content[i:i + size] for i in range(0, len(content), size)]
+            with self.subTest(size=size):
+                self.assertEqual(decode_expansion(chunks)['concepts'][1]['display'], 'Quote " and ] bracket')
+                decoded = decode_expansion(chunks, total_only=True)
+                self.assertEqual((decoded['total'], decoded['concepts']), (3, []))
+
+    def test_large_values_are_decoded_once(self):
+        """Test that a value spread over many chunks is decoded once it is complete, not after every chunk"""
+        import expansion_decoder
+        resource = build_expansion('< 1', 1, 0, 1)
+        resource['expansion']['contains'][0]['display'] = 'x' * 200000
+        content = self.encode(resource)
+        calls = []
+        decoder = expansion_decoder._decoder
+        raw_decode = decoder.raw_decode
+        expansion_decoder._decoder = type('Counting', (), {
+            'raw_decode': staticmethod(lambda text, pos: calls.append(pos) or raw_decode(text, pos))})()
+        try:
+            decoded = decode_expansion(content[i:i + 100] for i in range(0, len(content), 100))
+        finally:
+            expansion_decoder._decoder = decoder
+        self.assertEqual(len(decoded['concepts'][0]['display']), 200000)
+        self.assertLess(len(calls), 20)
+
+    def test_display_fallback_and_nesting(self):
+        """Test that missing displays fall back to the code and nested contains are flattened"""
+        resource = {'resourceType': 'ValueSet', 'expansion': {'total': 2, 'contains': [
+            {'code': '1', 'contains': [{'code': '2', 'display': 'Two'}]}, {'display': 'no code'}]}}
+        decoded = decode_expansion([self.encode(resource)])
+        self.assertEqual(decoded['concepts'], [{'code': '1', 'display': '1'}, {'code': '2', 'display': 'Two'}])
+
+    def test_operation_outcome(self):
+        """Test that OperationOutcome issues are returned"""
+        decoded = decode_expansion([self.encode(operation_outcome('bad'))])
+        self.assertEqual(decoded['resourceType'], 'OperationOutcome')
+        self.assertEqual(len(decoded['issue']), 1)
+
+    def test_invalid_input(self):
+        """Test empty and malformed bodies"""
+        with self.assertRaises(EmptyResponseError):
+            decode_expansion([b'  '])
+        for content in [b'<html>', b'{"expansion": {"total": 1', b'{"a": 1} trailing']:
+            with self.subTest(content=content), self.assertRaises(ValueError):
+                decode_expansion([content])
+
+    def test_fetcher_error_results(self):
+        """Test that the fetcher turns decoder failures into error results"""
+        self.assertEqual(fetcher.parse_expansion(b'')['error'], 'Empty response from FHIR server')
+        self.assertIn('Invalid JSON response', fetcher.parse_expansion(b'not json')['error'])
+
+    def test_fhirpathpy_not_imported(self):
+        """Test that importing the app does not load fhirpathpy or antlr4"""
+        import subprocess, sys
+        code = "import main, sys; print('fhirpathpy' in sys.modules or 'antlr4' in sys.modules)"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                env=dict(os.environ, EXPANSION_STORE='')).stdout
+        self.assertEqual(output.strip(), 'False')
+
+
+class TestExpansionCache(unittest.TestCase):
+    """Test LRU, TTL and negative caching of expansion results"""
+
+    def setUp(self):
+        self.now = 0.0
+        self.calls = []
+        self.cache = ExpansionCache(max_entries=3, ttl=100, negative_ttl=10, clock=lambda: self.now)
+
+    def expand(self, endpoint, ecl, count):
+        self.calls.append(ecl)
+        if ecl == 'bad':
+            return {'total': -1, 'concepts': [], 'error': 'Unable to parse', 'operation_outcome': True}
+        if ecl == 'down':
+            return {'total': -1, 'concepts': [], 'error': 'API request failed'}
+        return {'total': 1, 'concepts': [{'code': ecl, 'display': ecl}]}
+
+    def test_hit_after_miss(self):
+        """Test that a repeated expansion is served from the cache"""
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', '< 1', 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir/', '< 1 ', 25)
+        self.assertEqual(self.calls, ['< 1'])
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['hit_ratio'], 0.5)
+
+    def test_count_is_part_of_key(self):
+        """Test that different page sizes are cached separately"""
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', '< 1', 5)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', '< 1', 25)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_ttl_expiry(self):
+        """Test that entries expire after the TTL"""
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', '< 1', 25)
+        self.now = 101
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', '< 1', 25)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(self.cache.stats()['evictions']['expired'], 1)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted first"""
+        for ecl in ['a', 'b', 'c']:
+            self.cache.get_or_expand(self.expand, 'http://tx/fhir', ecl, 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'a', 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'd', 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'a', 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'b', 25)
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'd', 'b'])
+        self.assertGreaterEqual(self.cache.stats()['evictions']['lru'], 1)
+
+    def test_byte_limit(self):
+        """Test that the byte budget evicts old entries"""
+        cache = ExpansionCache(max_entries=100, max_bytes=150, clock=lambda: self.now)
+        for ecl in ['a', 'b', 'c']:
+            cache.get_or_expand(self.expand, 'http://tx/fhir', ecl, 25)
+        stats = cache.stats()
+        self.assertLessEqual(stats['bytes'], 150)
+        self.assertGreater(stats['evictions']['bytes'], 0)
+
+    def test_negative_cache_uses_short_ttl(self):
+        """Test that OperationOutcome errors are cached with the negative TTL"""
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'bad', 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'bad', 25)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.cache.stats()['negative_hits'], 1)
+        self.now = 11
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'bad', 25)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_transport_errors_not_cached(self):
+        """Test that failed requests are retried rather than cached"""
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'down', 25)
+        self.cache.get_or_expand(self.expand, 'http://tx/fhir', 'down', 25)
+        self.assertEqual(len(self.calls), 2)
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test coalescing of identical concurrent expansion calls"""
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.calls = []
+
+    def slow(self, value):
+        self.calls.append(value)
+        self.release.wait(5)
+        return {'total': value, 'concepts': []}
+
+    def run_threads(self, flight, count, key=('http://tx/fhir', '< 1', 25)):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do(key, lambda: self.slow(1))))
+                   for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()['calls'] < count:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_threads_share_one_call(self):
+        """Test that concurrent callers with the same key make one call and get its result"""
+        flight = SingleFlight()
+        results = self.run_threads(flight, 10)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual([r['total'] for r in results], [1] * 10)
+        stats = flight.stats()
+        self.assertEqual((stats['calls'], stats['upstream_calls'], stats['coalesced']), (10, 1, 9))
+        self.assertEqual(stats['in_flight'], 0)
+
+    def test_sequential_calls_are_not_coalesced(self):
+        """Test that a finished call is not reused and different keys do not wait on each other"""
+        flight = SingleFlight()
+        self.release.set()
+        flight.do('a', lambda: self.slow(1))
+        flight.do('a', lambda: self.slow(1))
+        flight.do('b', lambda: self.slow(2))
+        self.assertEqual(self.calls, [1, 1, 2])
+
+    def test_errors_reach_every_caller(self):
+        """Test that an exception in the shared call is raised in every waiting caller"""
+        flight = SingleFlight()
+        started = threading.Event()
+        errors = []
+
+        def failing():
+            started.set()
+            self.release.wait(5)
+            raise RuntimeError('upstream down')
+
+        def call():
+            try:
+                flight.do('k', failing)
+            except RuntimeError as e:
+                errors.append(str(e))
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=call)
+        follower.start()
+        while flight.stats()['coalesced'] < 1:
+            time.sleep(0.001)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(errors, ['upstream down'] * 2)
+
+    def test_lock_files_coalesce_processes(self):
+        """Test that a second process waits for the lock and then reads the shared store"""
+        lock_dir = os.path.join(create_test_folder(), 'locks')
+        store = {}
+        first, second = SingleFlight(lock_dir), SingleFlight(lock_dir)
+
+        def fetch():
+            store['k'] = self.slow(1)
+            return store['k']
+
+        started = threading.Thread(target=lambda: first.do('k', fetch, recheck=lambda: store.get('k')))
+        started.start()
+        while not self.calls:
+            time.sleep(0.001)
+        result = []
+        waiting = threading.Thread(target=lambda: result.append(
+            second.do('k', lambda: self.slow(2), recheck=lambda: store.get('k'))))
+        waiting.start()
+        time.sleep(0.05)
+        self.release.set()
+        started.join()
+        waiting.join()
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(result[0]['total'], 1)
+        self.assertEqual(second.stats()['process_coalesced'], 1)
+        self.assertEqual(os.listdir(lock_dir), [])
+
+    def test_followers_give_up_at_their_deadline(self):
+        """Test that a follower with a short deadline gets the expired result instead of waiting for a slow leader"""
+        flight = SingleFlight()
+        leader = threading.Thread(target=lambda: flight.do('k', lambda: self.slow(1)))
+        leader.start()
+        while not self.calls:
+            time.sleep(0.001)
+        start = time.monotonic()
+        with resilience.deadline(0.1):
+            result = flight.do('k', lambda: self.slow(2), expired=fetcher.deadline_exceeded)
+        waited = time.monotonic() - start
+        with resilience.deadline(0.01), self.assertRaises(TimeoutError):
+            flight.do('k', lambda: self.slow(3))
+        self.release.set()
+        leader.join()
+        self.assertTrue(result['deadline_exceeded'])
+        self.assertLess(waited, 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(flight.stats()['expired'], 2)
+
+    def test_lock_file_wait_honours_the_deadline(self):
+        """Test that a leader that cannot get the lock file before its deadline gives up without calling upstream"""
+        lock_dir = os.path.join(create_test_folder(), 'locks')
+        first, second = SingleFlight(lock_dir), SingleFlight(lock_dir)
+        holder = threading.Thread(target=lambda: first.do('k', lambda: self.slow(1)))
+        holder.start()
+        while not self.calls:
+            time.sleep(0.001)
+        start = time.monotonic()
+        with resilience.deadline(0.1):
+            result = second.do('k', lambda: self.slow(2), expired=fetcher.deadline_exceeded)
+        waited = time.monotonic() - start
+        self.release.set()
+        holder.join()
+        self.assertTrue(result['deadline_exceeded'])
+        self.assertLess(waited, 1)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(second.stats()['upstream_calls'], 0)
+        self.assertEqual(os.listdir(lock_dir), [])
+
+
+class TestExpansionStore(unittest.TestCase):
+    """Test the persistent SQLite expansion store"""
+
+    V1 = 'http://snomed.info/sct/32506021000036107/version/20250131'
+    V2 = 'http://snomed.info/sct/32506021000036107/version/20250228'
+
+    def setUp(self):
+        self.folder = create_test_folder()
+        self.now = 1000.0
+        self.store = ExpansionStore(os.path.join(self.folder, 'store', 'expansions.sqlite3'),
+                                    ttl=100, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.store.close()
+
+    def result(self, version, total=3):
+        return {'total': total, 'concepts': [{'code': '1', 'display': 'one'}], 'version': version}
+
+    def test_round_trip(self):
+        """Test that a stored expansion is returned after reopening the store"""
+        self.store.put('http://tx/fhir', '< 1', 25, self.result(self.V1))
+        self.store.close()
+        reopened = ExpansionStore(self.store.path, ttl=100, clock=lambda: self.now)
+        self.assertEqual(reopened.get('http://tx/fhir/', '< 1', 25)['total'], 3)
+        self.assertIsNone(reopened.get('http://tx/fhir', '< 1', 5))
+        reopened.close()
+
+    def test_errors_not_stored(self):
+        """Test that error results are never persisted"""
+        self.store.put('http://tx/fhir', 'bad', 25, {'total': -1, 'concepts': [], 'error': 'x'})
+        self.assertEqual(self.store.stats()['rows'], 0)
+
+    def test_new_version_hides_old_rows(self):
+        """Test that lookups only see the version the endpoint currently serves"""
+        self.store.put('http://tx/fhir', '< 1', 25, self.result(self.V1))
+        self.store.put('http://tx/fhir', '< 2', 25, self.result(self.V2))
+        self.assertIsNone(self.store.get('http://tx/fhir', '< 1', 25))
+        self.assertEqual(self.store.current_version('http://tx/fhir'), self.V2)
+
+    def test_ttl(self):
+        """Test that rows older than the TTL are ignored"""
+        self.store.put('http://tx/fhir', '< 1', 25, self.result(self.V1))
+        self.now += 101
+        self.assertIsNone(self.store.get('http://tx/fhir', '< 1', 25))
+
+    def test_compact_bounds_rows(self):
+        """Test that compaction removes superseded versions and old rows"""
+        self.store.put('http://tx/fhir', 'old', 25, self.result(self.V1))
+        for i in range(5):
+            self.now += 1
+            self.store.put('http://tx/fhir', f'< {i}', 25, self.result(self.V2))
+        removed = self.store.compact(max_rows=3)
+        self.assertEqual(removed, 3)
+        self.assertEqual(self.store.stats()['rows'], 3)
+        self.assertIsNotNone(self.store.get('http://tx/fhir', '< 4', 25))
+
+    def test_compacts_after_every_n_puts(self):
+        """Test that a long-running store is compacted in the background instead of only at startup"""
+        store = ExpansionStore(os.path.join(self.folder, 'store', 'bounded.sqlite3'), ttl=100,
+                               clock=lambda: self.now, max_rows=2, compact_every=3)
+        try:
+            for i in range(6):
+                self.now += 1
+                store.put('http://tx/fhir', f'< {i}', 25, self.result(self.V1))
+                deadline = time.time() + 5
+                while store.stats()['compactions'] < (i + 1) // 3 and time.time() < deadline:
+                    time.sleep(0.01)
+                self.assertEqual(store.stats()['compactions'], (i + 1) // 3)
+            self.assertEqual(store.stats()['rows'], 2)
+            self.assertIsNotNone(store.get('http://tx/fhir', '< 5', 25))
+        finally:
+            store.close()
+
+    def test_one_process_compacts_at_a_time(self):
+        """Test that compaction is skipped while another process holds the store's compaction lock"""
+        import fcntl
+        self.store.put('http://tx/fhir', '< 1', 25, self.result(self.V1))
+        self.now += 101
+        with open(self.store.path + '.compact.lock', 'w') as held:
+            fcntl.flock(held, fcntl.LOCK_EX)
+            self.assertIsNone(self.store.try_compact())
+        self.assertEqual(self.store.stats()['rows'], 1)
+        self.assertEqual(self.store.try_compact(), 1)
+        self.assertEqual(self.store.stats()['rows'], 0)
+
+    def test_preload_fills_cache(self):
+        """Test that preload puts current rows into the in-memory cache"""
+        self.store.put('http://tx/fhir', '< 1', 25, self.result(self.V1))
+        cache = ExpansionCache()
+        self.assertEqual(self.store.preload(cache), 1)
+        self.assertEqual(cache.get(cache.make_key('http://tx/fhir', '< 1', 25, self.V1))['total'], 3)
+
+
+class TestBatch(unittest.TestCase):
+    """Test concurrent batch expansion through /test_ecl_batch"""
+
+    @classmethod
+    def setUpClass(cls):
+        from main import app
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+        cls.server = FakeTerminologyServer(total=10, latency=0.2).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def post(self, body):
+        body = dict(body, endpoint=self.server.url)
+        response = self.app.post('/test_ecl_batch', json=body)
+        lines = [json.loads(line) for line in response.data.decode().splitlines() if line]
+        return response, lines
+
+    def test_streams_ndjson_concurrently(self):
+        """Test that a batch takes about as long as one expansion, not the sum"""
+        fetcher.expansion_cache.clear()
+        expressions = [f'< {100000 + i} |Batch concept|' for i in range(6)]
+        start = time.perf_counter()
+        response, lines = self.post({'expressions': expressions, 'count': 3})
+        elapsed = time.perf_counter() - start
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 7)
+        self.assertEqual({line['expression'] for line in lines[:-1]}, set(expressions))
+        self.assertTrue(all(line['total'] == 10 for line in lines[:-1]))
+        self.assertEqual(lines[-1], dict(lines[-1], done=True, count=6, errors=0))
+        self.assertLess(elapsed, 0.2 * 6 / 2)
+
+    def test_library_category(self):
+        """Test that a category expands every library entry in it"""
+        response, lines = self.post({'category': 'Situations', 'count': 1})
+        self.assertEqual(sorted(line['filename'] for line in lines[:-1]),
+                         ['01-01-NoHistoryOfFindings.txt', '01-01-NoHistoryOfProcedures.txt'])
+
+    def test_sse_format_and_errors(self):
+        """Test Server-Sent Events output and per-expression errors"""
+        response = self.app.post('/test_ecl_batch', json={
+            'expressions': [{'expression': 'invalid ecl', 'filename': 'bad.txt'}],
+            'endpoint': self.server.url, 'format': 'sse'})
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        events = [json.loads(chunk[len('data: '):]) for chunk in response.data.decode().split('\n\n') if chunk]
+        self.assertEqual(events[0]['filename'], 'bad.txt')
+        self.assertIsNotNone(events[0]['error'])
+        self.assertEqual(events[1]['errors'], 1)
+
+    def test_requires_expressions(self):
+        """Test that an empty batch is rejected"""
+        response = self.app.post('/test_ecl_batch', json={'expressions': []})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_bad_count(self):
+        """Test that a count that is not a number is a 400 with a JSON error rather than a 500"""
+        for count in ['x', [], {}]:
+            with self.subTest(count=count):
+                response = self.app.post('/test_ecl_batch', json={'expressions': ['< 1'], 'count': count})
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json['error'], 'count must be a whole number')
+
+    def test_count_is_capped(self):
+        """Test that a huge count is cut down to STREAM_MAX_PAGE_SIZE instead of asking for the whole expansion"""
+        import main
+        counts = []
+        expand = fetcher.cached_expand_valueset
+        fetcher.cached_expand_valueset = lambda endpoint, ecl, count: counts.append(count) or {'total': 0,
+                                                                                             'concepts': []}
+        try:
+            response, lines = self.post({'expressions': ['< 404684003'], 'count': 10000000, 'plan': False})
+            self.assertTrue(lines[-1]['done'])
+        finally:
+            fetcher.cached_expand_valueset = expand
+        self.assertEqual(counts, [main.STREAM_MAX_PAGE_SIZE])
+
+
+class TestCountOnly(unittest.TestCase):
+    """Test total-only expansions through count_valueset, /test_ecl and /count_ecl"""
+
+    @classmethod
+    def setUpClass(cls):
+        from main import app
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+        cls.server = FakeTerminologyServer(total=42).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_decoder_skips_concepts(self):
+        """Test that total_only keeps the total and version but decodes no concepts"""
+        content = json.dumps(build_expansion('< 1', 30, 0, 5)).encode('utf-8')
+        decoded = decode_expansion([content], total_only=True)
+        self.assertEqual((decoded['total'], decoded['concepts']), (30, []))
+        self.assertTrue(decoded['version'])
+
+    def test_count_valueset(self):
+        """Test that a count is cached separately from concept pages"""
+        fetcher.expansion_cache.clear()
+        result = fetcher.count_valueset(self.server.url, '< 404684003 |Count only|')
+        self.assertEqual((result['total'], result['concepts']), (42, []))
+        requests_before = self.server.request_count
+        self.assertEqual(fetcher.count_valueset(self.server.url, '<404684003')['total'], 42)
+        self.assertEqual(self.server.request_count, requests_before)
+
+    def test_test_ecl_count_only(self):
+        """Test that /test_ecl with count_only returns the total without concepts"""
+        response = self.app.post('/test_ecl', json={'expression': '< 73211009', 'endpoint': self.server.url,
+                                                    'count_only': True})
+        self.assertEqual((response.json['total'], response.json['concepts']), (42, []))
+
+    def test_count_ecl_keeps_order(self):
+        """Test that /count_ecl returns one total per expression in request order, with errors inline"""
+        expressions = ['< 404684003', {'expression': '< 73211009 OR', 'filename': 'bad.txt'}, 'invalid ecl', '< 71388002']
+        response = self.app.post('/count_ecl', json={'expressions': expressions, 'endpoint': self.server.url})
+        counts = response.json['counts']
+        self.assertEqual([entry['total'] for entry in counts], [42, -1, -1, 42])
+        self.assertEqual(counts[1]['filename'], 'bad.txt')
+        self.assertIn('Invalid ECL', counts[1]['error'])
+        self.assertEqual(response.json['errors'], 2)
+
+    def test_count_ecl_category(self):
+        """Test that a library category is counted and an empty request is rejected"""
+        response = self.app.post('/count_ecl', json={'category': 'Situations', 'endpoint': self.server.url})
+        self.assertEqual(sorted(entry['filename'] for entry in response.json['counts']),
+                         ['01-01-NoHistoryOfFindings.txt', '01-01-NoHistoryOfProcedures.txt'])
+        self.assertEqual(self.app.post('/count_ecl', json={'expressions': []}).status_code, 400)
+
+
+class TestCacheWarmer(unittest.TestCase):
+    """Test background warming of the expansion cache from the library"""
+
+    def setUp(self):
+        self.server = FakeTerminologyServer(total=12).start()
+        self.entries = [{'expression': '< 404684003', 'filename': 'a.txt'},
+                        {'expression': '<< 73211009', 'filename': 'b.txt'},
+                        {'expression': '< 404684003 OR', 'filename': 'invalid.txt'}]
+        fetcher.expansion_cache.clear()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def warmer(self, **options):
+        return CacheWarmer(self.server.url, lambda: self.entries, fetcher.cached_expand_valueset,
+                           fetcher.refresh_expansion, **options)
+
+    def test_warms_library_into_cache(self):
+        """Test that a pass fills the cache so the first click makes no upstream call"""
+        status = self.warmer().warm()
+        self.assertEqual((status['total'], status['done'], status['errors'], status['passes']), (2, 2, 0, 1))
+        self.assertTrue(status['version'])
+        requests_before = self.server.request_count
+        self.assertEqual(fetcher.cached_expand_valueset(self.server.url, '<404684003', 25)['total'], 12)
+        self.assertEqual(self.server.request_count, requests_before)
+
+    def test_refresh_pass_goes_upstream(self):
+        """Test that a refresh pass re-expands entries that are already cached"""
+        warmer = self.warmer()
+        warmer.warm()
+        requests_before = self.server.request_count
+        warmer.warm()
+        self.assertEqual(self.server.request_count, requests_before)
+        self.server.total = 13
+        warmer.warm(refresh=True)
+        self.assertEqual(self.server.request_count, requests_before + 2)
+        self.assertEqual(fetcher.cached_expand_valueset(self.server.url, '< 404684003', 25)['total'], 13)
+
+    def test_waits_for_interactive_requests(self):
+        """Test that warming does not start an expansion while an interactive request is in flight"""
+        gate = InteractiveGate()
+        warmer = self.warmer(gate=gate)
+        gate.enter()
+        thread = threading.Thread(target=warmer.warm)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual((warmer.status()['done'], self.server.request_count), (0, 0))
+        gate.exit()
+        thread.join(5)
+        self.assertEqual(warmer.status()['done'], 2)
+
+    def test_version_change_triggers_pass(self):
+        """Test that the scheduler re-warms when the probe reports a new version"""
+        versions = iter([SNOMED_VERSION, SNOMED_VERSION])
+        warmer = self.warmer(probe=lambda endpoint: next(versions, SNOMED_VERSION + '-next'), interval=60,
+                             check_interval=0.01)
+        warmer.start()
+        try:
+            deadline = time.time() + 5
+            while warmer.status()['passes'] < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual(warmer.status()['reason'], 'version')
+            self.assertIsNone(next(versions, None))
+        finally:
+            warmer.stop(5)
+
+    def test_warm_status_route(self):
+        """Test that /warm_status reports the warmer state"""
+        from main import app
+        app.config['TESTING'] = True
+        status = app.test_client().get('/warm_status').json
+        self.assertFalse(status['enabled'])
+        self.assertIn('done', status)
+
+
+class TestReleaseTracking(unittest.TestCase):
+    """Test SNOMED CT version-aware cache keys, release probes and the overlap period"""
+
+    V1 = SNOMED_VERSION
+    V2 = 'http://snomed.info/sct/32506021000036107/version/20250228'
+
+    def setUp(self):
+        self.now = 1000.0
+        self.saved = fetcher.releases
+        fetcher.releases = ReleaseTracker(overlap=60, check_interval=30, clock=lambda: self.now)
+        fetcher.expansion_cache.clear()
+        self.server = FakeTerminologyServer(total=5).start()
+        self.other = FakeTerminologyServer(total=7).start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.other.stop()
+        fetcher.releases = self.saved
+
+    def expand(self, server):
+        return fetcher.cached_expand_valueset(server.url, '< 404684003', 25)
+
+    def wait_for_total(self, server, total):
+        deadline = time.time() + 5
+        while self.expand(server)['total'] != total and time.time() < deadline:
+            time.sleep(0.01)
+        return self.expand(server)['total']
+
+    def test_tracker_overlap(self):
+        """Test that the previous version is kept for the overlap, then handed out for discarding"""
+        tracker = ReleaseTracker(overlap=60, clock=lambda: self.now)
+        self.assertIsNone(tracker.observe('http://tx/fhir/', self.V1))
+        self.assertEqual(tracker.observe('http://tx/fhir', self.V2), self.V1)
+        self.assertEqual(tracker.versions('http://tx/fhir'), (self.V2, self.V1))
+        self.now += 60
+        self.assertEqual(tracker.versions('http://tx/fhir'), (self.V2, None))
+        self.assertEqual(tracker.take_expired(), [('http://tx/fhir', self.V1)])
+        self.assertEqual(tracker.take_expired(), [])
+
+    def test_version_is_part_of_the_key(self):
+        """Test that the version an expansion reported is recorded and used in its cache key"""
+        self.assertEqual(self.expand(self.server)['total'], 5)
+        self.assertEqual(fetcher.releases.current(self.server.url), self.V1)
+        key = ExpansionCache.make_key(self.server.url, '< 404684003', 25, self.V1)
+        self.assertIsNotNone(fetcher.expansion_cache.get(key))
+
+    def test_release_change_serves_old_entries_during_overlap(self):
+        """Test that a new release is detected by the probe and warmed while old entries are still served"""
+        self.expand(self.server)
+        self.expand(self.other)
+        self.server.version, self.server.total = self.V2, 6
+        self.assertEqual(fetcher.check_release(self.server.url), self.V2)
+        # The first lookup after the change still answers from the old release...
+        self.assertEqual(self.expand(self.server)['total'], 5)
+        # ...and refreshes it in the background
+        self.assertEqual(self.wait_for_total(self.server, 6), 6)
+        self.assertEqual(self.expand(self.server)['version'], self.V2)
+        # Only entries of the endpoint that changed are dropped once the overlap ends
+        self.now += 60
+        self.expand(self.server)
+        self.assertIsNone(fetcher.expansion_cache.get(
+            ExpansionCache.make_key(self.server.url, '< 404684003', 25, self.V1)))
+        requests_before = self.other.request_count
+        self.assertEqual(self.expand(self.other)['total'], 7)
+        self.assertEqual(self.other.request_count, requests_before)
+
+    def test_periodic_probe(self):
+        """Test that lookups probe an endpoint's version once the check interval has passed"""
+        self.expand(self.server)
+        self.server.version = self.V2
+        self.expand(self.server)
+        self.now += 30
+        self.expand(self.server)
+        deadline = time.time() + 5
+        while fetcher.releases.current(self.server.url) != self.V2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(fetcher.releases.current(self.server.url), self.V2)
+
+
+class TestMetrics(unittest.TestCase):
+    """Test the per-thread metrics registry and the /metrics endpoint"""
+
+    def test_counters_sum_across_threads(self):
+        """Test that counts recorded on other threads, including exited ones, are all scraped"""
+        registry = Registry()
+        counter = registry.counter('test_total', 'Test counter', ('kind',))
+        gauge = registry.gauge('test_active', 'Test gauge')
+        threads = [threading.Thread(target=lambda: [counter.inc('a') for _ in range(100)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('b', amount=5)
+        gauge.inc()
+        thread = threading.Thread(target=gauge.dec)
+        thread.start()
+        thread.join()
+        values = registry.snapshot()
+        self.assertEqual(values['test_total'], {('a',): 400, ('b',): 5})
+        self.assertEqual(values['test_active'], {(): 0})
+
+    def test_histogram_exposition(self):
+        """Test cumulative buckets, sum, count and label escaping in the text format"""
+        registry = Registry()
+        histogram = registry.histogram('test_seconds', 'Test histogram', ('route',), buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            histogram.observe(value, '/a"b')
+        lines = registry.render().splitlines()
+        self.assertIn('# TYPE test_seconds histogram', lines)
+        self.assertIn('test_seconds_bucket{route="/a\\"b",le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{route="/a\\"b",le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{route="/a\\"b",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{route="/a\\"b"} 4.25', lines)
+        self.assertIn('test_seconds_count{route="/a\\"b"} 4', lines)
+
+    def test_metrics_endpoint(self):
+        """Test that routes, upstream calls and the cache are reported by /metrics"""
+        from main import app
+        app.config['TESTING'] = True
+        client = app.test_client()
+        with FakeTerminologyServer(total=9) as server:
+            client.post('/test_ecl', json={'expression': '< 404684003 |Metrics|', 'endpoint': server.url})
+            endpoint = server.url.rsplit('/', 1)[0]
+            response = client.get('/metrics')
+        self.assertEqual(response.content_type, metrics.CONTENT_TYPE)
+        text = response.data.decode()
+        self.assertIn('ecl_http_requests_total{route="/test_ecl",method="POST",status="200"}', text)
+        self.assertIn(f'ecl_upstream_requests_total{{endpoint="{endpoint}",status="200"}}', text)
+        self.assertIn(f'ecl_upstream_response_bytes_total{{endpoint="{endpoint}"}}', text)
+        self.assertIn(f'ecl_upstream_decode_seconds_count{{endpoint="{endpoint}"}}', text)
+        self.assertIn('ecl_cache_misses_total', text)
+        self.assertIn('ecl_http_requests_in_flight{route="/metrics"} 1', text)
+
+
+class TestProfiling(unittest.TestCase):
+    """Test Server-Timing phase timings and the on-demand sampling profiler"""
+
+    def test_phase_timings(self):
+        """Test that repeated phases are summed, ordered and counted in the header"""
+        timings = PhaseTimings()
+        timings.add('decode', 0.002)
+        timings.add('ttfb', 0.010)
+        timings.add('decode', 0.003)
+        timings.add('custom', 0.001)
+        self.assertEqual(list(timings.phases()), ['ttfb', 'decode', 'custom'])
+        header = timings.server_timing()
+        self.assertTrue(header.startswith('ttfb;dur=10.00, decode;dur=5.00;desc="2 calls", custom;dur=1.00, total;dur='))
+
+    def test_record_outside_request(self):
+        """Test that phases recorded outside a timed request are ignored"""
+        self.assertIsNone(profiling.current())
+        profiling.record('decode', 1.0)
+        token = profiling.start()
+        try:
+            with profiling.phase('parse'):
+                pass
+            self.assertEqual(list(profiling.current().phases()), ['parse'])
+        finally:
+            profiling.finish(token)
+        self.assertIsNone(profiling.current())
+
+    def test_server_timing_header(self):
+        """Test that an upstream expansion reports its network and decode phases"""
+        from main import app
+        app.config['TESTING'] = True
+        client = app.test_client()
+        with FakeTerminologyServer(total=12) as server:
+            response = client.post('/test_ecl', json={'expression': '< 404684003 |Timing|', 'endpoint': server.url})
+        self.assertEqual(response.status_code, 200)
+        phases = [part.split(';')[0] for part in response.headers['Server-Timing'].split(', ')]
+        for name in ('parse', 'encode', 'ttfb', 'download', 'decode', 'serialize', 'total'):
+            self.assertIn(name, phases)
+
+    def test_profiler_samples_armed_requests_only(self):
+        """Test that only the armed number of requests is sampled"""
+        profiler = SamplingProfiler(interval=0.001)
+        self.assertIsNone(profiler.begin('/idle'))
+        profiler.arm(1)
+        token = profiler.begin('/slow')
+        self.assertIsNotNone(token)
+        self.assertIsNone(profiler.begin('/second'))
+        time.sleep(0.05)
+        profiler.end(token)
+        status = profiler.status()
+        self.assertEqual(status['profiled_requests'], 1)
+        self.assertEqual(status['armed'], 0)
+        self.assertGreater(status['samples'], 0)
+        line = profiler.collapsed().splitlines()[0]
+        stack, count = line.rsplit(' ', 1)
+        self.assertIn('test_profiler_samples_armed_requests_only', stack)
+        self.assertGreater(int(count), 0)
+        profiler.reset()
+        self.assertEqual(profiler.collapsed(), '')
+
+    def test_admin_profile_endpoints(self):
+        """Test arming the profiler over HTTP and the admin token check"""
+        import main
+        main.app.config['TESTING'] = True
+        client = main.app.test_client()
+        original = main.ADMIN_TOKEN
+        main.ADMIN_TOKEN = 'secret'
+        try:
+            response = client.post('/admin/profile', json={'requests': 1})
+            self.assertEqual(response.status_code, 403)
+            headers = {'X-Admin-Token': 'secret'}
+            response = client.post('/admin/profile', json={'requests': 1, 'interval_ms': 1}, headers=headers)
+            self.assertEqual(response.json['armed'], 1)
+            client.post('/validate_ecl', json={'expression': '< 404684003'})
+            status = client.get('/admin/profile', headers=headers).json
+            self.assertEqual(status['armed'], 0)
+            self.assertGreaterEqual(status['profiled_requests'], 1)
+            response = client.get('/admin/profile/stacks', headers=headers)
+            self.assertEqual(response.mimetype, 'text/plain')
+            for body in [{'requests': 'x'}, {'requests': []}, {'interval_ms': 'fast'}, {'interval_ms': 0}, [1]]:
+                with self.subTest(body=body):
+                    response = client.post('/admin/profile', json=body, headers=headers)
+                    self.assertEqual(response.status_code, 400)
+            self.assertEqual(client.get('/admin/profile', headers=headers).json['armed'], 0)
+            status = client.delete('/admin/profile', headers=headers).json
+            self.assertEqual((status['armed'], status['samples']), (0, 0))
+        finally:
+            main.ADMIN_TOKEN = original
+
+
+class TestBenchmarkHarness(unittest.TestCase):
+    """Test the stand-in server's fault injection and the load benchmark reports"""
+
+    def test_canned_expansion_is_paged(self):
+        """Test that a canned response is served for its expression and synthetic ones otherwise"""
+        canned = build_expansion('< 73211009', 3, 0, 3)
+        canned['expansion']['contains'][0]['display'] = 'Recorded concept'
+        with FakeTerminologyServer(total=50, canned={'< 73211009': canned}) as server:
+            first = fetcher.expand_valueset(server.url, '< 73211009', 2)
+            rest = fetcher.expand_valueset(server.url, '< 73211009', 2, offset=2)
+            other = fetcher.expand_valueset(server.url, '< 404684003', 2)
+        self.assertEqual(first['total'], 3)
+        self.assertEqual(first['concepts'][0]['display'], 'Recorded concept')
+        self.assertEqual(len(rest['concepts']), 1)
+        self.assertEqual(other['total'], 50)
+
+    def test_error_rate_is_reproducible(self):
+        """Test that the same seed injects errors into the same requests"""
+        outcomes = []
+        for _ in range(2):
+            server = FakeTerminologyServer(error_rate=0.3, seed=5)
+            outcomes.append([server.next_response()[1] for _ in range(200)])
+            self.assertTrue(40 <= server.injected_errors <= 80)
+        self.assertEqual(outcomes[0], outcomes[1])
+        self.assertEqual(set(outcomes[0]), {None, 503})
+
+    def test_drive_and_compare(self):
+        """Test latency percentiles of a load run and regression detection between reports"""
+        import benchmark
+        summary = benchmark.drive(lambda i: i % 10 != 0, 50, 4, 2)
+        self.assertEqual(summary['requests'], 50)
+        self.assertEqual(summary['errors'], 5)
+        latency = summary['latency_ms']
+        self.assertLessEqual(latency['p50'], latency['p95'])
+        self.assertLessEqual(latency['p99'], latency['max'])
+
+        def report(rps, p95):
+            return {'scenarios': {'test_ecl': {'throughput_rps': rps,
+                                               'latency_ms': {'p50': 10.0, 'p95': p95, 'p99': 40.0}}}}
+        rows = benchmark.compare_reports(report(100.0, 20.0), report(95.0, 21.0), threshold=10)
+        self.assertFalse(rows[0]['regression'])
+        rows = benchmark.compare_reports(report(100.0, 20.0), report(100.0, 30.0), threshold=10)
+        self.assertTrue(rows[0]['regression'])
+        self.assertEqual(rows[0]['p95'], 50.0)
+
+
+class TestProductionServing(unittest.TestCase):
+    """Test the gunicorn settings and state that must survive many short-lived workers"""
+
+    def test_gunicorn_config(self):
+        """Test worker sizing and that draining outlasts the request timeout"""
+        import runpy
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gunicorn.conf.py')
+        saved = {key: os.environ.get(key) for key in ('WEB_CONCURRENCY', 'REQUEST_TIMEOUT', 'TX_POOL_SIZE')}
+        try:
+            os.environ.pop('WEB_CONCURRENCY', None)
+            os.environ['REQUEST_TIMEOUT'] = '20'
+            config = runpy.run_path(path)
+            self.assertGreaterEqual(config['workers'], 1)
+            self.assertEqual(config['worker_class'], 'gevent')
+            self.assertGreater(config['graceful_timeout'], 20)
+            self.assertTrue(callable(config['worker_exit']))
+            os.environ['WEB_CONCURRENCY'] = '3'
+            self.assertEqual(runpy.run_path(path)['workers'], 3)
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+
+    def test_metric_shards_of_exited_threads_are_folded(self):
+        """Test that per-thread shards do not accumulate as request threads come and go"""
+        registry = Registry()
+        counter = registry.counter('test_total', 'Test counter')
+        for _ in range(50):
+            thread = threading.Thread(target=counter.inc)
+            thread.start()
+            thread.join()
+        counter.inc()
+        self.assertEqual(registry.snapshot()['test_total'], {(): 51})
+        self.assertLessEqual(len(registry._shards), 2)
+
+
+class TestJobs(unittest.TestCase):
+    """Test the persistent job queue, the job runner and the /jobs API"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='ecl-jobs-')
+        self.now = [1000.0]
+        self.store = JobStore(os.path.join(self.tmpdir, 'jobs.sqlite3'), clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def wait_for(self, job_id, store=None, timeout=10):
+        store = store or self.store
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            status = store.get(job_id)
+            if status['state'] in ('done', 'failed', 'cancelled'):
+                return status
+            time.sleep(0.02)
+        self.fail(f'Job {job_id} did not finish')
+
+    def test_lapsed_lease_is_reclaimed(self):
+        """Test that a job whose worker stopped renewing its lease is run again, then failed after max attempts"""
+        job_id = self.store.submit('expand', {'expression': '< 404684003'})
+        job = self.store.claim('worker-a', lease=60)
+        self.assertEqual((job['id'], job['attempts']), (job_id, 1))
+        self.assertIsNone(self.store.claim('worker-b', lease=60))
+
+        self.now[0] += 61
+        job = self.store.claim('worker-b', lease=60)
+        self.assertEqual((job['id'], job['attempts']), (job_id, 2))
+        self.assertFalse(self.store.progress(job_id, 'worker-a', 5, 10, 60))
+        self.assertTrue(self.store.progress(job_id, 'worker-b', 5, 10, 60))
+        self.assertEqual(self.store.get(job_id)['progress'], {'done': 5, 'total': 10})
+
+        self.now[0] += 61
+        self.assertIsNone(self.store.claim('worker-c', lease=60, max_attempts=2))
+        status = self.store.get(job_id)
+        self.assertEqual(status['state'], 'failed')
+        self.assertIn('stopped', status['error'])
+
+    def test_finished_jobs_expire(self):
+        """Test that results are kept until the TTL and queued jobs are never purged"""
+        done_id = self.store.submit('batch', {})
+        self.now[0] += 1
+        queued_id = self.store.submit('batch', {})
+        self.store.claim('worker', lease=60)
+        self.assertTrue(self.store.finish(done_id, 'worker', result={'errors': 0}))
+        self.assertEqual(self.store.result(done_id), {'errors': 0})
+        self.now[0] += 100
+        self.assertEqual(self.store.purge(ttl=200), 0)
+        self.now[0] += 200
+        self.assertEqual(self.store.purge(ttl=200), 1)
+        self.assertIsNone(self.store.get(done_id))
+        self.assertEqual(self.store.get(queued_id)['state'], 'queued')
+
+    def test_output_is_spooled_in_rows(self):
+        """Test that progress output is stored row by row, read back in order and dropped when a job is re-run"""
+        job_id = self.store.submit('expand', {})
+        self.store.claim('worker-a', lease=60)
+        self.assertTrue(self.store.progress(job_id, 'worker-a', 2, 3, 60, [{'code': '1'}, {'code': '2'}]))
+        self.assertTrue(self.store.progress(job_id, 'worker-a', 3, 3, 60, [{'code': '3'}]))
+        self.assertFalse(self.store.progress(job_id, 'worker-b', 3, 3, 60, [{'code': '4'}]))
+        self.assertEqual([self.store.output(job_id, seq) for seq in range(3)],
+                         [[{'code': '1'}, {'code': '2'}], [{'code': '3'}], None])
+
+        self.now[0] += 61
+        self.store.claim('worker-b', lease=60)
+        self.assertIsNone(self.store.output(job_id, 0))
+        self.store.progress(job_id, 'worker-b', 1, 3, 60, [{'code': '1'}])
+        self.assertTrue(self.store.cancel(job_id))
+        self.assertIsNone(self.store.output(job_id, 0))
+
+    def test_stop_waits_once_for_all_threads(self):
+        """Test that stop(timeout) returns after about timeout seconds however many workers are busy"""
+        release = threading.Event()
+        started = []
+        store = JobStore(os.path.join(self.tmpdir, 'stop.sqlite3'))
+
+        def stuck(params, progress):
+            started.append(params)
+            release.wait(10)
+            return {}
+
+        runner = JobRunner(store, {'stuck': stuck}, workers=3, poll_interval=0.01).start()
+        try:
+            for n in range(3):
+                runner.submit('stuck', {'n': n})
+            deadline = time.time() + 5
+            while len(started) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            start = time.monotonic()
+            runner.stop(timeout=0.3)
+            self.assertLess(time.monotonic() - start, 0.6)
+        finally:
+            release.set()
+            store.close()
+
+    def test_runner_cancel_and_release(self):
+        """Test that cancelled jobs stop at their next progress report and unfinished jobs are requeued on stop"""
+        store = JobStore(os.path.join(self.tmpdir, 'runner.sqlite3'))
+        started = threading.Event()
+
+        def slow(params, progress):
+            for step in range(500):
+                started.set()
+                progress(step, 500)
+                time.sleep(0.01)
+            return {'steps': 500}
+
+        runner = JobRunner(store, {'slow': slow, 'quick': lambda params, progress: {'echo': params}},
+                           workers=1, poll_interval=0.05).start()
+        try:
+            quick_id = runner.submit('quick', {'n': 1})
+            self.assertEqual(self.wait_for(quick_id, store)['state'], 'done')
+            self.assertEqual(store.result(quick_id), {'echo': {'n': 1}})
+            with self.assertRaises(ValueError):
+                runner.submit('unknown', {})
+
+            slow_id = runner.submit('slow', {})
+            self.assertTrue(started.wait(5))
+            self.assertTrue(runner.cancel(slow_id))
+            self.assertEqual(self.wait_for(slow_id, store)['state'], 'cancelled')
+            self.assertFalse(runner.cancel(slow_id))
+
+            started.clear()
+            requeued_id = runner.submit('slow', {})
+            self.assertTrue(started.wait(5))
+        finally:
+            runner.stop(timeout=5)
+        self.assertEqual(store.get(requeued_id)['state'], 'queued')
+        self.assertEqual(runner.stats()['completed_here'], 1)
+        store.close()
+
+    def test_job_api(self):
+        """Test submitting, polling and fetching expansion and batch jobs over HTTP"""
+        from main import app
+        app.config['TESTING'] = True
+        client = app.test_client()
+        with FakeTerminologyServer(total=2500) as server:
+            response = client.post('/jobs', json={'type': 'expand', 'expression': '< 404684003 |Job|',
+                                                  'endpoint': server.url, 'page_size': 1000})
+            self.assertEqual(response.status_code, 202)
+            job_id = response.json['job']['id']
+            self.assertEqual(response.headers['Location'], f'/jobs/{job_id}')
+
+            events = client.get(f'/jobs/{job_id}/events').data.decode()
+            final = json.loads(events.strip().split('\n\n')[-1][len('data: '):])
+            self.assertEqual(final['state'], 'done')
+            self.assertEqual(final['progress'], {'done': 2500, 'total': 2500})
+            response = client.get(f'/jobs/{job_id}/result')
+            self.assertTrue(response.json['success'])
+            self.assertEqual(response.json['result']['total'], 2500)
+            self.assertEqual(len(response.json['result']['concepts']), 2500)
+
+            response = client.post('/jobs', json={'type': 'batch', 'count_only': True, 'endpoint': server.url,
+                                                  'expressions': ['< 73211009', '< (', '<< 404684003']})
+            job_id = response.json['job']['id']
+            deadline = time.time() + 10
+            while client.get(f'/jobs/{job_id}').json['job']['state'] != 'done' and time.time() < deadline:
+                time.sleep(0.02)
+            result = client.get(f'/jobs/{job_id}/result').json['result']
+        self.assertEqual([entry['total'] for entry in result['results']], [2500, -1, 2500])
+        self.assertEqual(result['errors'], 1)
+        self.assertIn('Invalid ECL', result['results'][1]['error'])
+        self.assertIn(job_id, [job['id'] for job in client.get('/jobs').json['jobs']])
+
+        self.assertEqual(client.get('/jobs/missing').status_code, 404)
+        self.assertEqual(client.delete(f'/jobs/{job_id}').status_code, 409)
+        self.assertEqual(client.post('/jobs', json={'type': 'export'}).status_code, 400)
+        self.assertEqual(client.post('/jobs', json={'type': 'batch', 'expressions': ['< 1'], 'count': 'x'}).status_code,
+                         400)
+        self.assertEqual(client.get('/jobs?limit=x').status_code, 400)
+        self.assertEqual(client.post('/jobs', json={'type': 'expand', 'expression': '<'}).status_code, 400)
+
+
+class TestStreamingExpansion(unittest.TestCase):
+    """Test paged streaming of full expansions through /expand_ecl"""
+
+    @classmethod
+    def setUpClass(cls):
+        from main import app
+        app.config['TESTING'] = True
+        cls.app = app.test_client()
+        cls.server = FakeTerminologyServer(total=2500).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def test_iter_expansion_pages(self):
+        """Test that iter_expansion walks every page with offset/count"""
+        pages = list(fetcher.iter_expansion(self.server.url, '< 404684003', page_size=1000))
+        self.assertEqual([len(page['concepts']) for page in pages], [1000, 1000, 500])
+        codes = [c['code'] for page in pages for c in page['concepts']]
+        self.assertEqual(len(set(codes)), 2500)
+
+    def test_iter_expansion_without_total(self):
+        """Test that paging continues until a short page when the server does not report a total"""
+        with FakeTerminologyServer(total=2500, report_total=False) as server:
+            pages = list(fetcher.iter_expansion(server.url, '< 404684003 |No total|', page_size=1000))
+            self.assertEqual([len(page['concepts']) for page in pages], [1000, 1000, 500])
+            self.assertEqual(pages[0]['total'], -1)
+            pages = list(fetcher.iter_expansion(server.url, '< 404684003 |No total|', page_size=500))
+            self.assertEqual([len(page['concepts']) for page in pages], [500] * 5 + [0])
+
+    def test_ndjson_stream(self):
+        """Test that NDJSON output starts with the total followed by one concept per line"""
+        response = self.app.post('/expand_ecl', json={
+            'expression': '< 404684003', 'endpoint': self.server.url, 'page_size': 700})
+        lines = response.data.decode().splitlines()
+        self.assertEqual(json.loads(lines[0]), {'total': 2500})
+        self.assertEqual(len(lines), 2501)
+        self.assertEqual(set(json.loads(lines[1])), {'code', 'display'})
+
+    def test_csv_stream(self):
+        """Test CSV output"""
+        response = self.app.post('/expand_ecl', json={
+            'expression': '< 404684003', 'endpoint': self.server.url, 'format': 'csv'})
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = response.data.decode().splitlines()
+        self.assertEqual(rows[0], 'code,display')
+        self.assertEqual(len(rows), 2501)
+
+    def test_error_is_streamed(self):
+        """Test that an invalid expression produces a single error line"""
+        response = self.app.post('/expand_ecl', json={'expression': '< 404684003 |invalid|',
+                                                      'endpoint': self.server.url})
+        lines = response.data.decode().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('error', json.loads(lines[0]))
+
+    def test_syntax_error_is_rejected(self):
+        """Test that malformed ECL is rejected before any request is made"""
+        requests_before = self.server.request_count
+        response = self.app.post('/expand_ecl', json={'expression': '<< 404684003 :', 'endpoint': self.server.url})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['syntax_error']['column'], 15)
+        self.assertEqual(self.server.request_count, requests_before)
+
+    def test_failed_first_page_is_an_error_status(self):
+        """Test that an upstream failure before any concept is sent is a 502, not an empty 200 CSV"""
+        self.server.fail_status = 500
+        try:
+            for stream_format in ('csv', 'ndjson'):
+                with self.subTest(format=stream_format):
+                    response = self.app.post('/expand_ecl', json={'expression': '< 404684003', 'format': stream_format,
+                                                                  'endpoint': self.server.url})
+                    self.assertEqual(response.status_code, 502)
+                    self.assertIn('API request failed', response.json['error'])
+        finally:
+            self.server.fail_status = None
+            fetcher.configure_resilience()
+
+    def test_failure_after_first_page_aborts_csv(self):
+        """Test that a CSV stream failing part way is cut off instead of ending like a complete file"""
+        import main
+        iter_expansion = fetcher.iter_expansion
+
+        def failing_after_first_page(endpoint, ecl, page_size):
+            pages = iter_expansion(endpoint, ecl, page_size)
+            yield next(pages)
+            pages.close()
+            yield {'total': -1, 'concepts': [], 'error': 'API request failed: HTTP 500'}
+
+        fetcher.iter_expansion = failing_after_first_page
+        try:
+            response = self.app.post('/expand_ecl', json={'expression': '< 404684003', 'format': 'csv',
+                                                          'endpoint': self.server.url, 'page_size': 1000})
+            self.assertEqual(response.status_code, 200)
+            with self.assertRaises(main.StreamAborted):
+                response.get_data()
+            response = self.app.post('/expand_ecl', json={'expression': '< 404684003',
+                                                          'endpoint': self.server.url, 'page_size': 1000})
+            lines = response.data.decode().splitlines()
+            self.assertEqual(len(lines), 1002)
+            self.assertEqual(json.loads(lines[-1]), {'error': 'API request failed: HTTP 500'})
+        finally:
+            fetcher.iter_expansion = iter_expansion
+
+    def test_bad_page_size_is_rejected(self):
+        """Test that a page_size that is not a number is a 400 rather than a 500, for streams and jobs"""
+        requests_before = self.server.request_count
+        response = self.app.post('/expand_ecl', json={'expression': '< 404684003', 'endpoint': self.server.url,
+                                                      'page_size': 'big'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json['error'], 'page_size must be a whole number')
+        response = self.app.post('/jobs', json={'type': 'expand', 'expression': '< 404684003',
+                                                'endpoint': self.server.url, 'page_size': 'big'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.server.request_count, requests_before)
+
+
 class TestSearch(unittest.TestCase):
     
     def setUp(self):
@@ -273,6 +2274,61 @@ class TestSearch(unittest.TestCase):
                     self.assertTrue(result['expression'].endswith('...'))
 
 
+class TestSearchIndex(unittest.TestCase):
+    """Test the inverted-index search engine directly"""
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.add_many([
+            self.entry('AMT', '01-01-TPUU-Dose-Form-Injection.txt', 'All TPUUs with a dose form of injection',
+                       '^ 929360031000036100 |Trade product unit of use reference set|: '
+                       '411116001 |Has manufactured dose form| = << 129011000036109 |Injection|'),
+            self.entry('AMT', '03-01-TPUU-Cephalexin-Dose-Forms.txt', 'Dose forms of cephalexin products',
+                       '^ 929360031000036100 |Trade product unit of use reference set|: '
+                       '127489000 |Has active ingredient| = 372833007 |Cefalexin|'),
+            self.entry('ClinicalFindings', '04-01-DiabetesNotGDM.txt', 'Diabetes but not gestational diabetes',
+                       '<< 73211009 |Diabetes mellitus| MINUS << 11687002 |Gestational diabetes mellitus|'),
+        ])
+
+    def entry(self, category, filename, description, expression):
+        return {'filename': filename, 'path': f'ecl_library/{category}/{filename}',
+                'description': description, 'expression': expression, 'category': category}
+
+    def filenames(self, query):
+        return [entry['filename'] for score, entry in self.index.search(query)]
+
+    def test_ranks_description_match_first(self):
+        """Test that a term in the description outranks the same term only in the expression"""
+        self.assertEqual(self.filenames('injection')[0], '01-01-TPUU-Dose-Form-Injection.txt')
+
+    def test_all_tokens_must_match(self):
+        """Test that multi-word queries require every word"""
+        self.assertEqual(self.filenames('dose cephalexin'), ['03-01-TPUU-Cephalexin-Dose-Forms.txt'])
+        self.assertEqual(self.filenames('diabetes injection'), [])
+
+    def test_prefix_and_substring_matching(self):
+        """Test typeahead prefixes and mid-word matches"""
+        self.assertEqual(self.filenames('gestat'), ['04-01-DiabetesNotGDM.txt'])
+        self.assertEqual(self.filenames('lexin'), ['03-01-TPUU-Cephalexin-Dose-Forms.txt'])
+
+    def test_concept_ids_and_terms(self):
+        """Test lookups by SCTID and by |term| label"""
+        self.assertEqual(self.filenames('73211009'), ['04-01-DiabetesNotGDM.txt'])
+        self.assertEqual(self.filenames('cefalexin'), ['03-01-TPUU-Cephalexin-Dose-Forms.txt'])
+        self.assertEqual(len(self.filenames('929360031000036100')), 2)
+
+    def test_incremental_updates(self):
+        """Test that changed and removed entries are reflected in results"""
+        self.index.on_catalog_change(
+            [self.entry('Procedures', '01-01-Bilateral.txt', 'Bilateral procedures', '<< 71388002 |Procedure|')],
+            [self.entry('ClinicalFindings', '04-01-DiabetesNotGDM.txt', 'Type 1 diabetes', '<< 46635009')],
+            [self.entry('AMT', '01-01-TPUU-Dose-Form-Injection.txt', '', '')])
+        self.assertEqual(self.filenames('bilateral'), ['01-01-Bilateral.txt'])
+        self.assertEqual(self.filenames('gestational'), [])
+        self.assertEqual(self.filenames('injection'), [])
+        self.assertEqual(len(self.index), 3)
+
+
 class TestValueSetURL(unittest.TestCase):
     """Test the ValueSet URL generation functionality"""
     
@@ -340,7 +2396,6 @@ class TestValueSetURL(unittest.TestCase):
         """Test URL encoding of ECL with various quote types"""
         ecl = '< 404684003 "quoted text" and \'single quotes\''
         encoded = urllib.parse.quote(ecl)
-        url = f"http://snomed.info/sct?fhir_vs=ecl/{encoded}"
         
         # Verify quotes are encoded
         self.assertIn("%22", encoded)  # "